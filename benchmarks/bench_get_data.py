@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark of PyPSRFITS.get_data decoding with a pool of worker processes.
+
+Decodes a SEARCH mode PSRFITS file with an increasing number of workers and
+reports the throughput, speedup and scaling efficiency relative to the serial
+path. A synthetic file is written if no file is given, e.g.
+
+    python benchmarks/bench_get_data.py --workers 1 2 4 8
+    python benchmarks/bench_get_data.py --file obs.fits --downsamp 8
+"""
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import fitsio
+
+import pdat
+
+
+def write_synthetic(path, nrows, nsblk, nchan, npol):
+    """Write a SEARCH mode file of 8-bit random data."""
+    rng = np.random.RandomState(0)
+    dtype = [('TSUBINT', '>f8'), ('OFFS_SUB', '>f8'),
+             ('DAT_FREQ', '>f4', (nchan,)), ('DAT_WTS', '>f4', (nchan,)),
+             ('DAT_OFFS', '>f4', (nchan*npol,)),
+             ('DAT_SCL', '>f4', (nchan*npol,)),
+             ('DATA', 'u1', (nsblk, npol, nchan, 1))]
+    hdr = [{'name': 'NSBLK', 'value': nsblk},
+           {'name': 'NPOL', 'value': npol},
+           {'name': 'NCHAN', 'value': nchan},
+           {'name': 'NBITS', 'value': 8},
+           {'name': 'TBIN', 'value': 64e-6},
+           {'name': 'POL_TYPE', 'value': 'AA+BB'}]
+    with fitsio.FITS(path, 'rw', clobber=True) as fits:
+        fits.write(None, header=[{'name': 'OBS_MODE', 'value': 'SEARCH'}])
+        fits.create_table_hdu(dtype=dtype, extname='SUBINT')
+        fits['SUBINT'].write_keys(hdr)
+        for row in range(nrows):
+            subint = np.zeros(1, dtype=dtype)
+            subint['TSUBINT'] = nsblk * 64e-6
+            subint['OFFS_SUB'] = (row + 0.5) * nsblk * 64e-6
+            subint['DAT_FREQ'] = np.linspace(1500, 1300, nchan)
+            subint['DAT_WTS'] = 1
+            subint['DAT_SCL'] = 1
+            subint['DATA'] = rng.randint(0, 256, subint['DATA'].shape)
+            fits['SUBINT'].append(subint)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--file', default=None,
+                        help='PSRFITS file to decode (default: synthetic).')
+    parser.add_argument('--nrows', type=int, default=64)
+    parser.add_argument('--nsblk', type=int, default=4096)
+    parser.add_argument('--nchan', type=int, default=512)
+    parser.add_argument('--npol', type=int, default=1)
+    parser.add_argument('--downsamp', type=int, default=1)
+    parser.add_argument('--workers', type=int, nargs='+',
+                        default=[1, 2, 4, 8])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    path = args.file
+    if path is None:
+        path = os.path.join(tempfile.mkdtemp(), 'bench_search.fits')
+        write_synthetic(path, args.nrows, args.nsblk, args.nchan, args.npol)
+
+    pf = pdat.PyPSRFITS(path)
+    nbytes = pf.subhdr['NAXIS1'] * pf.subhdr['NAXIS2']
+    print('{0}: {1:.1f} MB of SUBINT data'.format(path, nbytes / 1e6))
+    print('{0:>8} {1:>10} {2:>10} {3:>8} {4:>10}'.format(
+        'workers', 'time (s)', 'MB/s', 'speedup', 'efficiency'))
+
+    # Speedups are relative to the first worker count (normally 1)
+    serial = None
+    for workers in args.workers:
+        best = np.inf
+        for _ in range(args.repeat):
+            t0 = time.time()
+            pf.get_data(0, -1, downsamp=args.downsamp, workers=workers)
+            best = min(best, time.time() - t0)
+        if serial is None:
+            serial, serial_workers = best, workers
+        speedup = serial / best
+        efficiency = speedup * serial_workers / workers
+        print('{0:>8d} {1:>10.3f} {2:>10.1f} {3:>8.2f} {4:>10.2f}'.format(
+            workers, best, nbytes / 1e6 / best, speedup, efficiency))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark of opening existing PSRFITS files with psrfits(mode='rw').
+
+Opens many files and reads one PRIMARY key from each, comparing the lazily
+loaded draft headers with reading every header up front (the old behaviour)
+and with a bare fitsio.FITS open, which is the floor set by the filesystem
+and cfitsio. Synthetic files with PSRFITS sized headers are written if no
+files are given, e.g.
+
+    python benchmarks/bench_open.py --nfiles 2000
+    python benchmarks/bench_open.py --files /data/*.fits
+"""
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+import argparse
+import contextlib
+import io
+import os
+import tempfile
+import time
+
+import numpy as np
+import fitsio
+
+import pdat
+
+
+def write_synthetic(path, ncards=150):
+    """Write a small SEARCH mode file with about ncards cards in each of its
+    PRIMARY, HISTORY, POLYCO and SUBINT headers."""
+    cards = [{'name': 'KEY{0:04d}'.format(ii), 'value': float(ii),
+              'comment': 'synthetic header card'} for ii in range(ncards)]
+    primary = [{'name': 'OBS_MODE', 'value': 'SEARCH'},
+               {'name': 'SRC_NAME', 'value': 'J1234+5678'}] + cards
+    table = np.zeros(2, dtype=[('A', '>f8'), ('B', '>f4', (16,))])
+    subint = np.zeros(2, dtype=[('TSUBINT', '>f8'), ('OFFS_SUB', '>f8'),
+                                ('DATA', 'u1', (64, 1, 32, 1))])
+    with fitsio.FITS(path, 'rw', clobber=True) as fits:
+        fits.write(None, header=primary)
+        fits.write_table(table, extname='HISTORY', header=cards)
+        fits.write_table(table, extname='POLYCO', header=cards)
+        fits.write_table(subint, extname='SUBINT', header=cards)
+
+
+def open_fitsio(path):
+    with fitsio.FITS(path, 'rw') as fits:
+        fits[0].read_header()['SRC_NAME']
+
+
+def open_lazy(path):
+    psrf = pdat.psrfits(path, mode='rw', verbose=False)
+    psrf.draft_hdrs['PRIMARY']['SRC_NAME']
+    psrf.close()
+
+
+def open_eager(path):
+    psrf = pdat.psrfits(path, mode='rw', verbose=False)
+    for key in psrf.draft_hdr_keys:
+        psrf.draft_hdrs[key]
+    psrf.draft_hdrs['PRIMARY']['SRC_NAME']
+    psrf.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--files', nargs='+', default=None,
+                        help='PSRFITS files to open (default: synthetic).')
+    parser.add_argument('--nfiles', type=int, default=500)
+    parser.add_argument('--ncards', type=int, default=150)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    paths = args.files
+    if paths is None:
+        tmp = tempfile.mkdtemp()
+        paths = [os.path.join(tmp, 'bench_open_{0}.fits'.format(ii))
+                 for ii in range(args.nfiles)]
+        for path in paths:
+            write_synthetic(path, args.ncards)
+
+    print('{0} files'.format(len(paths)))
+    print('{0:>16} {1:>10} {2:>12} {3:>8}'.format(
+        'open', 'time (s)', 'ms per file', 'vs fitsio'))
+    floor = None
+    for name, func in [('fitsio.FITS', open_fitsio),
+                       ('psrfits lazy', open_lazy),
+                       ('psrfits eager', open_eager)]:
+        best = np.inf
+        for _ in range(args.repeat):
+            # psrfits.close() prints a blank line
+            with contextlib.redirect_stdout(io.StringIO()):
+                t0 = time.time()
+                for path in paths:
+                    func(path)
+                best = min(best, time.time() - t0)
+        if floor is None:
+            floor = best
+        print('{0:>16} {1:>10.3f} {2:>12.3f} {3:>8.2f}'.format(
+            name, best, 1e3 * best / len(paths), best / floor))
+
+
+if __name__ == '__main__':
+    main()
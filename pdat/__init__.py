@@ -3,8 +3,14 @@
 """Top-level package for PulsarDataToolbox."""
 from __future__ import (absolute_import, division,
                     print_function, unicode_literals)
-from .pdat import psrfits
+from .pdat import psrfits, TemplateCache, template_cache
 from .pypsrfits import PyPSRFITS
+from .index import PSRFITSIndex
+from .merge import merge_psrfits
+from .scrunch import scrunch_psrfits
+from .dedisperse import Dedisperser, dedisperse_psrfits
+from .stats import StreamStats
+from .rfi import sk_mask
 
 __author__ = """Jeffrey S Hazboun"""
 __email__ = 'jeffrey.hazboun@gmail.com'
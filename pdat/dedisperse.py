@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+# encoding=utf8
+"""Streaming incoherent dedispersion of SEARCH mode PSRFITS data."""
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+from .pypsrfits import PyPSRFITS, downsample_freqs
+
+# Dispersion constant in MHz^2 pc^-1 cm^3 s.
+k_dm = 4.148808e3
+
+
+def dispersion_delay(dm, freqs, ref_freq=np.inf):
+    """
+    Dispersion delay in seconds of radio waves at freqs (MHz) relative to
+    ref_freq (MHz, default infinite frequency) for a dispersion measure
+    dm (pc cm^-3). dm and freqs are broadcast against each other.
+    """
+    freqs = np.asarray(freqs, dtype=np.float64)
+    return k_dm * np.asarray(dm, dtype=np.float64) * (freqs**-2.
+                                                       - ref_freq**-2.)
+
+
+class Dedisperser(object):
+    """
+    Incoherent (shift and sum) dedispersion of a stream of filterbank
+    blocks for a batch of trial DMs.
+
+    Blocks of spectra are given to `push()` in time order. The last
+    `max_delay` samples of each block are kept as the overlap with the next
+    one, so the dedispersed time series are the same whatever the block
+    sizes, and memory use only depends on the block size, the number of
+    channels and the number of DMs. Sample i of each output time series is
+    the sum over channels of the samples that arrive i samples after the
+    start of the stream at `ref_freq`.
+
+    Parameters
+    ----------
+
+    dms : array_like
+        Trial dispersion measures (pc cm^-3).
+
+    freqs : array_like
+        Channel centre frequencies (MHz).
+
+    tbin : float
+        Sample time (s).
+
+    ref_freq : float, optional
+        Reference frequency (MHz) of the output time series. Default is the
+        highest channel frequency. Must be at least as high as every
+        channel.
+
+    workers : int
+        Number of threads the trial DMs are split between.
+    """
+    def __init__(self, dms, freqs, tbin, ref_freq=None, workers=1):
+        self.dms = np.atleast_1d(np.asarray(dms, dtype=np.float64))
+        self.freqs = np.asarray(freqs, dtype=np.float64)
+        self.tbin = tbin
+        if ref_freq is None:
+            ref_freq = self.freqs.max()
+        if ref_freq < self.freqs.max():
+            raise ValueError('ref_freq ({0} MHz) is below the highest '
+                             'channel frequency ({1} MHz).'.format(
+                                 ref_freq, self.freqs.max()))
+        self.ref_freq = ref_freq
+        # Delay of each channel, in samples, for each DM: [dm, chan]
+        delays = dispersion_delay(self.dms[:, np.newaxis], self.freqs,
+                                  ref_freq) / tbin
+        self.delays = np.rint(delays).astype(np.intp)
+        self.max_delay = int(self.delays.max()) if self.delays.size else 0
+        self.workers = workers
+        self._pool = ThreadPool(workers) if workers > 1 else None
+        # Overlap kept from previous blocks, with dimensions [chan, time]
+        self._overlap = np.zeros((len(self.freqs), 0), dtype=np.float32)
+        self.nsamp_in = 0
+        self.nsamp_out = 0
+
+    def push(self, block):
+        """
+        Add a block of spectra, with dimensions [time, chan], to the stream.
+        Returns the newly completed samples of the dedispersed time series,
+        with dimensions [dm, time]. Fewer samples than are in the block are
+        returned until `max_delay` samples have been pushed.
+        """
+        block = np.asarray(block, dtype=np.float32)
+        if block.ndim != 2 or block.shape[1] != len(self.freqs):
+            raise ValueError('Blocks must have dimensions [time, chan] with '
+                             '{0} channels.'.format(len(self.freqs)))
+        # Channel-major, so every shifted channel is a contiguous slice
+        data = np.concatenate([self._overlap, block.T], axis=1)
+        nout = max(0, data.shape[1] - self.max_delay)
+        out = np.zeros((len(self.dms), nout), dtype=np.float32)
+        if nout:
+            if self._pool is None:
+                _shift_sum(data, self.delays, out)
+            else:
+                bounds = np.linspace(0, len(self.dms),
+                                     min(self.workers, len(self.dms)) + 1)
+                bounds = bounds.astype(int)
+                self._pool.map(lambda b: _shift_sum(
+                    data, self.delays[b[0]:b[1]], out[b[0]:b[1]]),
+                               zip(bounds[:-1], bounds[1:]))
+        self._overlap = np.ascontiguousarray(data[:, nout:])
+        self.nsamp_in += len(block)
+        self.nsamp_out += nout
+        return out
+
+    def close(self):
+        """Stop the worker threads."""
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+
+def _shift_sum(data, delays, out):
+    """
+    Add each channel of data ([chan, time]) into out ([dm, time]), shifted
+    earlier by the delays ([dm, chan]) in samples.
+    """
+    nout = out.shape[1]
+    for chan in range(data.shape[0]):
+        row = data[chan]
+        # Every window of nout samples of the channel, one per delay
+        windows = as_strided(row, shape=(len(row) - nout + 1, nout),
+                             strides=(row.strides[0], row.strides[0]))
+        out += windows[delays[:, chan]]
+
+
+def dedisperse_psrfits(path, dms, out=None, out_path=None, start_row=0,
+                       end_row=-1, rows_per_block=16, downsamp=1,
+                       fdownsamp=1, ref_freq=None, workers=1,
+                       decode_workers=1):
+    """
+    Dedisperse a SEARCH mode PSRFITS file for a batch of trial DMs, reading
+    it a block of rows at a time with `PyPSRFITS.iter_blocks()`.
+
+    Total intensity is dedispersed: AA+BB for POL_TYPE 'AABB...' data and
+    the first polarization otherwise (see pol_mode='I' of `get_data()`),
+    summed as it is decoded. The last `max_delay` samples (the
+    dispersion sweep of the largest DM across the band) can not be fully
+    dedispersed and are left out, so each time series has
+    nsamp - max_delay samples, starting at the first sample of the file at
+    the reference frequency.
+
+    Parameters
+    ----------
+
+    path : str
+        SEARCH mode file.
+
+    dms : array_like
+        Trial dispersion measures (pc cm^-3).
+
+    out : array, optional
+        Array of shape [dm, time] to write the time series into, e.g. a
+        numpy.memmap.
+
+    out_path : str, optional
+        Write the time series into a new .npy file at this path, through a
+        memory map, instead of holding them in memory.
+
+    start_row, end_row, rows_per_block, downsamp, fdownsamp :
+        See `PyPSRFITS.iter_blocks()`.
+
+    ref_freq : float, optional
+        Reference frequency (MHz), default the highest channel frequency.
+
+    workers : int
+        Number of threads the trial DMs are split between.
+
+    decode_workers : int
+        Number of processes decoding each block, see `PyPSRFITS.get_data()`.
+
+    Returns
+    -------
+    The dedispersed time series, with dimensions [dm, time].
+    """
+    pf = PyPSRFITS(path)
+    p = pf._search_setup(start_row, end_row, downsamp, fdownsamp)
+    freqs = downsample_freqs(pf.get_freqs(p['start_row']), p['fdownsamp'])
+    nsamp = (p['end_row'] - p['start_row'] + 1) * p['nsblk_ds']
+
+    dd = Dedisperser(dms, freqs, p['tbin'] * p['downsamp'],
+                     ref_freq=ref_freq, workers=workers)
+    nout = nsamp - dd.max_delay
+    if nout <= 0:
+        dd.close()
+        raise ValueError('The file has {0} samples, fewer than the largest '
+                         'dispersion delay ({1} samples).'.format(
+                             nsamp, dd.max_delay))
+    shape = (len(dd.dms), nout)
+    if out is None:
+        if out_path is not None:
+            out = np.lib.format.open_memmap(out_path, mode='w+',
+                                            dtype=np.float32, shape=shape)
+        else:
+            out = np.zeros(shape, dtype=np.float32)
+    elif out.shape != shape:
+        dd.close()
+        raise ValueError('out must have shape {0}.'.format(shape))
+
+    try:
+        for data, _, _ in pf.iter_blocks(rows_per_block, p['start_row'],
+                                         p['end_row'], downsamp=downsamp,
+                                         fdownsamp=fdownsamp, pol_mode='I',
+                                         workers=decode_workers):
+            samp = dd.nsamp_out
+            series = dd.push(data[:, 0])
+            out[:, samp:samp + series.shape[1]] = series
+    finally:
+        dd.close()
+        pf.fits.close()
+    if isinstance(out, np.memmap):
+        out.flush()
+    return out
@@ -0,0 +1,366 @@
+# -*- coding: utf-8 -*-
+# encoding=utf8
+"""Persistent SQLite index of PSRFITS header metadata."""
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+import collections
+import json
+import multiprocessing
+import os
+import sqlite3
+
+import fitsio as F
+import six
+
+# Extensions recognised as PSRFITS files when scanning directories.
+fits_extensions = ('.fits', '.fit', '.sf', '.rf', '.cf', '.ar')
+
+_schema = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    mtime REAL,
+    size INTEGER,
+    src_name TEXT,
+    obs_mode TEXT,
+    telescope TEXT,
+    obsfreq REAL,
+    obsbw REAL,
+    freq_lo REAL,
+    freq_hi REAL,
+    mjd_start REAL,
+    mjd_end REAL,
+    nsubint INTEGER,
+    nchan INTEGER,
+    npol INTEGER,
+    nbits INTEGER,
+    nsblk INTEGER,
+    tbin REAL
+);
+CREATE TABLE IF NOT EXISTS hdus (
+    path TEXT,
+    hdu INTEGER,
+    extname TEXT,
+    header TEXT,
+    data_start INTEGER,
+    nrows INTEGER,
+    PRIMARY KEY (path, hdu)
+);
+CREATE INDEX IF NOT EXISTS files_src ON files (src_name);
+CREATE INDEX IF NOT EXISTS files_mjd ON files (mjd_start, mjd_end);
+CREATE INDEX IF NOT EXISTS files_freq ON files (freq_lo, freq_hi);
+"""
+
+_file_columns = ['path', 'mtime', 'size', 'src_name', 'obs_mode',
+                 'telescope', 'obsfreq', 'obsbw', 'freq_lo', 'freq_hi',
+                 'mjd_start', 'mjd_end', 'nsubint', 'nchan', 'npol', 'nbits',
+                 'nsblk', 'tbin']
+
+
+class PSRFITSIndex(object):
+
+    def __init__(self, db_path, verbose=False):
+        """
+        A local SQLite database of the key header values and HDU layout of a
+        collection of PSRFITS files. Files are scanned once (in parallel) and
+        are keyed by path, modification time and size, so later scans only
+        re-read files that have changed. The cached headers can be handed to
+        `psrfits` and `PyPSRFITS` (`index=` keyword) to skip parsing them
+        again.
+
+        Parameters
+        ----------
+
+        db_path : str
+            Path to the SQLite database. It is created if it does not exist.
+
+        verbose : bool
+            Print a summary of each scan.
+        """
+        self.db_path = db_path
+        self.verbose = verbose
+        self.db = sqlite3.connect(db_path)
+        self.db.executescript(_schema)
+        self.db.commit()
+
+    def close(self):
+        """Close the database connection."""
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+
+    def __contains__(self, path):
+        return self._lookup(path) is not None
+
+    def scan(self, paths, workers=1, force=False):
+        """
+        Add files to the index, or update those that have changed.
+
+        Parameters
+        ----------
+
+        paths : str or list of str
+            Files and/or directories. Directories are searched recursively for
+            files ending in one of `fits_extensions`.
+
+        workers : int
+            Number of processes used to read the headers.
+
+        force : bool
+            Re-read every file, even if its mtime and size are unchanged.
+
+        Returns
+        -------
+        Number of files (re)indexed.
+        """
+        if isinstance(paths, six.string_types):
+            paths = [paths]
+        files = []
+        for path in paths:
+            if os.path.isdir(path):
+                for root, dirs, names in os.walk(path):
+                    files.extend(os.path.join(root, name)
+                                 for name in sorted(names)
+                                 if name.lower().endswith(fits_extensions))
+            else:
+                files.append(path)
+
+        stale = [os.path.abspath(path) for path in files
+                 if force or not self.is_current(path)]
+        if workers > 1 and len(stale) > 1:
+            pool = multiprocessing.Pool(workers)
+            try:
+                results = pool.map(_scan_file, stale)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [_scan_file(path) for path in stale]
+
+        n_bad = 0
+        for result in results:
+            if isinstance(result, Exception):
+                n_bad += 1
+                if self.verbose:
+                    print('Skipping {0}'.format(result))
+                continue
+            self._store(*result)
+        self.db.commit()
+
+        if self.verbose:
+            print('Indexed {0} of {1} files '
+                  '({2} unreadable).'.format(len(stale) - n_bad, len(files),
+                                             n_bad))
+        return len(stale) - n_bad
+
+    def refresh(self, workers=1):
+        """
+        Re-scan the files already in the index. Files that have changed are
+        re-read and files that no longer exist are removed.
+
+        Returns
+        -------
+        Number of files re-indexed.
+        """
+        paths = [row[0] for row in self.db.execute('SELECT path FROM files')]
+        missing = [path for path in paths if not os.path.exists(path)]
+        for path in missing:
+            self.remove(path)
+        self.db.commit()
+        return self.scan([path for path in paths if path not in missing],
+                         workers=workers)
+
+    def remove(self, path):
+        """Remove a file from the index."""
+        path = os.path.abspath(path)
+        self.db.execute('DELETE FROM files WHERE path=?', (path,))
+        self.db.execute('DELETE FROM hdus WHERE path=?', (path,))
+
+    def is_current(self, path):
+        """True if the file is indexed and unchanged since it was scanned."""
+        row = self._lookup(path)
+        if row is None:
+            return False
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        return row[1] == stat.st_mtime and row[2] == stat.st_size
+
+    def query(self, source=None, freq_range=None, mjd_range=None,
+              obs_mode=None, telescope=None):
+        """
+        Find indexed files by source, frequency and/or time.
+
+        Parameters
+        ----------
+
+        source : str
+            Source name (SRC_NAME). SQL wildcards (% and _) are allowed.
+
+        freq_range : tuple of float
+            (low, high) in MHz. Files whose band overlaps the range match.
+
+        mjd_range : tuple of float
+            (start, end) MJD. Files whose observation overlaps the range
+            match.
+
+        obs_mode : str, {'SEARCH', 'PSR', 'CAL'}
+
+        telescope : str
+
+        Returns
+        -------
+        List of file paths, sorted by start MJD.
+        """
+        where, args = [], []
+        if source is not None:
+            where.append('src_name LIKE ?')
+            args.append(source)
+        if freq_range is not None:
+            where.append('freq_hi >= ? AND freq_lo <= ?')
+            args.extend([min(freq_range), max(freq_range)])
+        if mjd_range is not None:
+            where.append('mjd_end >= ? AND mjd_start <= ?')
+            args.extend([min(mjd_range), max(mjd_range)])
+        if obs_mode is not None:
+            where.append('obs_mode = ?')
+            args.append(obs_mode.upper())
+        if telescope is not None:
+            where.append('telescope LIKE ?')
+            args.append(telescope)
+        sql = 'SELECT path FROM files'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY mjd_start, path'
+        return [row[0] for row in self.db.execute(sql, args)]
+
+    def get_info(self, path):
+        """Return the indexed key values of a file as a dictionary, or None
+        if the file is not indexed."""
+        row = self._lookup(path)
+        if row is None:
+            return None
+        return dict(zip(_file_columns, row))
+
+    def get_headers(self, path):
+        """
+        Return the cached headers of a file as an OrderedDict of
+        fitsio.FITSHDR objects keyed by EXTNAME ('PRIMARY' for the first
+        HDU), in HDU order. Returns None if the file is not indexed or has
+        changed since it was scanned, in which case the headers should be
+        read from the file.
+        """
+        if not self.is_current(path):
+            return None
+        rows = self.db.execute('SELECT extname, header FROM hdus '
+                               'WHERE path=? ORDER BY hdu',
+                               (os.path.abspath(path),))
+        headers = collections.OrderedDict()
+        for extname, header in rows:
+            headers[extname] = F.FITSHDR(json.loads(header))
+        return headers
+
+    def get_layout(self, path):
+        """Return a list of (extname, data_start, nrows) for each HDU of an
+        indexed file."""
+        rows = self.db.execute('SELECT extname, data_start, nrows FROM hdus '
+                               'WHERE path=? ORDER BY hdu',
+                               (os.path.abspath(path),))
+        return [tuple(row) for row in rows]
+
+    def _lookup(self, path):
+        sql = 'SELECT {0} FROM files WHERE path=?'.format(
+            ', '.join(_file_columns))
+        return self.db.execute(sql, (os.path.abspath(path),)).fetchone()
+
+    def _store(self, info, hdus):
+        path = info['path']
+        self.remove(path)
+        self.db.execute('INSERT INTO files ({0}) VALUES ({1})'.format(
+            ', '.join(_file_columns), ', '.join('?'*len(_file_columns))),
+            [info.get(col) for col in _file_columns])
+        self.db.executemany('INSERT INTO hdus VALUES (?, ?, ?, ?, ?, ?)',
+                            [(path,) + tuple(hdu) for hdu in hdus])
+
+
+def _scan_file(path):
+    """
+    Read the headers and HDU layout of one file. Returns (info, hdus), where
+    info is a dictionary of the key values and hdus a list of
+    (hdu, extname, header_json, data_start, nrows), or an IOError naming the
+    file and the error if it could not be read.
+    """
+    try:
+        stat = os.stat(path)
+        info = {'path': path, 'mtime': stat.st_mtime, 'size': stat.st_size}
+        hdus = []
+        with F.FITS(path, 'r') as fits:
+            for ii, hdu in enumerate(fits):
+                hdr = hdu.read_header()
+                extname = 'PRIMARY' if ii == 0 else hdu.get_extname()
+                nrows = hdr.get('NAXIS2', 0) if ii > 0 else 0
+                hdus.append((ii, extname,
+                             json.dumps(hdr.records(), default=str),
+                             hdu.get_offsets()['data_start'], nrows))
+                if ii == 0:
+                    _primary_info(hdr, info)
+                elif extname == 'SUBINT':
+                    _subint_info(hdu, hdr, info)
+        return info, hdus
+    except Exception as err:
+        # Not type(err)(...): many exceptions need other arguments
+        return IOError('{0}: {1}'.format(path, err))
+
+
+def _primary_info(hdr, info):
+    """Fill in the key values taken from the PRIMARY header."""
+    def _str(key):
+        value = hdr.get(key, None)
+        return (value.strip() if isinstance(value, six.string_types)
+                else value)
+    info['src_name'] = _str('SRC_NAME')
+    info['obs_mode'] = _str('OBS_MODE')
+    info['telescope'] = _str('TELESCOP')
+    info['obsfreq'] = _float(hdr.get('OBSFREQ', None))
+    info['obsbw'] = _float(hdr.get('OBSBW', None))
+    if info['obsfreq'] is not None and info['obsbw'] is not None:
+        info['freq_lo'] = info['obsfreq'] - abs(info['obsbw'])/2
+        info['freq_hi'] = info['obsfreq'] + abs(info['obsbw'])/2
+    try:
+        info['mjd_start'] = (hdr['STT_IMJD']
+                             + (hdr['STT_SMJD'] + hdr['STT_OFFS'])/86400.)
+    except (KeyError, TypeError, ValueError):
+        info['mjd_start'] = None
+
+
+def _subint_info(hdu, hdr, info):
+    """Fill in the key values taken from the SUBINT table, including the
+    end MJD from the time offset of the last subint."""
+    for key in ['NCHAN', 'NPOL', 'NBITS', 'NSBLK']:
+        info[key.lower()] = hdr.get(key, None)
+    info['tbin'] = _float(hdr.get('TBIN', None))
+    info['nsubint'] = nrows = hdr.get('NAXIS2', 0)
+    info['mjd_end'] = info.get('mjd_start', None)
+    if nrows and info['mjd_end'] is not None:
+        try:
+            last = hdu.read(columns=['OFFS_SUB', 'TSUBINT'], rows=[nrows-1])
+            end = float(last['OFFS_SUB'][0] + last['TSUBINT'][0]/2.)
+            info['mjd_end'] = info['mjd_start'] + end/86400.
+        except (ValueError, KeyError, IOError):
+            pass
+
+
+def _float(value):
+    """Header value as a float, or None if it is not a number."""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+# encoding=utf8
+"""N-way concatenation of PSRFITS files."""
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+import os
+import threading
+import time
+
+import numpy as np
+import fitsio as F
+import six
+from six.moves import queue
+
+# How the BinTables other than SUBINT are merged, by default. 'first' keeps
+# the table of the first file, 'concat' concatenates the tables of all files
+# and 'dedupe' concatenates them and drops rows that are exact repeats.
+ancillary_policies = {'HISTORY': 'concat',
+                      'PSRPARAM': 'first',
+                      'POLYCO': 'dedupe'}
+
+# SUBINT header values that must match for files to be merged.
+subint_match_keys = ['NBIN', 'NCHAN', 'NPOL', 'NBITS', 'NSBLK', 'TBIN',
+                     'POL_TYPE']
+
+# Approximate size in bytes of each block of SUBINT rows copied.
+merge_chunk_bytes = 64 * 1024 * 1024
+
+
+def merge_psrfits(paths, out_path, ancillary=None, chunk_rows=None,
+                  threads=False, fix_offsets=True, clobber=False,
+                  verbose=True):
+    """
+    Concatenate the SUBINT tables of many PSRFITS files into a new file.
+
+    The headers of all the inputs are read first to check that they can be
+    merged and to work out the size of the output. The output SUBINT table is
+    then made once with its full header and sized for the total number of
+    rows in one step (with fitsio >= 1.0, which has `TableHDU.resize()`;
+    older versions grow it as the blocks are appended). It is the last HDU
+    in the file while its rows are copied over in large blocks, so no data
+    is shifted or written twice. BinTables that come after SUBINT are
+    written once it is full.
+
+    Parameters
+    ----------
+
+    paths : list of str
+        Input files, in the order their subints are to be written.
+
+    out_path : str
+        Path of the merged file.
+
+    ancillary : str or dict, optional
+        Policy for the BinTables other than SUBINT, one of 'first', 'concat'
+        or 'dedupe'. A single string is used for every table, a dictionary
+        maps table names to policies. Tables not given use
+        `ancillary_policies`, or 'first' if they are not in it.
+
+    chunk_rows : int, optional
+        Number of SUBINT rows copied at a time. Default is as many as fit in
+        `merge_chunk_bytes`.
+
+    threads : bool
+        Read ahead in a single separate reader thread, so the next block of
+        rows (possibly from the next file) is read while the current block
+        is written. Blocks are still read one at a time, in order.
+
+    fix_offsets : bool
+        Shift OFFS_SUB of each file so it is relative to the start time
+        (STT_IMJD, STT_SMJD, STT_OFFS) of the first file.
+
+    clobber : bool
+        Overwrite `out_path` if it exists.
+
+    verbose : bool
+        Print a summary of the merge.
+
+    Returns
+    -------
+    Dictionary with the number of SUBINT 'rows' written, and the 'bytes',
+        'seconds' and throughput in 'MB/s'.
+    """
+    if isinstance(paths, six.string_types):
+        paths = [paths]
+    if os.path.exists(out_path):
+        if not clobber:
+            raise ValueError('{0} already exists. Set clobber=True to '
+                             'overwrite it.'.format(out_path))
+        os.remove(out_path)
+
+    start = time.time()
+    scan = _prescan(paths)
+    policies = _ancillary_policies(scan['extnames'], ancillary)
+    offsets = _offs_sub_shifts(scan['primary']) if fix_offsets else None
+    if chunk_rows is None:
+        chunk_rows = max(1, merge_chunk_bytes // scan['row_bytes'])
+
+    with F.FITS(out_path, 'rw') as out:
+        out.write(None, header=scan['primary'][0])
+        subint_done = False
+        for extname in scan['extnames']:
+            if extname == 'SUBINT':
+                hdr = scan['headers'][0]['SUBINT']
+                out.create_table_hdu(dtype=scan['dtypes'][0]['SUBINT'],
+                                     header=hdr, extname='SUBINT')
+                out[-1].write_keys(hdr)
+                blocks = _iter_subint_blocks(paths, scan['nrows'], chunk_rows,
+                                             offsets)
+                if threads:
+                    blocks = _prefetch(blocks)
+                preallocated = hasattr(out[-1], 'resize')
+                if preallocated:
+                    # Allocate every row at once, then fill them in
+                    out[-1].resize(sum(scan['nrows']))
+                try:
+                    row = 0
+                    for block in blocks:
+                        if preallocated:
+                            out[-1].write(block, firstrow=row)
+                        else:
+                            out[-1].append(block)
+                        row += len(block)
+                finally:
+                    # Stops the reader thread and closes the input files
+                    blocks.close()
+                subint_done = True
+            elif not subint_done:
+                _write_ancillary(out, paths, extname, policies[extname],
+                                 scan['headers'][0][extname])
+        for extname in scan['extnames'][scan['extnames'].index('SUBINT')+1:]:
+            _write_ancillary(out, paths, extname, policies[extname],
+                             scan['headers'][0][extname])
+
+    nrows = sum(scan['nrows'])
+    stats = {'rows': nrows, 'bytes': nrows * scan['row_bytes'],
+             'seconds': time.time() - start}
+    stats['MB/s'] = (stats['bytes'] / 1e6 / stats['seconds']
+                     if stats['seconds'] > 0 else float('inf'))
+    if verbose:
+        print('Merged {0} rows ({1:.1f} MB) from {2} files into \'{3}\' in '
+              '{4:.2f} s ({5:.1f} MB/s).'.format(nrows, stats['bytes']/1e6,
+                                                 len(paths), out_path,
+                                                 stats['seconds'],
+                                                 stats['MB/s']))
+    return stats
+
+
+def _prescan(paths):
+    """
+    Read the headers of every input and check they can be merged. Returns a
+    dictionary with the PRIMARY headers, BinTable headers and dtypes of each
+    file, the HDU names, SUBINT row counts and SUBINT row size in bytes.
+    """
+    scan = {'primary': [], 'headers': [], 'dtypes': [], 'nrows': []}
+    for path in paths:
+        with F.FITS(path, 'r') as fits:
+            extnames = [fits[ii].get_extname()
+                        for ii in range(1, len(fits))]
+            scan['primary'].append(fits[0].read_header())
+            scan['headers'].append(dict((ext, fits[ext].read_header())
+                                        for ext in extnames))
+            scan['dtypes'].append(dict((ext, fits[ext].get_rec_dtype()[0])
+                                       for ext in extnames))
+        if 'SUBINT' not in extnames:
+            raise ValueError('{0} has no SUBINT table.'.format(path))
+        if 'extnames' not in scan:
+            scan['extnames'] = extnames
+        elif extnames != scan['extnames']:
+            raise ValueError('{0} has BinTables {1}, but {2} has {3}.'.format(
+                path, extnames, paths[0], scan['extnames']))
+        scan['nrows'].append(scan['headers'][-1]['SUBINT']['NAXIS2'])
+
+        first = scan['headers'][0]['SUBINT']
+        this = scan['headers'][-1]['SUBINT']
+        for key in subint_match_keys:
+            if first.get(key, None) != this.get(key, None):
+                raise ValueError('SUBINT {0} of {1} ({2}) does not match {3} '
+                                 '({4}).'.format(key, path, this.get(key),
+                                                 paths[0], first.get(key)))
+        if scan['dtypes'][-1]['SUBINT'] != scan['dtypes'][0]['SUBINT']:
+            raise ValueError('The SUBINT columns of {0} do not match those '
+                             'of {1}.'.format(path, paths[0]))
+    scan['row_bytes'] = scan['headers'][0]['SUBINT']['NAXIS1']
+    return scan
+
+
+def _ancillary_policies(extnames, ancillary):
+    """Policy to use for each BinTable other than SUBINT."""
+    policies = {}
+    for extname in extnames:
+        if extname == 'SUBINT':
+            continue
+        if isinstance(ancillary, six.string_types):
+            policy = ancillary
+        elif ancillary is not None and extname in ancillary:
+            policy = ancillary[extname]
+        else:
+            policy = ancillary_policies.get(extname, 'first')
+        if policy not in ['first', 'concat', 'dedupe']:
+            raise ValueError('Unknown policy \'{0}\' for {1}. Use \'first\', '
+                             '\'concat\' or \'dedupe\'.'.format(policy,
+                                                                 extname))
+        policies[extname] = policy
+    return policies
+
+
+def _offs_sub_shifts(primary_hdrs):
+    """
+    Seconds to add to OFFS_SUB of each file so that it is relative to the
+    start of the first file, or None if the start times are not set.
+    """
+    try:
+        imjd = [int(hdr['STT_IMJD']) for hdr in primary_hdrs]
+        secs = [float(hdr['STT_SMJD']) + float(hdr['STT_OFFS'])
+                for hdr in primary_hdrs]
+    except (KeyError, TypeError, ValueError):
+        return None
+    return [(imjd[ii] - imjd[0]) * 86400. + (secs[ii] - secs[0])
+            for ii in range(len(primary_hdrs))]
+
+
+def _iter_subint_blocks(paths, nrows, chunk_rows, offsets=None):
+    """Yield blocks of at most chunk_rows SUBINT rows from each file in
+    turn."""
+    for ii, path in enumerate(paths):
+        with F.FITS(path, 'r') as fits:
+            hdu = fits['SUBINT']
+            for row in range(0, nrows[ii], chunk_rows):
+                block = hdu[row:min(row+chunk_rows, nrows[ii])]
+                if offsets is not None and offsets[ii] != 0:
+                    block['OFFS_SUB'] += offsets[ii]
+                yield block
+
+
+def _prefetch(blocks, depth=2, timeout=0.1):
+    """
+    Run a block generator in a separate thread, keeping up to `depth` blocks
+    read ahead of the consumer. If the consumer stops early, or raises, the
+    reader thread stops at its next block (it waits at most `timeout`
+    seconds at a time for room in the queue) and closes the generator, and
+    with it any file the generator has open.
+    """
+    buf = queue.Queue(maxsize=depth)
+    done = object()
+    stop = threading.Event()
+
+    def _put(item):
+        """Queue item, unless the consumer has stopped. Returns False if it
+        has."""
+        while not stop.is_set():
+            try:
+                buf.put(item, timeout=timeout)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _reader():
+        try:
+            for block in blocks:
+                if not _put(block):
+                    break
+            else:
+                _put(done)
+        except Exception as err:
+            _put(err)
+        finally:
+            blocks.close()
+
+    thread = threading.Thread(target=_reader)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            block = buf.get()
+            if block is done:
+                break
+            if isinstance(block, Exception):
+                raise block
+            yield block
+    finally:
+        stop.set()
+        thread.join()
+
+
+def _write_ancillary(out, paths, extname, policy, header):
+    """Write a BinTable other than SUBINT using the given policy."""
+    if policy == 'first':
+        rows = F.read(paths[0], ext=extname)
+    else:
+        tables = [F.read(path, ext=extname) for path in paths]
+        if any(table.dtype != tables[0].dtype for table in tables):
+            raise ValueError('The {0} columns of the files do not match, '
+                             'can not use policy \'{1}\'.'.format(extname,
+                                                                  policy))
+        rows = np.concatenate(tables)
+        if policy == 'dedupe':
+            rows = dedupe_rows(rows)
+    out.write_table(rows, extname=extname, header=header)
+
+
+def dedupe_rows(rows):
+    """Return the rows of a recarray with exact repeats removed, keeping the
+    first occurrence of each row in its original order."""
+    rows = np.ascontiguousarray(rows)
+    as_bytes = rows.view(np.dtype((np.void, rows.dtype.itemsize)))
+    _, first = np.unique(as_bytes, return_index=True)
+    return rows[np.sort(first)]
@@ -9,16 +9,28 @@ import numpy as np
 import fitsio as F
 import collections, os, sys
 import datetime
+import threading
+import time
 import warnings
 import six
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+from .pypsrfits import (table_memmap, can_memmap_table,
+                        quantize_search_block, pack_samples)
 
 package_path = os.path.dirname(__file__)
 template_dir = os.path.join(package_path, './templates/')
 
 class psrfits(F.FITS):
 
+    # Approximate size in bytes of each block of rows copied by
+    # append_from_file
+    append_chunk_bytes = 64 * 1024 * 1024
+
     def __init__(self, psrfits_path, mode='rw', from_template=False,
-                 obs_mode=None, verbose=True):
+                 obs_mode=None, verbose=True, index=None, cache=True):
         """
         Class which inherits fitsio.FITS() (Python wrapper for cfitsio) class's
         functionality, and add's new functionality to easily manipulate and make
@@ -41,10 +53,23 @@ class psrfits(F.FITS):
         mode : str, {'r', 'rw, 'READONLY' or 'READWRITE'}
             Read/Write mode.
 
+        index : pdat.PSRFITSIndex, optional
+            Index of header metadata. If the file (or template) is indexed
+            and unchanged the cached headers are used instead of reading
+            every header from disk.
+
+        cache : bool
+            Use the process-wide `template_cache` for the template's headers,
+            dtypes and tables, so templates used many times are only parsed
+            once. Each instance gets its own copy-on-write draft headers.
+
         """
         self.verbose = verbose
         self.psrfits_path = psrfits_path
         self.obs_mode = obs_mode
+        self.template_path = None
+        self.template = None
+        self._fits_template = None
 
         dir_path = os.path.dirname(os.path.realpath(__file__))
         if os.path.exists(psrfits_path) and not from_template and verbose:
@@ -74,25 +99,27 @@ class psrfits(F.FITS):
                                  'it is initialized in write-only mode!')
 
             self.written = False
-            self.fits_template = F.FITS(template_path, mode='r')
-            if self.obs_mode is None:
-                OBS = self.fits_template[0].read_header()['OBS_MODE'].strip()
-                self.obs_mode = OBS
-            else:
-                self.obs_mode = obs_mode
-
+            self.template_path = template_path
             self.draft_hdrs = collections.OrderedDict()
             self.HDU_drafts = {}
             self.subint_dtype = None
 
-            #Set the ImageHDU to be called primary.
-            self.draft_hdrs['PRIMARY'] = self.fits_template[0].read_header()
-            self.n_hdrs = len(self.fits_template.hdu_list)
+            if cache:
+                self.template = template_cache.get(template_path, index=index)
+                template_hdrs = self.template.headers
+            else:
+                template_hdrs = read_draft_headers(template_path, index=index)
+            for hdr_key, hdr in template_hdrs.items():
+                self.draft_hdrs[hdr_key] = hdr.copy()
+                if hdr_key != 'PRIMARY':
+                    self.HDU_drafts[hdr_key] = None
+            self.n_hdrs = len(self.draft_hdrs)
 
-            for ii in np.arange(1,self.n_hdrs):
-                hdr_key = self.fits_template[ii].get_extname()
-                self.draft_hdrs[hdr_key] = self.fits_template[ii].read_header()
-                self.HDU_drafts[hdr_key] = None
+            if self.obs_mode is None:
+                OBS = self.draft_hdrs['PRIMARY']['OBS_MODE'].strip()
+                self.obs_mode = OBS
+            else:
+                self.obs_mode = obs_mode
             self.draft_hdr_keys = list(self.draft_hdrs.keys())
 
             if verbose:
@@ -111,10 +138,12 @@ class psrfits(F.FITS):
                 raise TypeError(err_msg)
         else:
             super().__init__(psrfits_path, mode = mode)
+        #fitsio.FITS sets its own verbose attribute.
+        self.verbose = verbose
 
         #If self.obs_mode is still None use loaded PSRFITS file
         if self.obs_mode is None and from_template:
-            OBS = self.fits_template[0].read_header()['OBS_MODE'].strip()
+            OBS = self.draft_hdrs['PRIMARY']['OBS_MODE'].strip()
             self.obs_mode = OBS
 
         if from_template and verbose:
@@ -124,16 +153,99 @@ class psrfits(F.FITS):
         elif not from_template and (mode=='rw' or mode=='READWRITE'):
             self.draft_hdrs = collections.OrderedDict()
             self.HDU_drafts = {}
-            #Set the ImageHDU to be called primary.
-            self.draft_hdrs['PRIMARY'] = self[0].read_header()
-            self.n_hdrs = len(self.hdu_list)
             self.written = False
-            for ii in range(self.n_hdrs-1):
-                hdr_key = self[ii+1].get_extname()
-                self.draft_hdrs[hdr_key] = self[ii+1].read_header()
-                self.HDU_drafts[hdr_key] = None
+            cached_hdrs = None
+            if index is not None:
+                cached_hdrs = index.get_headers(psrfits_path)
+            if cached_hdrs is not None:
+                for hdr_key, hdr in cached_hdrs.items():
+                    self.draft_hdrs[hdr_key] = DraftHeader(hdr)
+                self.n_hdrs = len(cached_hdrs)
+                for hdr_key in list(cached_hdrs.keys())[1:]:
+                    self.HDU_drafts[hdr_key] = None
+            else:
+                #Headers are only read when they are first used.
+                self.update_hdu_list()
+                self.n_hdrs = len(self.hdu_list)
+                #Set the ImageHDU to be called primary.
+                hdr_keys = ['PRIMARY']
+                for ii in range(self.n_hdrs-1):
+                    hdr_key = self[ii+1].get_extname()
+                    hdr_keys.append(hdr_key)
+                    self.HDU_drafts[hdr_key] = None
+                self.draft_hdrs = LazyHeaderDict(hdr_keys,
+                                                 self._read_draft_header)
             self.draft_hdr_keys = list(self.draft_hdrs.keys())
 
+    def _read_draft_header(self, hdr_key):
+        """Reads the header of an HDU of this file as a DraftHeader."""
+        hdu = self[0] if hdr_key == 'PRIMARY' else self[hdr_key]
+        return DraftHeader(hdu.read_header())
+
+
+    @property
+    def fits_template(self):
+        """The template PSRFITS file (a fitsio.FITS object), which is only
+        opened when it is first used."""
+        if self._fits_template is None and self.template_path is not None:
+            self._fits_template = F.FITS(self.template_path, mode='r')
+        return self._fits_template
+
+    @fits_template.setter
+    def fits_template(self, fits):
+        self._fits_template = fits
+
+    def get_template_dtypes(self, ext_name):
+        """
+        Returns the list of data types and array sizes (see
+        `get_HDU_dtypes()`) of a BinTable of the template, from the template
+        cache if it is being used.
+        """
+        if self.template is not None:
+            return list(self.template.dtypes[ext_name])
+        return self.get_HDU_dtypes(self.fits_template[ext_name])
+
+    def read_template_table(self, ext_name, cols='all', rows=None):
+        """
+        Returns the rows of a BinTable of the template as a numpy.recarray,
+        from the template cache if it is being used. A cached table is
+        shared, so it should not be edited in place.
+
+        Parameters
+        ----------
+
+        ext_name : str
+            BinTable to read.
+
+        cols : str or list
+            Columns to read. The template cache may return every column.
+
+        rows : array_like, optional
+            Row numbers to read. Default is every row.
+        """
+        if self.template is not None:
+            return self.template.read_table(ext_name, cols, rows=rows)
+        columns = None if cols == 'all' else cols
+        return self.fits_template[ext_name].read(columns=columns, rows=rows)
+
+    def template_table_view(self, ext_name, whole=True):
+        """
+        Returns the rows of a BinTable of the template without reading them
+        into memory: the table held by the template cache if there is one,
+        otherwise a read-only numpy.memmap of the table in the template file.
+        Set `whole` to False if only some rows will be used, so the template
+        cache does not read and keep the whole table. Returns None if the
+        table can not be memory mapped (it has scaled, logical, bit or
+        variable length columns).
+        """
+        if self.template is not None:
+            return self.template.view_table(ext_name, whole=whole)
+        hdu = self.fits_template[ext_name]
+        hdr = hdu.read_header()
+        if not can_memmap_table(hdr):
+            return None
+        return table_memmap(self.template_path, hdr,
+                            hdu.get_offsets()['data_start'])
 
     def write_psrfits(self, HDUs=None, hdr_from_draft=True):
         """
@@ -158,12 +270,168 @@ class psrfits(F.FITS):
         if any([val is None for val in HDUs.values()]):
             raise ValueError('One of HDU drafts is \"None\".')
 
-        self.write_PrimaryHDU_info_dict(self.fits_template[0],self[0])
-        self.set_hdr_from_draft('PRIMARY')
+        self.write_primary_from_draft()
         for hdr in self.draft_hdr_keys[1:]:
-            self.write_table(HDUs[hdr],extname=hdr, extver=1)
-                             # header = self.draft_hdrs[hdr])
-            if hdr_from_draft: self.set_hdr_from_draft(hdr)
+            self.write_bintable_from_draft(hdr, HDUs[hdr], hdr_from_draft)
+        self.written = True
+
+    def write_bintable_from_draft(self, ext_name, table, hdr_from_draft=True):
+        """
+        Writes a BinTable HDU so that its header never has to grow after the
+            data is written. The HDU is made with room for every card of the
+            draft header and the non-structural cards are written before the
+            data. The structural cards (TFORM, TDIM, NAXIS2, etc.) are then
+            set from the draft in place, so cfitsio never has to shift the
+            table data to make room for more header blocks.
+
+        Parameters
+        ----------
+
+        ext_name : str
+            Name of the BinTable, and of its draft header.
+
+        table : numpy.recarray
+            Rows of the BinTable.
+
+        hdr_from_draft : bool
+            Set the header from the draft header. If False only the header
+            made by fitsio from the recarray is written.
+        """
+        if hdr_from_draft:
+            draft = self.draft_hdrs[ext_name]
+            if draft.get('NAXIS2', len(table)) != len(table):
+                draft.set_value('NAXIS2', len(table))
+            #write_table() cleans the header it is given, so pass a copy.
+            header = DraftHeader(draft)
+        else:
+            header = None
+        self.write_table(table, extname=ext_name, extver=1, header=header)
+        if hdr_from_draft: self.set_hdr_from_draft(ext_name)
+
+    def write_primary_from_draft(self):
+        """
+        Writes the PRIMARY HDU using the template's info dictionary and the
+        draft PRIMARY header. An empty primary array is made first if nothing
+        has been written to the file yet.
+        """
+        self.update_hdu_list()
+        if len(self.hdu_list) == 0:
+            self.write(None)
+        if self.template is not None:
+            self.write_PrimaryHDU_info_dict(self.template.primary_info,self[0])
+        else:
+            self.write_PrimaryHDU_info_dict(self.fits_template[0],self[0])
+        self.set_hdr_from_draft('PRIMARY')
+
+    def begin_subint_stream(self, HDUs=None, hdr_from_draft=True):
+        """
+        Start writing a PSRFITS file whose SUBINT rows are streamed in chunks,
+            so the whole SUBINT table never has to be held in memory.
+        The PRIMARY HDU and any BinTables that come before SUBINT are written
+            from the drafts, then an empty SUBINT table is made with the
+            dtype set by `set_subint_dims()` (or the template's dtype) and
+            the draft header. Rows are then added with
+            `append_subint_array()` and the file is finished with
+            `end_subint_stream()`, which sets NAXIS2 and writes the BinTables
+            that come after SUBINT.
+
+        Parameters
+        ----------
+
+        HDUs : dict, optional
+            Dictionary of recarrays for the BinTables other than SUBINT.
+            Default is set to HDU_drafts. Only the tables before SUBINT are
+            needed at this point.
+
+        hdr_from_draft : bool
+            Set the BinTable headers from the draft headers.
+        """
+        if self.written:
+            raise ValueError('PSRFITS file has already been written. '
+                             'Can not write twice.')
+        if getattr(self, 'streaming', False):
+            raise ValueError('SUBINT stream has already been started.')
+        if HDUs is None:
+            HDUs = self.HDU_drafts
+
+        self.subint_idx = self.draft_hdr_keys.index('SUBINT')
+        before = self.draft_hdr_keys[1:self.subint_idx]
+        if any([HDUs.get(hdr) is None for hdr in before]):
+            raise ValueError('One of HDU drafts is \"None\".')
+
+        self.write_primary_from_draft()
+        for hdr in before:
+            self.write_bintable_from_draft(hdr, HDUs[hdr], hdr_from_draft)
+
+        if self.subint_dtype is None:
+            self.subint_dtype = self.get_template_dtypes('SUBINT')
+        self.create_table_hdu(dtype=self.subint_dtype, extname='SUBINT',
+                              extver=1)
+        #NAXIS2 is set by end_subint_stream(). Writing it now would make the
+        #empty table look full and rows would be appended after it.
+        self.set_hdr_from_draft('SUBINT', skip=['NAXIS2'])
+        self[self.subint_idx]._update_info()
+
+        self.hdr_from_draft = hdr_from_draft
+        self.streaming = True
+        self.nrows_streamed = 0
+
+    def append_subint_array(self, table):
+        """
+        Append subintegrations to the SUBINT table of a file being written
+            with `begin_subint_stream()`. Only this chunk is held in memory.
+
+        Parameters
+        ----------
+
+        table : numpy.recarray
+            Rows to append. The array must match the columns (in the
+            numpy.recarray sense) of the SUBINT dtype, e.g. a recarray made
+            with `make_HDU_rec_array(nrows, self.subint_dtype)`.
+
+        Returns
+        -------
+        Total number of rows written so far.
+        """
+        if not getattr(self, 'streaming', False):
+            raise ValueError('No SUBINT stream to append to. '
+                             'Call begin_subint_stream() first.')
+        names = [dt[0] for dt in self.subint_dtype]
+        if list(table.dtype.names) != names:
+            err_msg = 'Columns to append ({0}) '.format(table.dtype.names)
+            err_msg += 'do not match the SUBINT columns ({0}).'.format(names)
+            raise ValueError(err_msg)
+        hdu = self[self.subint_idx]
+        hdu.append(_reshape_columns(table, hdu.get_rec_dtype()[0]))
+        self.nrows_streamed += len(table)
+        return self.nrows_streamed
+
+    def end_subint_stream(self, HDUs=None):
+        """
+        Finish a file started with `begin_subint_stream()`. Sets NAXIS2 of
+            the SUBINT table (and its draft header) to the number of rows
+            written, then writes the BinTables that come after SUBINT.
+
+        Parameters
+        ----------
+
+        HDUs : dict, optional
+            Dictionary of recarrays for the BinTables after SUBINT. Default is
+            set to HDU_drafts.
+        """
+        if not getattr(self, 'streaming', False):
+            raise ValueError('No SUBINT stream to finish.')
+        if HDUs is None:
+            HDUs = self.HDU_drafts
+        after = self.draft_hdr_keys[self.subint_idx+1:]
+        if any([HDUs.get(hdr) is None for hdr in after]):
+            raise ValueError('One of HDU drafts is \"None\".')
+
+        self.draft_hdrs['SUBINT']['NAXIS2'] = self.nrows_streamed
+        self[self.subint_idx].write_key('NAXIS2', self.nrows_streamed)
+        for hdr in after:
+            self.write_bintable_from_draft(hdr, HDUs[hdr], self.hdr_from_draft)
+        self.streaming = False
         self.written = True
 
     # def write_psrfits_from_draft?(self):
@@ -177,16 +445,7 @@ class psrfits(F.FITS):
     #         self.write_table(rec_array)
     #         self.set_hdr_from_draft(hdr)
 
-    # def append_subint_array(self,table):
-    #     """
-    #     Method to append more subintegrations to a PSRFITS file from Python
-    #      arrays.
-    #     The array must match the columns (in the numpy.recarray sense)
-    #      of the existing PSRFITS file.
-    #     """
-    #     fits_to_append = F.FITS(table)
-
-    def append_from_file(self,path,table='all'):
+    def append_from_file(self, path, table='all', chunk_rows=None):
         """
         Method to append more subintegrations to a PSRFITS file from other
         PSRFITS files.
@@ -194,23 +453,84 @@ class psrfits(F.FITS):
             before copying if you are unsure about appending. The array must
             match the columns (in the numpy.recarray sense) of the existing
             PSRFITS file.
+        Rows are copied in blocks of `chunk_rows`, so only one block is held
+            in memory at a time. All of the files are checked before anything
+            is appended.
 
         Parameters
         ----------
 
-        path : str
-            Path to the new PSRFITS file to be appended.
+        path : str or list of str
+            Path(s) to the PSRFITS file(s) to be appended, in order.
 
         table : list
             List of BinTable HDU headers to append from file. Defaults to
                 appending all secondary BinTables.
                 ['HISTORY','PSRPARAM','POLYCO','SUBINT']
+
+        chunk_rows : int, optional
+            Number of rows read and appended at a time. Default is as many
+            rows as fit in `append_chunk_bytes`.
+
+        Returns
+        -------
+        Dictionary with the number of rows appended to each table, and the
+            total 'bytes', 'seconds' and throughput in 'MB/s'.
+        """
+        if isinstance(path, six.string_types):
+            path = [path]
+        PF2As = [F.FITS(pth, mode='r') for pth in path]
+        try:
+            tables = [self._check_append_file(pth, PF2A, table)
+                      for pth, PF2A in zip(path, PF2As)]
+
+            stats = collections.OrderedDict((hdr, 0) for hdr
+                                            in self.draft_hdr_keys[1:])
+            nbytes = 0
+            start = time.time()
+            for pth, PF2A, hdrs in zip(path, PF2As, tables):
+                file_start = time.time()
+                file_bytes = 0
+                for hdr in hdrs:
+                    nrows = PF2A[hdr].get_nrows()
+                    row_bytes = PF2A[hdr].read_header()['NAXIS1']
+                    if chunk_rows is None:
+                        step = max(1, self.append_chunk_bytes // row_bytes)
+                    else:
+                        step = int(chunk_rows)
+                    for row in range(0, nrows, step):
+                        rec_array = PF2A[hdr][row:min(row+step, nrows)]
+                        self[hdr].append(rec_array)
+                    stats[hdr] += nrows
+                    file_bytes += nrows * row_bytes
+                nbytes += file_bytes
+                if self.verbose:
+                    secs = time.time() - file_start
+                    print('Appended {0:.1f} MB from \'{1}\' in {2:.2f} s '
+                          '({3:.1f} MB/s).'.format(file_bytes/1e6, pth, secs,
+                                                   _rate(file_bytes, secs)))
+        finally:
+            for PF2A in PF2As:
+                PF2A.close()
+
+        stats['bytes'] = nbytes
+        stats['seconds'] = time.time() - start
+        stats['MB/s'] = _rate(nbytes, stats['seconds'])
+        if self.verbose and len(path) > 1:
+            print('Appended {0:.1f} MB from {1} files in {2:.2f} s '
+                  '({3:.1f} MB/s).'.format(nbytes/1e6, len(path),
+                                           stats['seconds'], stats['MB/s']))
+        return stats
+
+    def _check_append_file(self, path, PF2A, table='all'):
+        """
+        Check that a file can be appended with `append_from_file()` and return
+        the names of the BinTables to append from it.
         """
-        PF2A = F.FITS(path, mode='r')
         PF2A_hdrs = []
         PF2A_hdrs.append('PRIMARY')
-        for ii in range(self.n_hdrs-1):
-            hdr_key = PF2A[ii+1].get_extname()
+        for ii in range(1, len(PF2A)):
+            hdr_key = PF2A[ii].get_extname()
             PF2A_hdrs.append(hdr_key)
         if table=='all':
             if PF2A_hdrs!= self.draft_hdr_keys:
@@ -220,17 +540,69 @@ class psrfits(F.FITS):
                     raise ValueError(err_msg)
                 else:
                     err_msg = 'Original PSRFITS HDUs'
-                    err_msg = ' ({0}) and PSRFITS'.format(self.draft_hdr_keys)
-                    err_msg = ' to append ({1})'.format(PF2A_hdrs)
-                    err_msg = ' have different BinTables or they are in'
-                    err_msg = ' different orders. \nEnter a table list matching'
-                    err_msg = ' the order of the orginal PSRFITS file.'
+                    err_msg += ' ({0}) and PSRFITS'.format(self.draft_hdr_keys)
+                    err_msg += ' to append ({0})'.format(PF2A_hdrs)
+                    err_msg += ' have different BinTables or they are in'
+                    err_msg += ' different orders. \nEnter a table list'
+                    err_msg += ' matching the order of the orginal PSRFITS'
+                    err_msg += ' file.'
                     raise ValueError(err_msg)
-            else:
-                table=PF2A_hdrs
-        for hdr in self.draft_hdr_keys[1:]:
-            rec_array = PF2A[list_arg(table,hdr)].read()
-            self[list_arg(self.draft_hdr_keys,hdr)].append(rec_array)
+            table = PF2A_hdrs[1:]
+        table = [hdr.upper() for hdr in table if hdr.upper() != 'PRIMARY']
+
+        for hdr in table:
+            if hdr not in PF2A_hdrs or hdr not in self.draft_hdr_keys:
+                err_msg = 'BinTable {0} is not in both '.format(hdr)
+                err_msg += '{0} and {1}.'.format(self.psrfits_path, path)
+                raise ValueError(err_msg)
+            if (self.get_HDU_dtypes(PF2A[hdr])
+                    != self.get_HDU_dtypes(self[hdr])):
+                err_msg = 'The {0} columns of {1} do not '.format(hdr, path)
+                err_msg += 'match those of {0}.'.format(self.psrfits_path)
+                raise ValueError(err_msg)
+        return table
+
+    def memmap_columns(self, ext_name='SUBINT',
+                       columns=('DATA','DAT_SCL','DAT_OFFS','DAT_WTS'),
+                       mode='r'):
+        """
+        Memory-mapped views of the columns of a BinTable. FITS binary tables
+        are fixed-width rows at a known byte offset, so each column is
+        exposed as a strided numpy.memmap view, with the row index first and
+        the big-endian dtype used on disk. Nothing is read until the views
+        are used, so random access to single rows or channels does not copy
+        the rest of the table.
+
+        Parameters
+        ----------
+
+        ext_name : str
+            Name of the BinTable HDU to map.
+
+        columns : list of str
+            Columns to return views of.
+
+        mode : str, {'r', 'r+'}
+            Map read-only ('r') or allow editing the file in place ('r+').
+            The file is flushed before it is mapped.
+
+        Returns
+        -------
+        dict of numpy.memmap views, keyed by column name. Raises a
+        ValueError for tables that can not be mapped (see
+        `pypsrfits.can_memmap_table()`).
+        """
+        self.reopen()
+        hdu = self[ext_name]
+        hdr = hdu.read_header()
+        if not can_memmap_table(hdr):
+            err_msg = 'The {0} table has scaled, logical, '.format(ext_name)
+            err_msg += 'bit or variable length columns, which can not be '
+            err_msg += 'memory mapped.'
+            raise ValueError(err_msg)
+        mm = table_memmap(self._filename, hdr,
+                          hdu.get_offsets()['data_start'], mode=mode)
+        return dict((col, mm[col]) for col in columns)
 
 #######Convenience Functions################
     def get_colnames():
@@ -238,9 +610,9 @@ class psrfits(F.FITS):
         file."""
         return self[1].get_colnames()
 
-    def set_hdr_from_draft(self, hdr):
+    def set_hdr_from_draft(self, hdr, skip=None):
         """Sets a header of the PSRFITS file using the draft header derived from
-        template."""
+        template. Any keys in the list `skip` are left as they are."""
         keys = self.draft_hdr_keys
         if isinstance(hdr,int):
             hdr_name = keys[hdr]
@@ -251,7 +623,11 @@ class psrfits(F.FITS):
         #     warnings.simplefilter("ignore")
         for card in self.draft_hdrs[hdr_name].records():
             card = convert2asciii(card)
-        self[hdr].write_keys(self.draft_hdrs[hdr_name],clean=False)
+        draft = self.draft_hdrs[hdr_name]
+        if skip:
+            draft = F.FITSHDR([card for card in draft.records()
+                               if card['name'] not in skip])
+        self[hdr].write_keys(draft,clean=False)
         #Must set clean to False or the first keys are deleted!
 
     def get_FITS_card_dict(self, hdr, name):
@@ -271,8 +647,13 @@ class psrfits(F.FITS):
         name : str
             The name key in the FITS record you wish to make.
         """
-        card = next((item for item in hdr.records()
-                    if item['name'] == name.upper()), False)
+        if isinstance(hdr, DraftHeader):
+            #Copy, as make_FITS_card may edit the card it is given.
+            card = hdr.card(name)
+            card = dict(card) if card else card
+        else:
+            card = next((item for item in hdr.records()
+                        if item['name'] == name.upper()), False)
         if not card:
             err_msg = 'A FITS card named '
             err_msg += '{0} does not exist in this HDU.'.format(name)
@@ -441,11 +822,14 @@ class psrfits(F.FITS):
         # except AttributeError:
         #
         #     new_record = self.make_FITS_card(hdr,name,new_value)
-        if not isinstance(hdr,F.fitslib.FITSHDR):
+        if not isinstance(hdr,F.FITSHDR):
             hdr = self.draft_hdrs[hdr]
              #Maybe faster if try: except: used?
-        new_record = self.make_FITS_card(hdr,name,new_value)
-        hdr.add_record(new_record)
+        if isinstance(hdr, DraftHeader):
+            hdr.set_value(name, new_value)
+        else:
+            new_record = self.make_FITS_card(hdr,name,new_value)
+            hdr.add_record(new_record)
 
     def get_HDU_dtypes(self, HDU):
         """
@@ -510,23 +894,26 @@ class psrfits(F.FITS):
         Parameters
         ----------
         ImHDU_template :
-            Template header.
+            Template header, or its info dictionary.
 
         new_ImHDU :
             Header where template is copied.
         """
-        templ_info_keys = list(ImHDU_template.__dict__['_info'].keys())
-        new_info_keys = list(new_ImHDU.__dict__['_info'].keys())
+        templ_info = getattr(ImHDU_template, '_info', ImHDU_template)
+        new_info = new_ImHDU._info
+        templ_info_keys = list(templ_info.keys())
+        new_info_keys = list(new_info.keys())
         info_keys = np.unique(np.concatenate((templ_info_keys,new_info_keys)))
 
         for key in info_keys:
             if key in templ_info_keys:
-                new_ImHDU.__dict__['_info'][key] = ImHDU_template.__dict__['_info'][key]
+                new_info[key] = templ_info[key]
             elif key not in templ_info_keys:
-                new_ImHDU.__dict__['_info'].__delitem__(key)
+                new_info.__delitem__(key)
 
     def set_subint_dims(self, nbin=1, nchan=2048, npol=4, nsblk=4096,
-                        nsubint=4, obs_mode=None, data_dtype='|u1'):
+                        nsubint=4, obs_mode=None, data_dtype=None,
+                        nbits=None):
         """
         Method to set the appropriate parameters for the SUBINT BinTable of
             a PSRFITS file of the given dimensions.
@@ -561,12 +948,39 @@ class psrfits(F.FITS):
         obs_mode : str , {'SEARCH', 'PSR', 'CAL'}
             Observation mode.
 
-        data_type : str
-            Data type of the DATA array ('|u1'=int8 or '|u2'=int16).
+        data_dtype : str, optional
+            Data type of the samples, a 1 or 2-byte integer type ('|u1'=int8
+            or '>i2'=int16, default '|u1'). Other types raise a ValueError.
+            8-bit samples are written as TFORM 'B' columns and 16-bit
+            samples as big-endian TFORM 'I' (2-byte integer) columns.
+
+        nbits : int, {1, 2, 4, 8, 16}, optional
+            NBITS, bits per sample of SEARCH mode data. Defaults to the size
+            of data_dtype, which must match it if both are given. 1, 2 and
+            4-bit samples are packed into bytes (see
+            `pypsrfits.pack_samples()`), so the DATA column and the channel
+            axis of TDIM17 hold NCHAN*NBITS/8 bytes.
         """
         self.nrows = self.nsubint = nsubint
         #Make a dtype list with defined dimensions and data type
-        self._bytes_per_datum = np.dtype(data_dtype).itemsize
+        if data_dtype is not None:
+            data_dtype = np.dtype(data_dtype)
+            if data_dtype.kind not in 'iu' or data_dtype.itemsize > 2:
+                err_msg = 'data_dtype (set to '
+                err_msg += '{0}) must be a 1 or '.format(data_dtype)
+                err_msg += '2-byte integer type.'
+                raise ValueError(err_msg)
+        if nbits is None:
+            self._bytes_per_datum = (1 if data_dtype is None
+                                     else data_dtype.itemsize)
+        else:
+            self._bytes_per_datum = 2 if nbits == 16 else 1
+            if (data_dtype is not None
+                    and data_dtype.itemsize != self._bytes_per_datum):
+                err_msg = 'data_dtype (set to '
+                err_msg += '{0}) does not hold '.format(data_dtype)
+                err_msg += '{0}-bit samples.'.format(nbits)
+                raise ValueError(err_msg)
 
         if obs_mode is None: obs_mode = self.obs_mode
 
@@ -578,42 +992,55 @@ class psrfits(F.FITS):
                 raise ValueError(err_msg)
 
             self.nbits = 8 * self._bytes_per_datum
-            #Set Header values dependent on data shape
-            self.replace_FITS_Record('PRIMARY','BITPIX',8)
-            self.replace_FITS_Record('SUBINT','BITPIX',8)
-            self.replace_FITS_Record('SUBINT','NBITS',self.nbits)
-            self.replace_FITS_Record('SUBINT','NBIN',nbin)
-            self.replace_FITS_Record('SUBINT','NCHAN',nchan)
-            self.replace_FITS_Record('PRIMARY','OBSNCHAN',nchan)
-            self.replace_FITS_Record('SUBINT','NPOL',npol)
-            self.replace_FITS_Record('SUBINT','NSBLK',nsblk)
-            self.replace_FITS_Record('SUBINT','NAXIS2',nsubint)
-            self.replace_FITS_Record('SUBINT','TFORM13',str(nchan)+'E')
-            self.replace_FITS_Record('SUBINT','TFORM14',str(nchan)+'E')
-            self.replace_FITS_Record('SUBINT','TFORM15',str(nchan*npol)+'E')
-            self.replace_FITS_Record('SUBINT','TFORM16',str(nchan*npol)+'E')
-
+            if nbits is not None:
+                self.nbits = nbits
+            if self.nbits not in (1, 2, 4, 8, 16):
+                err_msg = 'NBITS (set to {0}) must be '.format(self.nbits)
+                err_msg += '1, 2, 4, 8 or 16 for SEARCH mode.'
+                raise ValueError(err_msg)
+            #Sub-byte samples are packed into the bytes of the channel axis
+            data_nchan = nchan
+            if self.nbits < 8:
+                if (nchan * self.nbits) % 8:
+                    err_msg = 'NCHAN*NBITS (set to '
+                    err_msg += '{0}) must be a '.format(nchan*self.nbits)
+                    err_msg += 'multiple of 8.'
+                    raise ValueError(err_msg)
+                data_nchan = nchan * self.nbits // 8
             #Calculate Number of Bytes in each row's DATA array
-            tform17 = nbin*nchan*npol*nsblk
-            self.replace_FITS_Record('SUBINT','TFORM17',str(tform17)+'B')
+            tform17 = nbin*data_nchan*npol*nsblk
 
             #This is the number of bytes in TSUBINT, OFFS_SUB, LST_SUB, etc.
             bytes_in_lone_floats = 7*8 + 5*4
 
             naxis1 = tform17*self._bytes_per_datum + 2*nchan*4 + 2*nchan*npol*4
             naxis1 += bytes_in_lone_floats
-            self.replace_FITS_Record('SUBINT','NAXIS1', str(naxis1))
+
+            # 16-bit samples are stored as big-endian 2-byte integers, 8-bit
+            # (and packed sub-byte) samples as bytes
+            data_tform, data_dtype = {1: ('B', '|u1'),
+                                      2: ('I', '>i2')}[self._bytes_per_datum]
 
             # Set the TDIM17 string-tuple
-            tdim17 = '('+str(nbin)+', '+str(nchan)+', '
+            tdim17 = '('+str(nbin)+', '+str(data_nchan)+', '
             tdim17 += str(npol)+', '+str(nsblk)+')'
-            self.replace_FITS_Record('SUBINT','TDIM17', tdim17)
 
-            self.subint_dtype = self.get_HDU_dtypes(self.fits_template
-                                                    [self.subint_idx])
+            #Set Header values dependent on data shape
+            self.draft_hdrs['PRIMARY'].update_values({'BITPIX': 8,
+                                                      'OBSNCHAN': nchan})
+            self.draft_hdrs['SUBINT'].update_values({
+                'BITPIX': 8, 'NBITS': self.nbits, 'NBIN': nbin,
+                'NCHAN': nchan, 'NPOL': npol, 'NSBLK': nsblk,
+                'NAXIS2': nsubint, 'NAXIS1': naxis1,
+                'TFORM13': str(nchan)+'E', 'TFORM14': str(nchan)+'E',
+                'TFORM15': str(nchan*npol)+'E',
+                'TFORM16': str(nchan*npol)+'E',
+                'TFORM17': str(tform17)+data_tform, 'TDIM17': tdim17})
+
+            self.subint_dtype = self.get_template_dtypes('SUBINT')
             self.set_HDU_array_shape_and_dtype(self.subint_dtype,'DATA',
-                                               (nbin,nchan,npol,nsblk))
-                                               #,data_dtype)
+                                               (nbin,data_nchan,npol,nsblk),
+                                               data_dtype)
 
             self.single_subint_floats=['TSUBINT','OFFS_SUB',
                                        'LST_SUB','RA_SUB',
@@ -631,36 +1058,30 @@ class psrfits(F.FITS):
                 raise ValueError(err_msg)
 
             self.nbits = 1
-            self.replace_FITS_Record('PRIMARY','BITPIX',8)
-            self.replace_FITS_Record('SUBINT','BITPIX',8)
-            self.replace_FITS_Record('SUBINT','NBITS',self.nbits)
-            self.replace_FITS_Record('SUBINT','NBIN',nbin)
-            self.replace_FITS_Record('SUBINT','NCHAN',nchan)
-            self.replace_FITS_Record('PRIMARY','OBSNCHAN',nchan)
-            self.replace_FITS_Record('SUBINT','NPOL',npol)
-            self.replace_FITS_Record('SUBINT','NSBLK',nsblk)
-            self.replace_FITS_Record('SUBINT','NAXIS2',nsubint)
-            self.replace_FITS_Record('SUBINT','TFORM16',str(nchan)+'D')
-            self.replace_FITS_Record('SUBINT','TFORM17',str(nchan)+'E')
-            self.replace_FITS_Record('SUBINT','TFORM18',str(nchan*npol)+'E')
-            self.replace_FITS_Record('SUBINT','TFORM19',str(nchan*npol)+'E')
 
             #Calculate Number of Bytes in each row's DATA array
             tform20 = nbin*nchan*npol
-            self.replace_FITS_Record('SUBINT','TFORM20',str(tform20)+'I')
             bytes_in_lone_floats = 10*8 + 5*4
 
             #This is the number of bytes in TSUBINT, OFFS_SUB, LST_SUB, etc.
             naxis1 = tform20*self._bytes_per_datum + nchan*8 + nchan*4
             naxis1 += 2*nchan*npol*4 + bytes_in_lone_floats
-            self.replace_FITS_Record('SUBINT','NAXIS1', str(naxis1))
 
             # Set the TDIM20 string-tuple
             tdim20 = '('+str(nbin)+', '+str(nchan)+', ' + str(npol)+')'
-            self.replace_FITS_Record('SUBINT','TDIM20', tdim20)
 
-            self.subint_dtype = self.get_HDU_dtypes(self.fits_template
-                                                    [self.subint_idx])
+            self.draft_hdrs['PRIMARY'].update_values({'BITPIX': 8,
+                                                      'OBSNCHAN': nchan})
+            self.draft_hdrs['SUBINT'].update_values({
+                'BITPIX': 8, 'NBITS': self.nbits, 'NBIN': nbin,
+                'NCHAN': nchan, 'NPOL': npol, 'NSBLK': nsblk,
+                'NAXIS2': nsubint, 'NAXIS1': naxis1,
+                'TFORM16': str(nchan)+'D', 'TFORM17': str(nchan)+'E',
+                'TFORM18': str(nchan*npol)+'E',
+                'TFORM19': str(nchan*npol)+'E',
+                'TFORM20': str(tform20)+'I', 'TDIM20': tdim20})
+
+            self.subint_dtype = self.get_template_dtypes('SUBINT')
             self.set_HDU_array_shape_and_dtype(self.subint_dtype,'DATA',
                                                (npol,nchan,nbin))
 
@@ -682,7 +1103,8 @@ class psrfits(F.FITS):
         self.set_HDU_array_shape_and_dtype(self.subint_dtype,
                                            'DAT_SCL',(nchan*npol,))
 
-    def copy_template_BinTable(self, ext_name, cols='all', dtypes=None):
+    def copy_template_BinTable(self, ext_name, cols='all', dtypes=None,
+                               rows=None, share=False):
         """
         Method to copy PSRFITS binary tables exactly. This is
             especially useful when using real PSRFITS files to make simulated
@@ -690,6 +1112,11 @@ class psrfits(F.FITS):
             file with your simulated data, but keep the ancillary telescope
             information. This copies the BinTable as a numpy.recarray into the
             `HDU_drafts` dictionary.
+        The template table is memory mapped (or, when it is copied whole,
+            taken from the template cache) and each column is copied once,
+            straight into the draft.
+        The NAXIS2 card of the draft header is set to the number of rows
+            copied.
 
         Parameters
         ----------
@@ -698,25 +1125,215 @@ class psrfits(F.FITS):
             Binary Extension name to copy.
 
         cols : str or list
-            Columns of the given BinTable to copy.
+            Columns of the given BinTable to copy. Other columns of the draft
+            are left uninitialized.
 
         dtypes : list of tuples
             Data types for numpy.recarray that will be the draft for the
-            BinTable.
+            BinTable, e.g. `subint_dtype` after `set_subint_dims()`. Defaults
+            to the template's dtypes. A column whose array shape differs from
+            the template's is filled in the template's element order.
+
+        rows : slice, int or array_like, optional
+            Rows of the template to copy, e.g. `slice(0, 16)` for the first
+            16 subints. Default is every row.
+
+        share : bool
+            Instead of copying, make the draft a read-only view of the
+            template table (memory mapped or cached), for tables that will be
+            written unchanged. Only possible for all columns with the
+            template's dtypes.
         """
-        idx = self.draft_hdr_keys.index(ext_name)
-        dtypes = self.get_HDU_dtypes(self.fits_template[idx])
-        nrows = self.fits_template[idx].read_header()['NAXIS2']
+        template_dtypes = self.get_template_dtypes(ext_name)
+        if dtypes is None:
+            dtypes = template_dtypes
+        # Only a table copied whole is worth keeping in the template cache
+        whole = rows is None and cols == 'all'
         if cols=='all':
-            cols = self.fits_template[idx].get_colnames()
+            cols = [dtype[0] for dtype in dtypes]
+        if rows is None:
+            rows = slice(None)
+        elif isinstance(rows, six.integer_types + (np.integer,)):
+            rows = [rows]
+        if not isinstance(rows, slice):
+            rows = np.asarray(rows)
+
+        source = self.template_table_view(ext_name, whole=whole)
+        if share:
+            if (list(dtypes) != template_dtypes
+                    or list(cols) != [dtype[0] for dtype in template_dtypes]):
+                raise ValueError('Only whole BinTables with the template '
+                                 'dtypes can be shared.')
+            if source is None:
+                source = self.read_template_table(
+                    ext_name, rows=None if whole else
+                    np.arange(self.fits_template[ext_name].get_nrows())[rows])
+                rows = slice(None)
+            table = source[rows].view(type=np.ndarray)
+            table.flags.writeable = False
+            self.HDU_drafts[ext_name] = table
+            self.draft_hdrs[ext_name].set_value('NAXIS2', len(table))
+            return
+
+        if source is None:
+            #Can not be memory mapped, so fitsio reads the rows and columns.
+            if isinstance(rows, slice):
+                nrows = self.fits_template[ext_name].get_nrows()
+                rows = np.arange(nrows)[rows]
+            source = self.read_template_table(ext_name, cols, rows=rows)
+            rows = slice(None)
+        if isinstance(rows, slice):
+            source = source[rows]
+            nrows = len(source)
+        else:
+            nrows = len(rows)
 
         self.HDU_drafts[ext_name] = self.make_HDU_rec_array(nrows, dtypes)
-        copy_cols = self.fits_template[idx].read(columns=cols)
-        #TODO Think about how this would change for appending single rows.
         for col in cols:
-            self.HDU_drafts[ext_name][col][:] = copy_cols[col][:]
+            if isinstance(rows, slice):
+                column = source[col]
+            else:
+                column = source[col][rows]
+            draft_col = self.HDU_drafts[ext_name][col]
+            if column.shape != draft_col.shape:
+                if column.size != draft_col.size:
+                    err_msg = 'Column {0} of {1} has '.format(col, ext_name)
+                    err_msg += 'shape {0} in the '.format(column.shape[1:])
+                    err_msg += 'template, which does not fit the draft '
+                    err_msg += 'shape {0}.'.format(draft_col.shape[1:])
+                    raise ValueError(err_msg)
+                column = column.reshape(draft_col.shape)
+            draft_col[...] = column
+        self.draft_hdrs[ext_name].set_value('NAXIS2', nrows)
+
+    def quantize_subint_data(self, data, start_row=0, method='minmax',
+                             percentiles=(0.5, 99.5), table=None):
+        """
+        Quantize floating point search mode data into the DATA, DAT_SCL and
+            DAT_OFFS columns of the SUBINT draft, in place. This is the
+            inverse of `PyPSRFITS.get_data()`: each row, polarization and
+            channel gets its own scale and offset, and reading the written
+            file back gives the data to within half a scale step.
+        The dimensions (NSBLK, NPOL, NCHAN), NBITS and POL_TYPE are taken
+            from the draft SUBINT header, e.g. after `set_subint_dims()`.
+            Polarizations are quantized to unsigned or signed samples as
+            `PyPSRFITS` expects from POL_TYPE, and 1, 2 and 4-bit samples
+            are packed into bytes. The draft must already hold the rows,
+            e.g. from `copy_template_BinTable()` or `make_HDU_rec_array()`.
+            Rows are quantized in blocks of about
+            `append_chunk_bytes`, so the only large temporary arrays are one
+            block in size.
 
-        del copy_cols
+        Parameters
+        ----------
+
+        data : array
+            Data with dimensions [time, poln, chan] (as returned by
+            `PyPSRFITS.get_data()`) or [row, time, poln, chan]. The number
+            of time samples must be a multiple of NSBLK.
+
+        start_row : int
+            First row of the draft to fill.
+
+        method : str, {'minmax', 'percentile'}
+            Scale each channel to the full range of its data, or to the
+            given percentiles, clipping samples outside them.
+
+        percentiles : tuple
+            (low, high) percentiles used with method='percentile'.
+
+        table : numpy.recarray, optional
+            Rows to fill instead of the SUBINT draft, e.g. a chunk made with
+            `make_HDU_rec_array(nrows, self.subint_dtype)` to pass to
+            `append_subint_array()`.
+        """
+        hdr = self.draft_hdrs['SUBINT']
+        nsblk, npol, nchan = hdr['NSBLK'], hdr['NPOL'], hdr['NCHAN']
+        nbits = hdr['NBITS']
+        signpol = 2 if 'AABB' in str(hdr['POL_TYPE']) else 1
+        data = np.asarray(data).reshape((-1, nsblk, npol, nchan))
+        nrows = data.shape[0]
+
+        if table is not None:
+            draft = table
+        elif self.HDU_drafts.get('SUBINT') is None:
+            raise ValueError('There is no SUBINT draft to fill. Make one '
+                             'with copy_template_BinTable() or '
+                             'make_HDU_rec_array().')
+        else:
+            draft = self.HDU_drafts['SUBINT']
+        if start_row < 0 or start_row + nrows > len(draft):
+            err_msg = 'Rows {0} to {1} '.format(start_row, start_row+nrows-1)
+            err_msg += 'are not in the SUBINT table, '
+            err_msg += 'which has {0} rows.'.format(len(draft))
+            raise ValueError(err_msg)
+        data_col = draft.dtype['DATA']
+        if data_col.itemsize != nsblk*npol*nchan*nbits//8:
+            err_msg = 'The DATA column of the draft has '
+            err_msg += '{0} bytes, but NSBLK, NPOL, '.format(data_col.itemsize)
+            err_msg += 'NCHAN and NBITS need '
+            err_msg += '{0}.'.format(nsblk*npol*nchan*nbits//8)
+            raise ValueError(err_msg)
+
+        block_rows = max(1, self.append_chunk_bytes // max(1, data[0].nbytes))
+        for row in range(0, nrows, block_rows):
+            block = data[row:row+block_rows]
+            samples, scales, offsets = quantize_search_block(
+                block, nbits, signpol, method=method, percentiles=percentiles)
+            rows = slice(start_row + row, start_row + row + len(block))
+            raw = samples.reshape((len(block), -1))
+            if nbits < 8:
+                raw = pack_samples(raw, nbits)
+            elif nbits == 16:
+                # Two's complement samples, big-endian as FITS stores them
+                raw = raw.view(np.int16).astype('>i2')
+            if raw.dtype.itemsize != data_col.base.itemsize:
+                # A DATA column of raw bytes holds the big-endian bytes
+                raw = raw.view(np.uint8).view(data_col.base)
+            draft['DATA'][rows] = raw.reshape((len(block),) + data_col.shape)
+            draft['DAT_SCL'][rows] = scales.reshape((len(block), -1))
+            draft['DAT_OFFS'][rows] = offsets.reshape((len(block), -1))
+
+    def zap_channels(self, mask, start_row=0):
+        """
+        Set DAT_WTS to zero for flagged channels, e.g. with a mask from
+            `pdat.rfi.sk_mask()`. The weights of the SUBINT draft are changed
+            if there is one, otherwise those of the file, in place, which
+            must then be open read-write.
+
+        Parameters
+        ----------
+
+        mask : array
+            Boolean array with dimensions [row, chan], True for channels to
+            zero. Weights of channels not flagged are left as they are.
+
+        start_row : int
+            Row of the SUBINT table the first row of mask is for.
+        """
+        mask = np.asarray(mask, dtype=bool)
+        rows = slice(start_row, start_row + len(mask))
+        draft = self.HDU_drafts.get('SUBINT')
+        if draft is not None:
+            weights = draft['DAT_WTS'][rows]
+            if weights.shape != mask.shape:
+                err_msg = 'The mask has shape {0}, '.format(mask.shape)
+                err_msg += 'but DAT_WTS of those rows of the draft has '
+                err_msg += 'shape {0}.'.format(weights.shape)
+                raise ValueError(err_msg)
+            weights[mask] = 0
+            return
+        hdu = self['SUBINT']
+        weights = hdu.read_column('DAT_WTS',
+                                  rows=np.arange(rows.start, rows.stop))
+        weights = weights.reshape((len(weights), -1))
+        if weights.shape != mask.shape:
+            err_msg = 'The mask has shape {0}, '.format(mask.shape)
+            err_msg += 'but DAT_WTS of those rows has '
+            err_msg += 'shape {0}.'.format(weights.shape)
+            raise ValueError(err_msg)
+        weights[mask] = 0
+        hdu.write_column('DAT_WTS', weights, firstrow=start_row)
 
     def set_draft_header(self, ext_name, hdr_dict):
         """
@@ -734,8 +1351,7 @@ class psrfits(F.FITS):
             Dictionary of header changes to be made to the template header.
             Template header entries are kept, unless replaced by this function.
         """
-        for key in hdr_dict.keys():
-            self.replace_FITS_Record(ext_name,key,hdr_dict[key])
+        self.draft_hdrs[ext_name].update_values(hdr_dict)
 
     def close(self):
         """
@@ -779,6 +1395,461 @@ class psrfits(F.FITS):
     #     #data = DATA*DAT_SCL+DAT_OFFS
 
 
+class DraftHeader(F.FITSHDR):
+
+    def __init__(self, record_list=None):
+        """
+        A fitsio.FITSHDR used for the draft headers of a PSRFITS file. Cards
+        are looked up by name through an index of their positions rather
+        than a scan of the records, and new values are formatted directly
+        from the FITS type of the card being replaced ('C' string, 'L'
+        logical, 'I' integer or 'F' float), so many keys can be changed in
+        one pass with `update_values()`. Only the public FITSHDR API
+        (`add_record()`, `records()`, `delete()`) is used, so the index
+        does not depend on fitsio's internals.
+
+        Parameters
+        ----------
+
+        record_list : fitsio.FITSHDR or list of dict
+            Header to copy, e.g. the output of `read_header()`.
+        """
+        # Position of each named card in records()
+        self._positions = {}
+        if isinstance(record_list, F.FITSHDR):
+            record_list = record_list.records()
+        super(DraftHeader, self).__init__(record_list)
+
+    def add_record(self, record_in):
+        """
+        Add a card, or replace the card of the same name, as
+        `fitsio.FITSHDR.add_record()` does, keeping the index up to date.
+        """
+        if not (isinstance(record_in, dict) and 'name' in record_in
+                and 'value' in record_in):
+            record_in = F.FITSRecord(record_in)
+        name = record_in['name']
+        name = None if name is None else name.upper()
+        position = None
+        if name not in ('COMMENT', 'HISTORY', 'CONTINUE', None):
+            position = self._positions.get(name, None)
+        super(DraftHeader, self).add_record(record_in)
+        if position is None:
+            position = len(self.records()) - 1
+        self._positions[name] = position
+
+    def delete(self, name):
+        """Delete the named card(s), if they exist."""
+        super(DraftHeader, self).delete(name)
+        self._positions = {}
+        for position, record in enumerate(self.records()):
+            key = record['name']
+            self._positions[None if key is None else key.upper()] = position
+
+    def copy(self):
+        """
+        Returns a copy of the header. Cards are replaced rather than edited
+        in place, so changing either header does not change the other.
+        """
+        return DraftHeader(self.records())
+
+    def card(self, name):
+        """Returns the FITS card/record named `name`, or False if it is not
+        in the header."""
+        position = self._positions.get(name.upper(), None)
+        if position is None:
+            return False
+        return self.records()[position]
+
+    def set_value(self, name, new_value):
+        """
+        Replace the value of an existing card, keeping its comment and FITS
+        type.
+        """
+        name = name.upper()
+        record = self.card(name)
+        if not record:
+            err_msg = 'A FITS card named '
+            err_msg += '{0} does not exist in this HDU.'.format(name)
+            raise ValueError(err_msg)
+        if name.startswith('TDIM'):
+            # TDIM string-tuples are written without spaces, e.g. (1,8,2,16)
+            new_value = str(new_value).replace(' ','')
+        value, value_str = format_card_value(card_type(record), new_value)
+        new_record = dict(record)
+        new_record['value'] = value
+        new_record['value_orig'] = value
+        new_record['card_string'] = make_card_string(name, value_str,
+                                                     record.get('comment'))
+        self.add_record(new_record)
+
+    def update_values(self, hdr_dict):
+        """
+        Replace the values of many existing cards at once.
+
+        Parameters
+        ----------
+
+        hdr_dict : dict
+            Dictionary of card names and new values.
+        """
+        missing = [key for key in hdr_dict.keys()
+                   if key.upper() not in self._positions]
+        if missing:
+            err_msg = 'FITS cards named {0} do not exist '.format(missing)
+            err_msg += 'in this HDU.'
+            raise ValueError(err_msg)
+        for key, value in hdr_dict.items():
+            self.set_value(key, value)
+
+
+def card_type(record):
+    """
+    Returns the FITS type of a card/record: 'C' (string), 'L' (logical),
+    'I' (integer) or 'F' (float). Uses the 'dtype' entry if fitsio set one,
+    otherwise the type of the parsed value.
+    """
+    if record.get('dtype', None) in ['C', 'L', 'I', 'F']:
+        return record['dtype']
+    value = record['value']
+    if isinstance(value, (bool, np.bool_)):
+        return 'L'
+    elif isinstance(value, six.integer_types + (np.integer,)):
+        return 'I'
+    elif isinstance(value, (float, np.floating)):
+        return 'F'
+    return 'C'
+
+def format_card_value(dtype, new_value):
+    """
+    Converts a new value to the FITS type of the card it replaces and
+    returns (value, value string for the card). An integer card given a
+    non-integral number becomes a float card. NaN and infinite values can
+    not be written in FITS headers and raise a ValueError, as in fitsio.
+    """
+    if dtype == 'C':
+        value = str(new_value).strip()
+        return value, '\'{0:<8}\''.format(value.replace('\'','\'\''))
+    elif dtype == 'L':
+        if isinstance(new_value, six.string_types):
+            value = new_value.strip().upper() in ['T', 'TRUE']
+        else:
+            value = bool(new_value)
+        return value, 'T' if value else 'F'
+    elif dtype == 'I':
+        value = float(new_value)
+        if value.is_integer():
+            value = int(value)
+            return value, str(value)
+    value = float(new_value)
+    if not np.isfinite(value):
+        raise ValueError('{0} can not be written in a FITS '
+                         'header.'.format(value))
+    value_str = repr(value).upper()
+    for precision in range(16, 0, -1):
+        if len(value_str) <= 20:
+            break
+        value_str = '{0:.{1}G}'.format(value, precision)
+    if '.' not in value_str and 'E' not in value_str:
+        value_str += '.'
+    return value, value_str
+
+def make_card_string(name, value_str, comment=None):
+    """Makes an 80 character FITS card from a name, formatted value and
+    comment. Strings are left justified, other values right justified to
+    column 30. A string too long for the card is started with the CONTINUE
+    long string convention, as fitsio shows it: the card holds the first
+    part of the string ending in '&', and the rest of the value is written
+    in CONTINUE cards when the header is written."""
+    if value_str.startswith('\'') and len(value_str) > 70:
+        # Keep doubled quotes together and leave room for the &
+        chunk = value_str[1:-1][:67]
+        if (len(chunk) - len(chunk.rstrip('\''))) % 2:
+            chunk = chunk[:-1]
+        return '{0:<8}= \'{1}&\''.format(name, chunk)
+    if value_str.startswith('\''):
+        card = '{0:<8}= {1:<20}'.format(name, value_str)
+    else:
+        card = '{0:<8}= {1:>20}'.format(name, value_str)
+    if comment:
+        card += ' / ' + comment
+    return card[:80]
+
+class LazyHeaderDict(MutableMapping):
+
+    def __init__(self, keys, read_header):
+        """
+        An ordered mapping of HDU names to headers that reads each header the
+        first time it is used, so opening a file does not parse headers that
+        are never looked at. Used for `draft_hdrs` when an existing file is
+        opened in read/write mode.
+
+        Parameters
+        ----------
+
+        keys : list of str
+            HDU names, in HDU order.
+
+        read_header : callable
+            Function taking an HDU name and returning its header.
+        """
+        self._keys = list(keys)
+        self._headers = {}
+        self._read_header = read_header
+
+    def is_loaded(self, key):
+        """True if the header has been read (or set)."""
+        return key in self._headers
+
+    def __getitem__(self, key):
+        if key not in self._headers:
+            if key not in self._keys:
+                raise KeyError(key)
+            self._headers[key] = self._read_header(key)
+        return self._headers[key]
+
+    def __setitem__(self, key, header):
+        if key not in self._keys:
+            self._keys.append(key)
+        self._headers[key] = header
+
+    def __delitem__(self, key):
+        self._keys.remove(key)
+        self._headers.pop(key, None)
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def __iter__(self):
+        return iter(list(self._keys))
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __repr__(self):
+        return 'LazyHeaderDict({0}, loaded={1})'.format(
+            self._keys, [key for key in self._keys if key in self._headers])
+
+
+class TemplateCache(object):
+
+    def __init__(self, max_templates=16, max_bytes=64*1024*1024,
+                 cache_tables=True):
+        """
+        Process-wide cache of parsed PSRFITS templates, used by
+        `psrfits(from_template=...)`. Each template is keyed by its path,
+        modification time and size, so a template that changes on disk is
+        re-read the next time it is used. Holds the draft headers, BinTable
+        dtypes and primary HDU info of each template and, optionally, the
+        BinTables copied whole with `copy_template_BinTable()`; copying some
+        rows reads just those rows, which are not kept. The least recently
+        used templates are dropped when there are more than `max_templates`
+        or they take up more than `max_bytes`.
+
+        Parameters
+        ----------
+
+        max_templates : int
+            Maximum number of templates held.
+
+        max_bytes : int
+            Approximate maximum size of the cached headers and tables. The
+            most recently used template is always kept.
+
+        cache_tables : bool
+            Keep BinTables read whole from the templates in memory.
+        """
+        self.max_templates = max_templates
+        self.max_bytes = max_bytes
+        self.cache_tables = cache_tables
+        self._templates = collections.OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, path, index=None):
+        """
+        Returns the TemplateEntry for a template, reading it if it is not
+        cached or has changed since it was cached.
+
+        Parameters
+        ----------
+
+        path : str
+            Path to the template.
+
+        index : pdat.PSRFITSIndex, optional
+            Index to take the headers from when the template is read.
+        """
+        key = _file_key(path)
+        with self._lock:
+            entry = self._templates.pop(key[0], None)
+            if entry is None or entry.key != key:
+                entry = TemplateEntry(path, key, self, index=index)
+            self._templates[key[0]] = entry
+            self._evict()
+        return entry
+
+    def invalidate(self, path=None):
+        """Drop a template from the cache, or every template if `path` is
+        None."""
+        with self._lock:
+            if path is None:
+                self._templates.clear()
+            else:
+                self._templates.pop(os.path.abspath(path), None)
+
+    def clear(self):
+        """Drop every template from the cache."""
+        self.invalidate()
+
+    @property
+    def nbytes(self):
+        """Approximate size of the cached headers and tables in bytes."""
+        return sum(entry.nbytes for entry in self._templates.values())
+
+    def __len__(self):
+        return len(self._templates)
+
+    def __contains__(self, path):
+        entry = self._templates.get(os.path.abspath(path), None)
+        try:
+            return entry is not None and entry.key == _file_key(path)
+        except OSError:
+            return False
+
+    def _evict(self):
+        with self._lock:
+            while len(self._templates) > 1 and (
+                    len(self._templates) > self.max_templates
+                    or self.nbytes > self.max_bytes):
+                self._templates.popitem(last=False)
+
+
+class TemplateEntry(object):
+
+    def __init__(self, path, key, cache, index=None):
+        """
+        A template held by a TemplateCache: its draft headers (`headers`),
+        BinTable dtype lists (`dtypes`), primary HDU info (`primary_info`) and
+        any BinTables read so far (`tables`). The headers are shared by every
+        psrfits instance using the template and must only be copied with
+        `DraftHeader.copy()`.
+        """
+        self.path = path
+        self.key = key
+        self.cache = cache
+        self.headers = read_draft_headers(path, index=index)
+        self.dtypes = {}
+        self.offsets = {}
+        with F.FITS(path, mode='r') as fits:
+            self.primary_info = dict(fits[0]._info)
+            for ext_name in list(self.headers.keys())[1:]:
+                self.dtypes[ext_name] = fits[ext_name].get_rec_dtype()[0].descr
+                self.offsets[ext_name] = (fits[ext_name].get_offsets()
+                                          ['data_start'])
+        self.tables = {}
+
+    @property
+    def nbytes(self):
+        """Approximate size of the cached headers and tables in bytes."""
+        nbytes = sum(80*len(hdr) for hdr in self.headers.values())
+        return nbytes + sum(table.nbytes for table in self.tables.values())
+
+    def read_table(self, ext_name, cols='all', rows=None):
+        """
+        Returns the rows of a BinTable, every row if `rows` is None. If the
+        cache keeps tables a table read whole is read once and shared
+        (unless it is larger than the cache's max_bytes). Otherwise, or when
+        only some rows are asked for, just `cols` and `rows` are read and
+        nothing is kept.
+        """
+        table = self.tables.get(ext_name, None)
+        if table is not None:
+            return table if rows is None else table[rows]
+        if rows is not None or not self._keep_table(ext_name):
+            columns = None if cols == 'all' else cols
+            return F.read(self.path, ext=ext_name, columns=columns, rows=rows)
+        table = F.read(self.path, ext=ext_name)
+        self.tables[ext_name] = table
+        self.cache._evict()
+        return table
+
+    def _keep_table(self, ext_name):
+        """True if a BinTable should be held in the cache once read."""
+        hdr = self.headers[ext_name]
+        return (self.cache.cache_tables
+                and hdr['NAXIS1']*hdr['NAXIS2'] <= self.cache.max_bytes)
+
+    def view_table(self, ext_name, whole=True):
+        """
+        Returns the cached rows of a BinTable, or a read-only numpy.memmap of
+        the table in the template file if it is too large to cache or only
+        part of it is needed (`whole` False), so it is not read in full.
+        Returns None if neither is possible (see
+        `pypsrfits.can_memmap_table()`).
+        """
+        if ext_name in self.tables or (whole and self._keep_table(ext_name)):
+            return self.read_table(ext_name)
+        if not can_memmap_table(self.headers[ext_name]):
+            return None
+        return table_memmap(self.path, self.headers[ext_name],
+                            self.offsets[ext_name])
+
+
+def _reshape_columns(table, dtype):
+    """
+    Return table with its array columns given the shapes of the same named
+    columns of dtype (e.g. those of a table in the file, set by TDIMn), as a
+    view of the same bytes. Used to append rows whose DATA has the
+    (nbin, nchan, npol, nsblk) shape of `set_subint_dims()`.
+    """
+    formats = []
+    for name in table.dtype.names:
+        column = table.dtype[name]
+        shape = dtype[name].shape if name in dtype.names else column.shape
+        if (shape == column.shape
+                or int(np.prod(shape)) != int(np.prod(column.shape))):
+            formats.append((name, column))
+        else:
+            formats.append((name, column.base, shape))
+    new_dtype = np.dtype(formats)
+    if new_dtype == table.dtype or new_dtype.itemsize != table.dtype.itemsize:
+        return table
+    return np.ascontiguousarray(table).view(new_dtype)
+
+
+def read_draft_headers(path, index=None):
+    """
+    Reads the headers of a PSRFITS file into an OrderedDict of DraftHeaders
+    keyed by EXTNAME ('PRIMARY' for the first HDU), in HDU order. The
+    headers are taken from `index` if the file is indexed and unchanged.
+    """
+    headers = None
+    if index is not None:
+        headers = index.get_headers(path)
+    draft_hdrs = collections.OrderedDict()
+    if headers is not None:
+        for hdr_key, hdr in headers.items():
+            draft_hdrs[hdr_key] = DraftHeader(hdr)
+        return draft_hdrs
+    with F.FITS(path, mode='r') as fits:
+        draft_hdrs['PRIMARY'] = DraftHeader(fits[0].read_header())
+        for ii in range(1, len(fits)):
+            hdr_key = fits[ii].get_extname()
+            draft_hdrs[hdr_key] = DraftHeader(fits[ii].read_header())
+    return draft_hdrs
+
+def _file_key(path):
+    """(absolute path, mtime, size) used to tell if a file has changed."""
+    stat = os.stat(path)
+    return (os.path.abspath(path), stat.st_mtime, stat.st_size)
+
+# Templates used by psrfits(from_template=...)
+template_cache = TemplateCache()
+
+def _rate(nbytes, seconds):
+    """Throughput in MB/s."""
+    return nbytes / 1e6 / seconds if seconds > 0 else float('inf')
+
 def list_arg(list_name, string):
     """Returns the index of a particular string in a list of strings."""
     return [x for x, y in enumerate(list_name) if y == string][0]
@@ -3,9 +3,13 @@
 # Simple code to read search-mode PSRFITS data arrays into python
 from __future__ import (absolute_import, division,
                     print_function, unicode_literals)
+import re
+import multiprocessing
 import fitsio
 import numpy
 
+from .stats import StreamStats
+
 class PyPSRFITS:
     """
     A version of Paul Demorest's pypsrfits routines added into the Pulsar Data Toolbox
@@ -40,28 +44,128 @@ class PyPSRFITS:
     # Read all data in entire file, downsampling in time by
     # a factor of 256
     d = f.get_data(0,-1,downsamp=256)
+
+    # Process the entire file 32 rows at a time in constant memory
+    for d, t, freqs in f.iter_blocks(32, downsamp=256):
+        ...
     """
-    def __init__(self, fname=None):
+    # Small per-row SUBINT columns, read once and cached for the whole file
+    row_columns = ['TSUBINT', 'OFFS_SUB', 'DAT_FREQ', 'DAT_WTS', 'DAT_SCL',
+                   'DAT_OFFS']
+
+    # Approximate size in bytes of each bulk DATA read done by get_data
+    read_block_bytes = 64 * 1024 * 1024
+
+    def __init__(self, fname=None, use_mmap=False, index=None):
         self.fits = None
+        self._freqs0 = None
+        self._mmap = None
         if fname != None:
-            self.open(fname)
+            self.open(fname, use_mmap=use_mmap, index=index)
 
-    def open(self,fname):
+    def open(self, fname, use_mmap=False, index=None):
         """Open the specified PSRFITS file.  A fitsio object is
         created and stored as self.fits.  For convenience, the
         main header is stored as self.hdr, and the SUBINT header
-        as self.subhdr."""
+        as self.subhdr.  If use_mmap is True the SUBINT rows are
+        read through a memory map of the file (see memmap()) rather
+        than copied by fitsio, if the table can be memory mapped (see
+        can_memmap()).  If a pdat.PSRFITSIndex is given as
+        index, headers cached there are used instead of being read
+        from the file again."""
+        self.fname = fname
         self.fits = fitsio.FITS(fname,'r')
-        self.hdr = self.fits[0].read_header()
-        self.subhdr = self.fits['SUBINT'].read_header()
+        headers = None
+        if index is not None:
+            headers = index.get_headers(fname)
+        if headers is not None:
+            self.hdr = headers['PRIMARY']
+            self.subhdr = headers['SUBINT']
+        else:
+            self.hdr = self.fits[0].read_header()
+            self.subhdr = self.fits['SUBINT'].read_header()
+        self._freqs0 = None
+        self._mmap = None
+        self.use_mmap = use_mmap
+
+    def can_memmap(self):
+        """True if the SUBINT table can be used straight from a memory
+        map and decodes the same as through fitsio (see
+        can_memmap_table())."""
+        return can_memmap_table(self.subhdr)
+
+    def memmap(self):
+        """Return the SUBINT table as a read-only numpy.memmap of the
+        file, with one structured element per row.  Columns and rows
+        (e.g. f.memmap()['DATA'][13]) are views into the file, so no
+        data are copied until they are used.  Raises a ValueError if
+        the table has scaled (TZEROn/TSCALn) or other columns that can
+        not be memory mapped."""
+        if not self.can_memmap():
+            raise ValueError("The SUBINT table of %s has columns that can "
+                             "not be memory mapped." % self.fname)
+        if self._mmap is None:
+            offset = self.fits['SUBINT'].get_offsets()['data_start']
+            self._mmap = table_memmap(self.fname, self.subhdr, offset)
+        return self._mmap
+
+    def memmap_columns(self, columns=('DATA','DAT_SCL','DAT_OFFS','DAT_WTS')):
+        """Return a dictionary of memory-mapped views of the given SUBINT
+        columns, each with the row index first."""
+        mm = self.memmap()
+        return dict((col, mm[col]) for col in columns)
+
+    def get_row_info(self, start_row=0, end_row=-1):
+        """Return the small per-row SUBINT columns listed in row_columns
+        (times, frequencies, weights, scales and offsets) for rows
+        start_row to end_row (inclusive; negative values count from the
+        end of the file).  Only these rows are read, with a single call,
+        so reading a file a block at a time holds the columns of one
+        block rather than of the whole file."""
+        nrows = self.subhdr['NAXIS2']
+        if start_row < 0: start_row += nrows
+        if end_row < 0: end_row += nrows
+        info = self.read_rows(start_row, end_row,
+                              columns=list(self.row_columns))
+        if info.dtype['DAT_FREQ'].shape == ():
+            # A single channel is read as a scalar, add the channel axis
+            dtype = [(name, info.dtype[name], (1,))
+                     if name.startswith('DAT_') else
+                     (name, info.dtype[name])
+                     for name in info.dtype.names]
+            fixed = numpy.empty(len(info), dtype=dtype)
+            for name in info.dtype.names:
+                fixed[name] = info[name].reshape(fixed[name].shape)
+            info = fixed
+        return info
+
+    def read_rows(self, start_row, end_row, columns=('DATA',)):
+        """Read the given SUBINT columns for rows start_row to end_row
+        (inclusive) with a single fitsio call.  Returns a recarray, or a
+        view of the memory map when the file was opened with use_mmap
+        (and the table can be memory mapped)."""
+        if self.use_mmap and self.can_memmap():
+            return self.memmap()[start_row:end_row+1][list(columns)]
+        rows = numpy.arange(start_row, end_row+1)
+        return self.fits['SUBINT'].read(columns=list(columns), rows=rows)
 
     def get_freqs(self,row=0):
-        """Return the frequency array from the specified subint."""
-        return self.fits['SUBINT']['DAT_FREQ'][row]
+        """Return the frequency array from the specified subint.  Those
+        of the first subint are cached."""
+        if row < 0: row += self.subhdr['NAXIS2']
+        if row == 0 and self._freqs0 is not None:
+            return self._freqs0
+        freqs = numpy.array(self.get_row_info(row, row)['DAT_FREQ'][0])
+        if row == 0:
+            self._freqs0 = freqs
+        return freqs
 
     def get_data(self, start_row=0, end_row=None,
             downsamp=1, fdownsamp=1, apply_scales=True,
-            get_ft=False,squeeze=False):
+            apply_weights=True,get_ft=False,squeeze=False,workers=1,
+            chan_range=None,chans=None,pols=None,
+            out=None,out_dtype=None,stats=None,zap=None,
+            pol_mode='all'):
         """Read the data from the specified rows and return it as a
         single array.  Dimensions are [time, poln, chan].
         options:
@@ -69,7 +173,8 @@ class PyPSRFITS:
           end_row: final subint to read.  None implies end_row=start_row.
             Negative values imply offset from the end, i.e.
             get_data(0,-1) would read the entire file.  (Don't forget
-            that PSRFITS files are often huge so this might be a bad idea).
+            that PSRFITS files are often huge so this might be a bad idea;
+            see iter_blocks() to stream through a file instead).
           downsamp: downsample the data in time as they are being read in.
             The downsample factor should evenly divide the number of spectra
             per row.  downsamp=0 means integrate each row completely.
@@ -77,12 +182,186 @@ class PyPSRFITS:
             The downsample factor should evenly divide the number of channels.
           apply_scales: set to False to avoid applying the scale/offset
             data stored in the file.
+          apply_weights: use the channel weights (DAT_WTS) stored in the
+            file.  Channels with zero weight are set to zero (and not
+            decoded at all when they have zero weight in every row of a
+            block), and with fdownsamp > 1 each output channel is the
+            weighted mean of its channels, so flagged channels are left
+            out.  Set to False to ignore DAT_WTS.  Not used for integer
+            out_dtype.
           get_ft: if True return time and freq arrays as well.
           squeeze: if True, "squeeze" the data array (remove len-1
             dimensions).
+          workers: number of processes to decode with.  If > 1 the rows
+            are split between a pool of processes, each with its own
+            fitsio handle, writing straight into a shared-memory result.
+          chan_range: (first, last+1) channels to read, e.g. (128, 256).
+          chans: list of channels to read (instead of chan_range).
+          pols: list of polarisations to read, e.g. [0] for only the
+            first polarisation.
+            When channels or polarisations are selected only the
+            selected bytes of each DATA row are read, through a memory
+            map of the file (see memmap(); tables that can not be
+            mapped are read whole with fitsio), and only the matching
+            scales, offsets and frequencies are used.  fdownsamp then
+            applies to the selected channels.
+          out: array to decode into instead of allocating a new one,
+            e.g. to reuse one buffer between calls.  It must be
+            C-contiguous with the shape of the result, and its dtype sets
+            out_dtype.  Can not be combined with workers > 1.
+          out_dtype: dtype of the result.  numpy.float32 (the default)
+            or numpy.float16 to halve the memory use.  An integer dtype
+            returns the raw samples, with the scales and offsets left
+            for the caller to apply (see get_row_info()); downsamp and
+            fdownsamp must then be 1, and the dtype wide enough for the
+            samples (e.g. int16 for 8-bit data with signed polarisations).
+          stats: a pdat.StreamStats to update with the decoded data, block
+            by block while it is still in cache, e.g. for the bandpass and
+            zero-DM series as a by-product of the read.  With workers > 1
+            each process collects its own statistics, which are merged.
+          pol_mode: polarisations to return, combined as they are
+            decoded.  'all' (the default) returns every polarisation;
+            'AA' or 'BB' only that one of AABB... data; 'AABB-sum' the
+            sum AA+BB; 'I' total intensity, i.e. AA+BB for AABB... data
+            and the first polarisation otherwise (IQUV, AA+BB, INTEN).
+            The output then has a single polarisation, and only the
+            polarisations needed are read.  Can not be combined with pols.
+          zap: boolean array with dimensions [row, chan] for every row and
+            channel of the file, e.g. from pdat.rfi.sk_mask().  Flagged
+            (True) channels are given zero weight, as for DAT_WTS above
+            (whether or not apply_weights is set).
         Notes:
-          - Only 8, 16, and 32 bit data are currently understood
+          - Only 1, 2, 4, 8, 16, and 32 bit data are currently understood
+          - Blocks of rows are read with one fitsio call each and
+            decoded in a handful of vectorized numpy operations by
+            decode_search_block().
+        """
+
+        p = self._search_setup(start_row, end_row, downsamp, fdownsamp,
+                               chan_range, chans, pols, zap, pol_mode)
+        nrows_tot = p['end_row'] - p['start_row'] + 1
+        nsamp = nrows_tot * p['nsblk_ds']
+        shape = (nsamp, p['npol_out'], p['nchan_ds'])
+
+        if out is not None:
+            if workers > 1:
+                raise ValueError("out can not be used with workers > 1.")
+            if out_dtype is not None and out.dtype != out_dtype:
+                raise ValueError("out has dtype %s, not out_dtype %s."
+                                 % (out.dtype, numpy.dtype(out_dtype)))
+            if out.shape != shape or not out.flags.c_contiguous:
+                raise ValueError("out must be a C-contiguous array of "
+                                 "shape %s." % (shape,))
+            out_dtype = out.dtype
+        out_dtype, apply_scales = _check_out_dtype(p, out_dtype, apply_scales)
+        p['apply_weights'] = apply_weights and out_dtype.kind == 'f'
+
+        # allocate the result array
+        pool = None
+        if workers > 1:
+            pool, result, times = self._start_pool(workers, p, nsamp, get_ft,
+                                                   out_dtype)
+        else:
+            if out is None:
+                result = numpy.zeros(shape, dtype=out_dtype)
+            else:
+                result = out
+            times = None
+            if get_ft:
+                times = numpy.zeros(nsamp)
+        if get_ft:
+            freqs = numpy.zeros(p['nchan_ds'])
+
+        if pool is None:
+            self._decode_rows(p, p['start_row'], nrows_tot, apply_scales,
+                              result, times, stats)
+        else:
+            try:
+                self._pool_decode_rows(pool, workers, p, p['start_row'],
+                                       nrows_tot, apply_scales, stats)
+            finally:
+                pool.close()
+                pool.join()
+
+        if get_ft:
+            # Assumes freqs don't change:
+            freqs[:] = self._block_freqs(p, p['end_row'])
+
+        if squeeze: result = result.squeeze()
+
+        if get_ft:
+            return (result, times, freqs)
+        else:
+            return result
+
+    def iter_blocks(self, rows_per_block=16, start_row=0, end_row=-1,
+            downsamp=1, fdownsamp=1, apply_scales=True, apply_weights=True,
+            squeeze=False, workers=1, chan_range=None, chans=None, pols=None,
+            out_dtype=None, stats=None, zap=None, pol_mode='all'):
+        """Generator that reads and decodes the data in blocks of
+        rows_per_block rows, yielding (data, times, freqs) for each block.
+        Dimensions of data are [time, poln, chan], as for get_data().
+        The output arrays are allocated once and reused for every block,
+        so memory use is bounded by rows_per_block whatever the size of
+        the file.  Copy the yielded arrays if you need to keep them past
+        the next iteration.
+        options:
+          rows_per_block: number of subints decoded per iteration.
+          start_row, end_row: first and last (inclusive) subints to read.
+            Negative values imply offset from the end; the default reads
+            the entire file.
+          downsamp, fdownsamp, apply_scales, apply_weights, squeeze,
+          workers, chan_range, chans, pols, out_dtype, stats, zap,
+          pol_mode: see get_data().  With workers > 1 one process pool
+            is kept for the lifetime of the generator.
         """
+        if rows_per_block < 1:
+            raise ValueError("rows_per_block must be at least 1")
+
+        p = self._search_setup(start_row, end_row, downsamp, fdownsamp,
+                               chan_range, chans, pols, zap, pol_mode)
+        nrows_tot = p['end_row'] - p['start_row'] + 1
+        rows_per_block = min(rows_per_block, nrows_tot)
+        nsamp_buf = rows_per_block * p['nsblk_ds']
+        out_dtype, apply_scales = _check_out_dtype(p, out_dtype, apply_scales)
+        p['apply_weights'] = apply_weights and out_dtype.kind == 'f'
+
+        pool = None
+        if workers > 1:
+            pool, data_buf, times_buf = self._start_pool(workers, p,
+                    nsamp_buf, True, out_dtype)
+        else:
+            data_buf = numpy.zeros((nsamp_buf, p['npol_out'], p['nchan_ds']),
+                    dtype=out_dtype)
+            times_buf = numpy.zeros(nsamp_buf)
+
+        try:
+            for irow in range(0, nrows_tot, rows_per_block):
+                nread = min(rows_per_block, nrows_tot - irow)
+                row0 = p['start_row'] + irow
+                nsamp = nread * p['nsblk_ds']
+                data = data_buf[:nsamp]
+                times = times_buf[:nsamp]
+                if pool is None:
+                    self._decode_rows(p, row0, nread, apply_scales, data,
+                                      times, stats)
+                else:
+                    self._pool_decode_rows(pool, workers, p, row0, nread,
+                                           apply_scales, stats)
+                freqs = self._block_freqs(p, row0 + nread - 1)
+                if squeeze: data = data.squeeze()
+                yield (data, times, freqs)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+    def _search_setup(self, start_row, end_row, downsamp, fdownsamp,
+            chan_range=None, chans=None, pols=None, zap=None,
+            pol_mode='all'):
+        """Check that search-mode data can be read with the requested
+        options, and return a dictionary of the file dimensions and the
+        (possibly adjusted) read options."""
 
         if self.hdr['OBS_MODE'].strip() != 'SEARCH':
             raise RuntimeError("get_data() only works on SEARCH-mode PSRFITS")
@@ -91,10 +370,34 @@ class PyPSRFITS:
         npol = self.subhdr['NPOL']
         nchan = self.subhdr['NCHAN']
         nbit = self.subhdr['NBITS']
-        tbin = self.subhdr['TBIN']
         poltype = self.subhdr['POL_TYPE']
         nrows_file = self.subhdr['NAXIS2']
 
+        # Polarisations read (and summed) for pol_mode
+        pol_sum = False
+        if pol_mode != 'all':
+            if pols is not None:
+                raise ValueError("Give only one of pols and pol_mode.")
+            pols, pol_sum = pol_mode_pols(pol_mode, poltype, npol)
+            if len(pols) == npol:
+                pols = None
+
+        # Channel and polarisation selections, as slices where possible
+        if chan_range is not None and chans is not None:
+            raise ValueError("Give only one of chan_range and chans.")
+        chan_sel = slice(0, nchan)
+        if chan_range is not None:
+            chan_sel = slice(*chan_range)
+        elif chans is not None:
+            chan_sel = numpy.asarray(chans, dtype=int)
+        pol_sel = slice(0, npol)
+        if pols is not None:
+            pol_sel = numpy.asarray(pols, dtype=int)
+        nchan_sel = len(numpy.arange(nchan)[chan_sel])
+        pol_idx = numpy.arange(npol)[pol_sel]
+        if nchan_sel == 0 or len(pol_idx) == 0:
+            raise ValueError("No channels or polarisations selected.")
+
         if downsamp == 0:
             downsamp = nsblk
 
@@ -102,10 +405,10 @@ class PyPSRFITS:
             downsamp = nsblk
 
         if fdownsamp == 0:
-            downsamp = nchan
+            fdownsamp = nchan_sel
 
-        if fdownsamp > nchan:
-            fdownsamp = nchan
+        if fdownsamp > nchan_sel:
+            fdownsamp = nchan_sel
 
         if end_row==None:
             end_row = start_row
@@ -116,90 +419,614 @@ class PyPSRFITS:
         if nsblk % downsamp > 0:
             print("Warning: downsamp does not evenly divide NSBLK.")
 
-        if nchan % fdownsamp > 0:
+        if nchan_sel % fdownsamp > 0:
             print("Warning: fdownsamp does not evenly divide NCHAN.")
 
-        nrows_tot = end_row - start_row + 1
-        nsblk_ds = nsblk / downsamp
-        nchan_ds = nchan / fdownsamp
-        tbin_ds = tbin * downsamp
-
-        # Data types of the signed and unsigned
-        if nbit==8:
-            s_t = numpy.int8
-            u_t = numpy.uint8
-        elif nbit==16:
-            s_t = numpy.int16
-            u_t = numpy.uint16
-        elif nbit==32:
-            s_t = numpy.float32
-            u_t = numpy.float32
-        else:
-            raise RuntimeError("Unhandled number of bits (%d)" % nbit)
+        # Check early that we understand the data type
+        sample_types(nbit)
 
-        # allocate the result array
-        sampresult = numpy.zeros(nchan, dtype=numpy.float32)
-        result = numpy.zeros((nrows_tot * nsblk_ds, npol, nchan_ds),
-                dtype=numpy.float32)
-        if get_ft:
-            freqs = numpy.zeros(nchan_ds)
-            times = numpy.zeros(nrows_tot*nsblk_ds)
+        if zap is not None:
+            zap = numpy.asarray(zap, dtype=bool)
+            if zap.shape != (nrows_file, nchan):
+                raise ValueError("zap must have dimensions [row, chan], "
+                                 "shape %s." % ((nrows_file, nchan),))
 
         signpol = 1
         if 'AABB' in poltype:
             signpol = 2
 
-        for irow in range(nrows_tot):
+        return dict(nsblk=nsblk, npol=npol, nchan=nchan,
+                    nbit=nbit, tbin=self.subhdr['TBIN'], signpol=signpol,
+                    downsamp=downsamp, fdownsamp=fdownsamp,
+                    nsblk_ds=nsblk//downsamp, nchan_ds=nchan_sel//fdownsamp,
+                    start_row=start_row, end_row=end_row,
+                    chan_sel=chan_sel, pol_sel=pol_sel, pol_idx=pol_idx,
+                    npol_out=1 if pol_sum else len(pol_idx),
+                    pol_sum=pol_sum, zap=zap,
+                    selected=(chan_range is not None or chans is not None
+                              or pols is not None))
+
+    def _decode_rows(self, p, start_row, nrows, apply_scales, out,
+            times=None, stats=None):
+        """Read and decode nrows subints starting at start_row into out,
+        using the read options p from _search_setup().  If times is not
+        None the sample times are written into it, and if stats is not
+        None each decoded block is added to it."""
+        nsblk, npol, nchan = p['nsblk'], p['npol'], p['nchan']
+        nsblk_ds = p['nsblk_ds']
+
+        # Read as many rows at once as fit in read_block_bytes
+        row_bytes = self.subhdr['NAXIS1']
+        if p['selected']:
+            row_bytes = max(1, row_bytes * p['npol_out'] // npol)
+        rows_per_read = max(1, self.read_block_bytes // row_bytes)
+
+        scales = offsets = None
+        for irow in range(0, nrows, rows_per_read):
+            nread = min(rows_per_read, nrows - irow)
+            rows = slice(irow+start_row, irow+start_row+nread)
+            samps = slice(irow*nsblk_ds, (irow+nread)*nsblk_ds)
+
+            if apply_scales or p['apply_weights'] or times is not None:
+                info = self.get_row_info(rows.start, rows.stop-1)
 
             if apply_scales:
-                offsets = self.fits['SUBINT']['DAT_OFFS'][irow+start_row]
-                scales = self.fits['SUBINT']['DAT_SCL'][irow+start_row]
-                scales = scales.reshape((npol,nchan))
-                offsets = offsets.reshape((npol,nchan))
+                scales = info['DAT_SCL'].reshape((nread,npol,nchan))
+                offsets = info['DAT_OFFS'].reshape((nread,npol,nchan))
+                if p['selected']:
+                    scales = scales[:, p['pol_sel']][..., p['chan_sel']]
+                    offsets = offsets[:, p['pol_sel']][..., p['chan_sel']]
 
-            if get_ft:
-                t0_row = self.fits['SUBINT']['OFFS_SUB'][irow+start_row] \
-                        - self.fits['SUBINT']['TSUBINT'][irow+start_row]/2.0
-                freqs_row = self.fits['SUBINT']['DAT_FREQ'][irow+start_row]
-
-            dtmp = self.fits['SUBINT']['DATA'][irow+start_row]
-
-            # Fix up the data type
-            if (nbit==16):
-                dtmp = numpy.fromstring(dtmp.tostring(),dtype=numpy.int16)
-                dtmp = dtmp.reshape((nsblk,npol,nchan,1))
-
-            for isamp in range(nsblk_ds):
-                for ipol in range(npol):
-                    if ipol<signpol:
-                        t = u_t
-                    else:
-                        t = s_t
-
-                    sampresult = dtmp[isamp*downsamp:(isamp+1)*downsamp,
-                            ipol,:,0].astype(t).mean(0)
-
-                    if get_ft:
-                        times[irow*nsblk_ds+isamp] = t0_row \
-                                + (isamp+0.5)*tbin_ds
-
-                    if apply_scales:
-                        sampresult *= scales[ipol,:]
-                        sampresult += offsets[ipol,:]
-
-                    if fdownsamp==1:
-                        result[irow*nsblk_ds+isamp,ipol,:] = sampresult
-                        # Assumes freqs don't change:
-                        if get_ft: freqs[:] = freqs_row[:]
-                    else:
-                        result[irow*nsblk_ds+isamp,ipol,:] = \
-                                sampresult.reshape((-1,fdownsamp)).mean(1)
-                        if get_ft:
-                            freqs[:] = freqs_row.reshape((-1,fdownsamp)).mean(1)
+            weights = None
+            if p['apply_weights']:
+                weights = info['DAT_WTS'][:, p['chan_sel']]
+                if (weights == weights.flat[0]).all() and weights.flat[0]:
+                    # Equal weights change nothing
+                    weights = None
+            if p['zap'] is not None:
+                keep = ~p['zap'][rows][:, p['chan_sel']]
+                weights = keep if weights is None else weights * keep
 
-        if squeeze: result = result.squeeze()
+            dtmp = self._read_samples(p, rows.start, rows.stop)
 
-        if get_ft:
-            return (result, times, freqs)
+            decode_search_block(dtmp, p['nbit'], p['signpol'],
+                                downsamp=p['downsamp'],
+                                fdownsamp=p['fdownsamp'], scales=scales,
+                                offsets=offsets, out=out[samps],
+                                pols=p['pol_idx'], weights=weights,
+                                pol_sum=p['pol_sum'])
+            if stats is not None:
+                stats.update(out[samps], row0=rows.start, nrows=nread)
+
+            if times is not None:
+                t0_rows = info['OFFS_SUB'] - info['TSUBINT']/2.0
+                times[samps] = sample_times(t0_rows, nsblk_ds,
+                        p['tbin']*p['downsamp']).ravel()
+
+    def _read_samples(self, p, start_row, stop_row):
+        """Read the raw samples of rows start_row to stop_row-1 with
+        dimensions [row, time, poln, chan], restricted to the selected
+        polarisations and channels.  With a selection the samples come
+        from the memory map, so only the selected bytes are touched,
+        unless the table can not be memory mapped."""
+        nsblk, npol, nchan, nbit = p['nsblk'], p['npol'], p['nchan'], p['nbit']
+        nrows = stop_row - start_row
+
+        if p['selected'] and self.can_memmap():
+            dtmp = self.memmap()['DATA'][start_row:stop_row]
+            if nbit < 8:
+                # Unpack the bytes of the selected polarisations
+                dtmp = dtmp.reshape((nrows, nsblk, npol, -1))
+                dtmp = dtmp[:, :, p['pol_sel']]
+                return unpack_samples(dtmp, nbit)[..., p['chan_sel']]
+            elif dtmp.dtype.itemsize * 8 == nbit:
+                dtmp = dtmp.reshape((nrows, nsblk, npol, nchan))
+                dtmp = dtmp[:, :, p['pol_sel']][..., p['chan_sel']]
+                if nbit == 16:
+                    # Convert the big-endian column to native samples
+                    dtmp = dtmp.astype(numpy.int16)
+                return dtmp
         else:
-            return result
+            dtmp = self.read_rows(start_row, stop_row-1)['DATA']
+
+        # Data stored with another column type are reinterpreted whole
+        dtmp = raw_to_samples(dtmp, nbit, (nsblk,npol,nchan))
+        if p['selected']:
+            dtmp = dtmp[:, :, p['pol_sel']][..., p['chan_sel']]
+        return dtmp
+
+    def _start_pool(self, workers, p, nsamp, get_times,
+            dtype=numpy.float32):
+        """Start a pool of decoding processes sharing a data (and
+        optionally times) output buffer of nsamp samples.  Returns the
+        pool and numpy views of the shared buffers."""
+        shape = (nsamp, p['npol_out'], p['nchan_ds'])
+        dtype = numpy.dtype(dtype)
+        data_buf = multiprocessing.RawArray('b',
+                int(numpy.prod(shape)) * dtype.itemsize)
+        times_buf = None
+        if get_times:
+            times_buf = multiprocessing.RawArray('d', nsamp)
+        pool = multiprocessing.Pool(workers, initializer=_init_decode_worker,
+                initargs=(self.fname, self.use_mmap, data_buf, shape,
+                          dtype.str, times_buf))
+        data = numpy.frombuffer(data_buf, dtype=dtype).reshape(shape)
+        times = None
+        if get_times:
+            times = numpy.frombuffer(times_buf, dtype=numpy.float64)
+        return pool, data, times
+
+    def _pool_decode_rows(self, pool, workers, p, start_row, nrows,
+            apply_scales, stats=None):
+        """Split nrows subints from start_row between the processes of
+        a pool from _start_pool(), which decode them into the start of
+        the shared output buffers.  The statistics collected by each
+        process are merged into stats, if given."""
+        bounds = numpy.linspace(0, nrows, min(workers, nrows)+1).astype(int)
+        tasks = [(p, start_row+b0, b1-b0, b0*p['nsblk_ds'], apply_scales,
+                  stats is not None)
+                 for b0, b1 in zip(bounds[:-1], bounds[1:])]
+        for worker_stats in pool.map(_decode_worker, tasks):
+            if stats is not None:
+                stats.merge(worker_stats)
+
+    def _block_freqs(self, p, row):
+        """Return the (downsampled) selected channel frequencies of a
+        subint."""
+        freqs = self.get_freqs(row)[p['chan_sel']]
+        return downsample_freqs(freqs, p['fdownsamp'])
+
+
+# Per-process state of the get_data(workers=...) decoding pool
+_worker_state = {}
+
+def _init_decode_worker(fname, use_mmap, data_buf, shape, dtype, times_buf):
+    """Open the file and attach the shared output buffers in a worker."""
+    _worker_state['pf'] = PyPSRFITS(fname, use_mmap=use_mmap)
+    _worker_state['data'] = numpy.frombuffer(data_buf,
+            dtype=dtype).reshape(shape)
+    _worker_state['times'] = None
+    if times_buf is not None:
+        _worker_state['times'] = numpy.frombuffer(times_buf,
+                dtype=numpy.float64)
+
+def _check_out_dtype(p, out_dtype, apply_scales):
+    """Check an output dtype against the read options p, returning the
+    dtype and whether scales can be applied.  Integer outputs hold raw
+    samples, so no scales are applied and no downsampling is allowed."""
+    if out_dtype is None:
+        out_dtype = numpy.float32
+    out_dtype = numpy.dtype(out_dtype)
+    if out_dtype.kind == 'f':
+        return out_dtype, apply_scales
+    if out_dtype.kind not in 'iu':
+        raise ValueError("Unhandled output dtype %s" % out_dtype)
+    if p['downsamp'] != 1 or p['fdownsamp'] != 1:
+        raise ValueError("Integer output can not be downsampled.")
+    if p['zap'] is not None:
+        raise ValueError("Integer output can not be zapped.")
+    if p['pol_sum']:
+        raise ValueError("Integer output can not sum polarisations.")
+    return out_dtype, False
+
+def _decode_worker(task):
+    """Decode a range of rows into the shared buffers at offset samp0,
+    returning their statistics if asked for."""
+    p, start_row, nrows, samp0, apply_scales, with_stats = task
+    samps = slice(samp0, samp0 + nrows*p['nsblk_ds'])
+    times = _worker_state['times']
+    if times is not None:
+        times = times[samps]
+    stats = StreamStats() if with_stats else None
+    _worker_state['pf']._decode_rows(p, start_row, nrows, apply_scales,
+                                     _worker_state['data'][samps], times,
+                                     stats)
+    return stats
+
+# Numpy types of the FITS binary table TFORM codes (big-endian on disk)
+_tform_types = {'L':'i1', 'X':'u1', 'B':'u1', 'I':'>i2', 'J':'>i4',
+                'K':'>i8', 'A':'S', 'E':'>f4', 'D':'>f8', 'C':'>c8',
+                'M':'>c16', 'P':'>i4', 'Q':'>i8'}
+
+# Lookup tables for unpacking sub-byte samples, filled on first use
+_unpack_tables = {}
+
+def table_dtype(hdr):
+    """Return the numpy dtype of one row of a FITS binary table, computed
+    from the TFORMn/TDIMn cards of its header.  Fields are placed at
+    their byte offsets within the NAXIS1 byte row."""
+    names, formats, offsets = [], [], []
+    offset = 0
+    for icol in range(1, hdr['TFIELDS']+1):
+        repeat, code = re.match(r'(\d*)([A-Z])',
+                                str(hdr['TFORM%d' % icol]).strip()).groups()
+        repeat = int(repeat or 1)
+        if code == 'X':
+            repeat = (repeat + 7) // 8
+        if code == 'A':
+            fmt = numpy.dtype('S%d' % repeat)
+        elif code in 'PQ':
+            # Variable length array descriptor: (count, heap offset)
+            fmt = numpy.dtype((_tform_types[code], (2,)))
+        else:
+            tdim = hdr.get('TDIM%d' % icol, None)
+            if tdim is not None:
+                shape = tuple(int(n) for n in
+                              str(tdim).strip('() ').split(','))[::-1]
+            elif repeat == 1:
+                shape = ()
+            else:
+                shape = (repeat,)
+            fmt = numpy.dtype((_tform_types[code], shape))
+        names.append(str(hdr['TTYPE%d' % icol]).strip())
+        formats.append(fmt)
+        offsets.append(offset)
+        offset += fmt.itemsize
+    return numpy.dtype({'names':names, 'formats':formats,
+                        'offsets':offsets, 'itemsize':hdr['NAXIS1']})
+
+def can_memmap_table(hdr):
+    """True if the rows of a FITS binary table can be used straight from a
+    memory map, i.e. no column is scaled (TSCALn/TZEROn), logical, a bit
+    array or a variable length array."""
+    for icol in range(1, hdr['TFIELDS']+1):
+        if 'TSCAL%d' % icol in hdr or 'TZERO%d' % icol in hdr:
+            return False
+        code = re.match(r'\d*([A-Z])',
+                        str(hdr['TFORM%d' % icol]).strip()).group(1)
+        if code in 'LXPQ':
+            return False
+    return True
+
+def table_memmap(fname, hdr, offset, mode='r'):
+    """Memory map the rows of a FITS binary table.  hdr is the table
+    header and offset the byte offset of its data in the file (e.g.
+    from fitsio's HDU.get_offsets()['data_start']).  Returns a
+    numpy.memmap with one structured element per row."""
+    dtype = table_dtype(hdr)
+    nrows = hdr['NAXIS2']
+    if nrows == 0:
+        return numpy.zeros(0, dtype=dtype)
+    return numpy.memmap(fname, dtype=dtype, mode=mode, offset=offset,
+                        shape=(nrows,))
+
+def sample_types(nbit):
+    """Return the (signed, unsigned) numpy types used to interpret
+    nbit search-mode samples.  Sub-byte (1, 2 and 4 bit) samples are
+    always unsigned."""
+    if nbit in (1,2,4):
+        return numpy.uint8, numpy.uint8
+    elif nbit==8:
+        return numpy.int8, numpy.uint8
+    elif nbit==16:
+        return numpy.int16, numpy.uint16
+    elif nbit==32:
+        return numpy.float32, numpy.float32
+    else:
+        raise RuntimeError("Unhandled number of bits (%d)" % nbit)
+
+def raw_to_samples(dtmp, nbit, shape):
+    """Reinterpret the raw DATA column of a block of rows as an array
+    of samples with dimensions [row, time, poln, chan].  dtmp is the
+    DATA column as returned by fitsio, with the row index first.
+    shape is (nsblk, npol, nchan)."""
+    nrows = dtmp.shape[0]
+    if nbit<8:
+        dtmp = unpack_samples(dtmp.reshape((nrows,-1)), nbit)
+    elif nbit==16:
+        dtmp = numpy.ascontiguousarray(dtmp).reshape((nrows,-1))
+        if dtmp.dtype.itemsize == 1:
+            # 16-bit data stored as raw bytes, which are big-endian
+            dtmp = dtmp.view('>i2')
+        # Unsigned (TZERO) columns wrap to the same two's complement bits
+        dtmp = dtmp.astype(numpy.int16)
+    return dtmp.reshape((nrows,) + tuple(shape))
+
+def unpack_table(nbit):
+    """Return the lookup table mapping each byte value to its 8/nbit
+    samples, shape [256, 8/nbit].  Following the PSRFITS convention the
+    first sample is held in the most significant bits of the byte."""
+    if nbit not in (1,2,4):
+        raise RuntimeError("Unhandled number of bits (%d)" % nbit)
+    if nbit not in _unpack_tables:
+        byte = numpy.arange(256, dtype=numpy.uint8)[:,numpy.newaxis]
+        shifts = numpy.arange(8-nbit, -1, -nbit, dtype=numpy.uint8)
+        table = (byte >> shifts) & numpy.uint8((1<<nbit) - 1)
+        _unpack_tables[nbit] = table.astype(numpy.uint8)
+    return _unpack_tables[nbit]
+
+def unpack_samples(packed, nbit):
+    """Unpack 1, 2 or 4 bit samples from bytes along the last axis of
+    packed, returning a uint8 array with 8/nbit times as many samples
+    in that axis.  A single table lookup is done for the whole array."""
+    table = unpack_table(nbit)
+    packed = numpy.asarray(packed).view(numpy.uint8)
+    samples = table[packed]
+    return samples.reshape(packed.shape[:-1] + (-1,))
+
+def pack_samples(samples, nbit):
+    """Pack 1, 2 or 4 bit samples into bytes along the last axis, the
+    inverse of unpack_samples().  The first sample goes in the most
+    significant bits of each byte, following the PSRFITS convention.
+    The last axis must hold a multiple of 8/nbit samples, each less than
+    2**nbit; the result has 8/nbit times fewer bytes in that axis."""
+    if nbit not in (1,2,4):
+        raise RuntimeError("Unhandled number of bits (%d)" % nbit)
+    samples = numpy.asarray(samples, dtype=numpy.uint8)
+    per_byte = 8 // nbit
+    if samples.shape[-1] % per_byte:
+        raise ValueError("%d-bit samples are packed %d to a byte, so the "
+                         "last axis (%d) must be a multiple of %d."
+                         % (nbit, per_byte, samples.shape[-1], per_byte))
+    if nbit == 1:
+        return numpy.packbits(samples, axis=-1)
+    samples = samples.reshape(samples.shape[:-1] + (-1, per_byte))
+    shifts = numpy.arange(8-nbit, -1, -nbit, dtype=numpy.uint8)
+    return numpy.bitwise_or.reduce(samples << shifts, axis=-1)
+
+def pol_mode_pols(pol_mode, poltype, npol):
+    """Return the polarisations to read for a get_data() pol_mode, and
+    whether they are summed, given POL_TYPE and NPOL of the file."""
+    aabb = 'AABB' in poltype and npol >= 2
+    if pol_mode == 'I':
+        return ([0, 1], True) if aabb else ([0], False)
+    if pol_mode in ('AA', 'BB', 'AABB-sum'):
+        if not aabb:
+            raise ValueError("pol_mode '%s' needs AABB data, not POL_TYPE "
+                             "%s." % (pol_mode, poltype))
+        return {'AA': ([0], False), 'BB': ([1], False),
+                'AABB-sum': ([0, 1], True)}[pol_mode]
+    raise ValueError("Unknown pol_mode '%s'.  Use 'all', 'I', 'AA', 'BB' "
+                     "or 'AABB-sum'." % pol_mode)
+
+def sample_times(t0, nsamp, tbin):
+    """Times of the centres of nsamp samples of length tbin starting
+    at t0.  t0 may be an array (one per row), in which case the result
+    has dimensions [row, sample]."""
+    t0 = numpy.asarray(t0, dtype=numpy.float64)
+    return t0[..., numpy.newaxis] + (numpy.arange(nsamp) + 0.5)*tbin
+
+def downsample_freqs(freqs, fdownsamp=1):
+    """Average a channel frequency array (last axis) by fdownsamp."""
+    if fdownsamp==1:
+        return freqs
+    nchan_ds = freqs.shape[-1] // fdownsamp
+    freqs = freqs[..., :nchan_ds*fdownsamp]
+    return freqs.reshape(freqs.shape[:-1] + (nchan_ds,fdownsamp)).mean(-1)
+
+def decode_search_block(dtmp, nbit, signpol=1, downsamp=1, fdownsamp=1,
+        scales=None, offsets=None, out=None, pols=None, weights=None,
+        pol_sum=False):
+    """Decode a block of search-mode rows into floating point spectra
+    using a few whole-array numpy operations.
+    options:
+      dtmp: raw samples with dimensions [row, time, poln, chan], e.g.
+        the output of raw_to_samples().
+      nbit: number of bits per sample (NBITS).
+      signpol: polarisations with index < signpol are unsigned, the rest
+        are signed (see PyPSRFITS.get_data).
+      downsamp, fdownsamp: time and frequency downsample factors.
+        Trailing samples/channels that do not fill a whole downsampled
+        bin are dropped.
+      scales, offsets: DAT_SCL and DAT_OFFS with dimensions
+        [row, poln, chan], or None to leave the data unscaled.
+      out: optional array of shape [row*time_ds, poln, chan_ds] to write
+        the result into.  If out has an integer dtype the raw samples
+        are copied into it, without scales or downsampling.
+      pols: the polarisation index in the file of each polarisation in
+        dtmp, when only some were read.  Used to tell which are signed.
+      weights: optional channel weights with dimensions [row, chan],
+        e.g. DAT_WTS.  Channels with zero weight are set to zero, and
+        are not decoded at all if their weight is zero in every row.
+        With fdownsamp > 1 each output channel is the weighted mean of
+        its channels (see weighted_fdownsamp()).
+      pol_sum: if True the polarisations are summed as they are decoded
+        (e.g. AA+BB for total intensity), and the output has a single
+        polarisation.
+    The output is identical to decoding each sample, polarisation and
+    row separately, as get_data() did originally.
+    """
+    s_t, u_t = sample_types(nbit)
+    nrows, nsblk, npol, nchan = dtmp.shape
+    nsblk_ds = nsblk // downsamp
+    nchan_ds = nchan // fdownsamp
+    npol_out = 1 if pol_sum else npol
+
+    if out is None:
+        out = numpy.zeros((nrows*nsblk_ds, npol_out, nchan_ds),
+                dtype=numpy.float32)
+    # Setting the shape (rather than reshape) guarantees a view of out
+    result = out.view()
+    result.shape = (nrows, nsblk_ds, npol_out, nchan_ds)
+    raw_out = out.dtype.kind in 'iu'
+    if raw_out and (downsamp!=1 or fdownsamp!=1 or scales is not None
+                    or weights is not None or pol_sum):
+        raise ValueError("Integer output can not be scaled, weighted or "
+                         "downsampled.")
+
+    dtmp = dtmp[:, :nsblk_ds*downsamp]
+    dtmp = dtmp.reshape((nrows, nsblk_ds, downsamp, npol, nchan))
+
+    chans = None
+    if weights is not None:
+        weights = numpy.asarray(weights, dtype=numpy.float64)
+        weights = weights[:, :nchan_ds*fdownsamp]
+        live = weights.any(0)
+        if not live.any():
+            result[...] = 0
+            return out
+        if not live.all() or len(live) < nchan:
+            # Channels with zero weight in every row are not decoded
+            chans = numpy.flatnonzero(live)
+            dtmp = dtmp[..., chans]
+            weights = weights[:, chans]
+            if scales is not None:
+                scales = scales[..., chans]
+                offsets = offsets[..., chans]
+
+    if pols is None:
+        pols = numpy.arange(npol)
+    unsigned = numpy.asarray(pols) < signpol
+    nuns = unsigned.sum()
+    if unsigned[:nuns].all():
+        groups = ((slice(0,nuns), u_t), (slice(nuns,npol), s_t))
+    else:
+        groups = ((numpy.flatnonzero(unsigned), u_t),
+                  (numpy.flatnonzero(~unsigned), s_t))
+
+    summed = False
+    for pols, t in groups:
+        block = dtmp[:, :, :, pols]
+        if block.shape[3]==0:
+            continue
+
+        # Same-size types are reinterpreted without a copy
+        if block.dtype.itemsize==numpy.dtype(t).itemsize:
+            block = block.view(
+                    numpy.dtype(t).newbyteorder(block.dtype.byteorder))
+        else:
+            block = block.astype(t)
+
+        if raw_out:
+            result[:, :, pols] = block[:, :, 0]
+            continue
+
+        if downsamp==1:
+            # The mean of a single sample, without the reduction
+            if numpy.issubdtype(t, numpy.integer):
+                spec = block[:, :, 0].astype(numpy.float64)
+            else:
+                spec = block[:, :, 0].astype(t)
+        else:
+            spec = block.mean(2)
+
+        if scales is not None:
+            spec *= scales[:, numpy.newaxis, pols]
+            spec += offsets[:, numpy.newaxis, pols]
+
+        if weights is not None:
+            spec = weighted_fdownsamp(spec, weights, fdownsamp, nchan_ds,
+                                      chans)
+        elif fdownsamp>1:
+            spec = spec[..., :nchan_ds*fdownsamp]
+            spec = spec.reshape(spec.shape[:-1] + (nchan_ds,fdownsamp))
+            spec = spec.mean(-1)
+
+        if not pol_sum:
+            result[:, :, pols] = spec
+        elif summed:
+            result[:, :, 0] += spec.sum(2)
+        else:
+            result[:, :, 0] = spec.sum(2)
+            summed = True
+
+    return out
+
+def weighted_fdownsamp(spec, weights, fdownsamp, nchan_ds, chans=None):
+    """Downsample spectra in frequency by fdownsamp, taking the mean of
+    each group of channels weighted by weights ([row, chan]), so
+    channels with zero weight are left out.  spec has dimensions
+    [row, time, poln, chan], where the channels are chans (indices into
+    the full band, default all of them).  Output channels with no
+    weight are zero.  With fdownsamp=1 channels with zero weight are
+    set to zero and the others left as they are.  Returns an array
+    with nchan_ds channels."""
+    w = weights[:, numpy.newaxis, numpy.newaxis]
+    if fdownsamp==1:
+        spec *= (w != 0)
+        if chans is None:
+            return spec
+        full = numpy.zeros(spec.shape[:-1] + (nchan_ds,), dtype=spec.dtype)
+        full[..., chans] = spec
+        return full
+
+    if chans is None:
+        chans = numpy.arange(nchan_ds*fdownsamp)
+        spec = spec[..., :nchan_ds*fdownsamp]
+    groups = chans // fdownsamp
+    starts = numpy.flatnonzero(numpy.r_[True, groups[1:] != groups[:-1]])
+    wsum = numpy.add.reduceat(weights, starts, axis=-1)
+    wsum = wsum[:, numpy.newaxis, numpy.newaxis]
+    sums = numpy.add.reduceat(spec * w, starts, axis=-1)
+    means = numpy.zeros_like(sums)
+    numpy.divide(sums, wsum, out=means, where=(wsum != 0))
+    if len(starts) == nchan_ds:
+        return means
+    full = numpy.zeros(spec.shape[:-1] + (nchan_ds,), dtype=means.dtype)
+    full[..., groups[starts]] = means
+    return full
+
+def sample_range(nbit, signed=False):
+    """Return the (smallest, largest) raw sample values of nbit
+    search-mode data.  Sub-byte samples are always unsigned."""
+    sample_types(nbit)
+    if signed and nbit >= 8:
+        return -(1 << (nbit-1)), (1 << (nbit-1)) - 1
+    return 0, (1 << nbit) - 1
+
+def quantize_search_block(data, nbit=8, signpol=1, method='minmax',
+        percentiles=(0.5, 99.5), pols=None):
+    """Quantize a block of floating point search-mode spectra, the
+    inverse of decode_search_block().  Returns (samples, scales,
+    offsets) such that samples*scales + offsets reproduces data to
+    within half a scale step (less any clipped outliers).
+    options:
+      data: spectra with dimensions [row, time, poln, chan].
+      nbit: number of bits per sample, 1, 2, 4, 8 or 16.
+      signpol: polarisations with index < signpol are quantized to
+        unsigned samples, the rest to signed samples (see
+        PyPSRFITS.get_data).  Sub-byte samples are always unsigned.
+      method: how the range of each row, polarisation and channel is
+        chosen.  'minmax' uses the whole range of the data, 'percentile'
+        the given (low, high) percentiles, clipping the samples outside
+        them.
+      percentiles: (low, high) percentiles used by method='percentile'.
+      pols: the polarisation index in the file of each polarisation in
+        data, when only some are given.  Used to tell which are signed.
+    The samples are returned as unsigned integers of nbit bits holding
+    the bytes of each sample, so signed samples are in two's complement,
+    with dimensions [row, time, poln, chan].  Sub-byte samples are
+    returned one per uint8, see pack_samples() to store them.  The
+    scales and offsets are float32 arrays with dimensions [row, poln,
+    chan], ready for DAT_SCL and DAT_OFFS once reshaped to
+    [row, poln*chan].
+    """
+    if nbit not in (1, 2, 4, 8, 16):
+        raise RuntimeError("Unhandled number of bits (%d)" % nbit)
+    s_t, u_t = sample_types(nbit)
+    data = numpy.asarray(data)
+    if data.dtype.kind != 'f':
+        data = data.astype(numpy.float32)
+    nrows, nsblk, npol, nchan = data.shape
+
+    if method == 'minmax':
+        lo = data.min(1)
+        hi = data.max(1)
+    elif method == 'percentile':
+        lo, hi = numpy.percentile(data, percentiles, axis=1)
+    else:
+        raise ValueError("Unknown method '%s'. Use 'minmax' or "
+                         "'percentile'." % method)
+
+    if pols is None:
+        pols = numpy.arange(npol)
+    signed = (numpy.asarray(pols) >= signpol) & (nbit >= 8)
+    qmin = numpy.where(signed, sample_range(nbit, True)[0], 0)
+    qmin = qmin[:, numpy.newaxis]
+
+    # Computed in double precision, then rounded to the stored float32
+    # values so quantizing and decoding use exactly the same numbers
+    scales = (hi - lo).astype(numpy.float64) / ((1 << nbit) - 1)
+    scales[scales <= 0] = 1.0
+    scales = scales.astype(numpy.float32)
+    offsets = (lo - qmin*scales.astype(numpy.float64)).astype(numpy.float32)
+
+    samples = data - offsets[:, numpy.newaxis]
+    samples /= scales[:, numpy.newaxis]
+    numpy.rint(samples, out=samples)
+    numpy.clip(samples, qmin, qmin + ((1 << nbit) - 1), out=samples)
+    if signed.any():
+        # Two's complement bytes of the signed samples
+        spols = numpy.flatnonzero(signed)
+        samples[:, :, spols] %= (1 << nbit)
+    return samples.astype(u_t), scales, offsets
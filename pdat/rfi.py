@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+# encoding=utf8
+"""Spectral kurtosis RFI flagging of SEARCH mode PSRFITS data."""
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import numpy as np
+
+from .pypsrfits import PyPSRFITS, sample_types
+
+# Squares of every byte value, so 1 to 8-bit samples are squared by lookup
+_byte_squares = (np.arange(256, dtype=np.uint16)**2).astype(np.uint16)
+
+
+def raw_moments(dtmp):
+    """
+    Sums of the samples and of their squares over time of a block of raw
+    samples with dimensions [row, time, poln, chan], as returned by
+    `pypsrfits.raw_to_samples()`. Integer samples are summed exactly in
+    64-bit integers, with bytes squared through a lookup table. Returns
+    (S1, S2) with dimensions [row, poln, chan].
+    """
+    if dtmp.dtype.kind in 'iu':
+        s1 = dtmp.sum(1, dtype=np.int64)
+        if dtmp.dtype.itemsize == 1:
+            if dtmp.dtype.kind == 'i':
+                dtmp = dtmp.view(np.uint8) ^ np.uint8(0x80)
+                squares = (np.arange(-128, 128, dtype=np.int32)**2)
+                squares = squares.astype(np.uint16)[dtmp]
+            else:
+                squares = _byte_squares[dtmp]
+        else:
+            squares = dtmp.astype(np.int64)
+            squares *= squares
+        return s1, squares.sum(1, dtype=np.int64)
+    dtmp = dtmp.astype(np.float64)
+    return dtmp.sum(1), (dtmp * dtmp).sum(1)
+
+
+def scaled_moments(s1, s2, nsamp, scales=None, offsets=None):
+    """
+    Sums of the values and of their squares, given the sums S1 and S2 of
+    nsamp raw samples that decode to value = raw*scale + offset. Arrays are
+    broadcast together, so no decoded copy of the data is needed.
+    """
+    s1 = np.asarray(s1, dtype=np.float64)
+    s2 = np.asarray(s2, dtype=np.float64)
+    if scales is None:
+        return s1, s2
+    p1 = scales*s1 + nsamp*offsets
+    p2 = scales**2*s2 + 2*scales*offsets*s1 + nsamp*offsets**2
+    return p1, p2
+
+
+def spectral_kurtosis(p1, p2, nsamp, d=1):
+    """
+    Generalized spectral kurtosis estimator (Nita & Gary 2010) of nsamp
+    power samples with sum p1 and sum of squares p2, each the sum of d
+    spectra. Close to 1 for Gaussian noise with d=1; RFI moves it away from
+    the value of the noise. Empty (zero power) channels give nan.
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return ((nsamp*d + 1) / (nsamp - 1)
+                * (nsamp * p2 / p1**2 - 1))
+
+
+def robust_outliers(values, threshold, axis=-1):
+    """
+    True where values are further than threshold robust standard
+    deviations (1.4826 times the median absolute deviation) from the median
+    along axis. nan values are outliers.
+    """
+    with np.errstate(invalid='ignore'):
+        med = np.nanmedian(values, axis=axis, keepdims=True)
+        mad = 1.4826 * np.nanmedian(abs(values - med), axis=axis,
+                                    keepdims=True)
+        return ~(abs(values - med) <= threshold * mad)
+
+
+def sk_mask(psrfits_path, start_row=0, end_row=-1, threshold=5.0,
+            mean_threshold=None, d=1, apply_scales=True, pf=None):
+    """
+    Flag RFI in a SEARCH mode file with the spectral kurtosis of each row
+    and channel.
+
+    The raw samples are read a block of rows at a time and only their
+    integer sums and sums of squares are formed, so no floating point copy
+    of the data is made. The scales and offsets are applied to these sums
+    (see `scaled_moments()`). The power polarizations (those below signpol,
+    i.e. AA and BB or I) are used, and a channel is flagged in a row if its
+    spectral kurtosis, in any of them, is more than `threshold` robust
+    standard deviations from the median over the channels of the row.
+
+    Parameters
+    ----------
+
+    psrfits_path : str
+        SEARCH mode file.
+
+    start_row, end_row : int
+        First and last (inclusive) rows to flag. Negative values count from
+        the end of the file.
+
+    threshold : float
+        Spectral kurtosis threshold, in robust standard deviations.
+
+    mean_threshold : float, optional
+        Also flag channels whose mean power is this many robust standard
+        deviations from the median of the row.
+
+    d : int
+        Number of spectra summed into each sample, for the estimator.
+
+    apply_scales : bool
+        Use DAT_SCL and DAT_OFFS. If False the statistics of the raw
+        samples are used.
+
+    pf : pdat.PyPSRFITS, optional
+        Open reader to use instead of opening `psrfits_path`. It is left
+        open; a reader opened here is closed before returning.
+
+    Returns
+    -------
+    Boolean mask with dimensions [row, chan], True for flagged channels.
+        Zero weights are `~mask`, see `psrfits.zap_channels()`.
+    """
+    close = pf is None
+    if pf is None:
+        pf = PyPSRFITS(psrfits_path)
+    try:
+        return _sk_mask(pf, start_row, end_row, threshold, mean_threshold, d,
+                        apply_scales)
+    finally:
+        if close:
+            pf.fits.close()
+
+
+def _sk_mask(pf, start_row, end_row, threshold, mean_threshold, d,
+             apply_scales):
+    """`sk_mask()` of an open reader."""
+    p = pf._search_setup(start_row, end_row, 1, 1)
+    nsblk, npol, nchan = p['nsblk'], p['npol'], p['nchan']
+    pols = np.arange(min(p['signpol'], npol))
+    nrows = p['end_row'] - p['start_row'] + 1
+    mask = np.zeros((nrows, nchan), dtype=bool)
+
+    rows_per_read = max(1, pf.read_block_bytes // pf.subhdr['NAXIS1'])
+    for irow in range(0, nrows, rows_per_read):
+        nread = min(rows_per_read, nrows - irow)
+        rows = slice(p['start_row'] + irow, p['start_row'] + irow + nread)
+        dtmp = pf._read_samples(p, rows.start, rows.stop)[:, :, pols]
+        # The power polarizations are unsigned
+        u_t = np.dtype(sample_types(p['nbit'])[1])
+        if dtmp.dtype.itemsize == u_t.itemsize:
+            dtmp = dtmp.view(u_t.newbyteorder(dtmp.dtype.byteorder))
+        s1, s2 = raw_moments(dtmp)
+        scales = offsets = None
+        if apply_scales:
+            info = pf.get_row_info(rows.start, rows.stop - 1)
+            scales = info['DAT_SCL'].reshape((nread, npol, nchan))
+            offsets = info['DAT_OFFS'].reshape((nread, npol, nchan))
+            scales = scales[:, pols].astype(np.float64)
+            offsets = offsets[:, pols].astype(np.float64)
+        p1, p2 = scaled_moments(s1, s2, nsblk, scales, offsets)
+
+        flags = robust_outliers(spectral_kurtosis(p1, p2, nsblk, d),
+                                threshold)
+        if mean_threshold is not None:
+            flags |= robust_outliers(p1 / nsblk, mean_threshold)
+        mask[irow:irow+nread] = flags.any(1)
+    return mask
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+# encoding=utf8
+"""Streaming time and frequency scrunching of SEARCH mode PSRFITS files."""
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+import os
+import time
+
+import numpy as np
+try:
+    from math import gcd
+except ImportError:
+    from fractions import gcd
+
+from .pdat import psrfits
+from .pypsrfits import PyPSRFITS, downsample_freqs
+
+# Approximate size in bytes of the decoded input rows held at a time.
+scrunch_chunk_bytes = 64 * 1024 * 1024
+
+# SUBINT columns that are recomputed for the scrunched rows, rather than
+# copied from the input row each output row starts in.
+_scrunched_columns = ['TSUBINT', 'OFFS_SUB', 'DAT_FREQ', 'DAT_WTS',
+                      'DAT_OFFS', 'DAT_SCL', 'DATA']
+
+
+def scrunch_psrfits(path, out_path, tscrunch=1, fscrunch=1, nsblk=None,
+                    nbits=None, method='minmax', percentiles=(0.5, 99.5),
+                    chunk_rows=None, clobber=False, verbose=True):
+    """
+    Write a time and/or frequency scrunched copy of a SEARCH mode PSRFITS
+    file.
+
+    The input is decoded a block of rows at a time, averaged over
+    `tscrunch` samples and `fscrunch` channels, requantized and streamed
+    into the SUBINT table of the new file, so memory use does not depend on
+    the size of the file. Time bins run across row boundaries, so
+    `tscrunch` does not have to divide NSBLK. NSBLK, NCHAN, TBIN, CHAN_BW,
+    NBITS, DAT_FREQ and DAT_WTS are updated, OFFS_SUB and TSUBINT are set
+    for the new rows, and the other SUBINT columns are taken from the input
+    row each new row starts in. All the other HDUs are copied unchanged.
+
+    Samples (channels) left over at the end of the file (band) that do not
+    fill a whole scrunched row (channel) are dropped.
+
+    Parameters
+    ----------
+
+    path : str
+        Input SEARCH mode file.
+
+    out_path : str
+        Path of the scrunched file.
+
+    tscrunch, fscrunch : int
+        Number of samples and channels averaged together.
+
+    nsblk : int, optional
+        NSBLK of the output. Default is NSBLK // tscrunch of the input, or 1.
+
+    nbits : int, {1, 2, 4, 8, 16}, optional
+        NBITS of the output. Default is NBITS of the input, or 8 for
+        floating point input.
+
+    method, percentiles :
+        How the scales and offsets of the new rows are chosen, see
+        `psrfits.quantize_subint_data()`.
+
+    chunk_rows : int, optional
+        Number of input rows decoded at a time. Default is as many as fit in
+        `scrunch_chunk_bytes` once decoded.
+
+    clobber : bool
+        Overwrite `out_path` if it exists.
+
+    verbose : bool
+        Print a summary of the scrunch.
+
+    Returns
+    -------
+    Dictionary with the number of input and output 'rows', the 'seconds'
+        taken and the throughput of input data in 'MB/s'.
+    """
+    if tscrunch < 1 or fscrunch < 1:
+        raise ValueError('tscrunch and fscrunch must be at least 1.')
+    if os.path.exists(out_path):
+        if not clobber:
+            raise ValueError('{0} already exists. Set clobber=True to '
+                             'overwrite it.'.format(out_path))
+        os.remove(out_path)
+
+    start = time.time()
+    pf = PyPSRFITS(path)
+    try:
+        nrows = _scrunch_file(pf, path, out_path, tscrunch, fscrunch, nsblk,
+                              nbits, method, percentiles, chunk_rows)
+    finally:
+        pf.fits.close()
+
+    nrows_in = pf.subhdr['NAXIS2']
+    stats = {'rows': nrows_in, 'rows_out': nrows,
+             'seconds': time.time() - start}
+    nbytes = nrows_in * pf.subhdr['NAXIS1']
+    stats['MB/s'] = (nbytes / 1e6 / stats['seconds']
+                     if stats['seconds'] > 0 else float('inf'))
+    if verbose:
+        print('Scrunched {0} rows of \'{1}\' by {2} in time and {3} in '
+              'frequency into {4} rows of \'{5}\' in {6:.2f} s '
+              '({7:.1f} MB/s).'.format(nrows_in, path, tscrunch, fscrunch,
+                                       nrows, out_path, stats['seconds'],
+                                       stats['MB/s']))
+    return stats
+
+
+def _scrunch_file(pf, path, out_path, tscrunch, fscrunch, nsblk, nbits,
+                  method, percentiles, chunk_rows):
+    """
+    Write the scrunched copy of the file open in `pf`, see
+    `scrunch_psrfits()`. Returns the number of rows written.
+    """
+    subhdr = pf.subhdr
+    nrows_in = subhdr['NAXIS2']
+    nsblk_in, npol = subhdr['NSBLK'], subhdr['NPOL']
+    nchan_in = subhdr['NCHAN']
+    if fscrunch > nchan_in:
+        raise ValueError('fscrunch ({0}) is larger than NCHAN '
+                         '({1}).'.format(fscrunch, nchan_in))
+    nchan = nchan_in // fscrunch
+    if nsblk is None:
+        nsblk = max(1, nsblk_in // tscrunch)
+    if nbits is None:
+        nbits = subhdr['NBITS'] if subhdr['NBITS'] <= 16 else 8
+    nrows = nrows_in * nsblk_in // tscrunch // nsblk
+    if nrows == 0:
+        raise ValueError('{0} has too few samples for one row of {1} '
+                         'scrunched samples.'.format(path, nsblk))
+    tbin = subhdr['TBIN'] * tscrunch
+
+    # A one-off template, kept out of the process-wide template cache
+    out = psrfits(out_path, from_template=path, verbose=False, cache=False)
+    out.set_subint_dims(nbin=1, nchan=nchan, npol=npol, nsblk=nsblk,
+                        nsubint=nrows, nbits=nbits)
+    out.set_draft_header('SUBINT', {'TBIN': tbin,
+                                    'CHAN_BW': subhdr['CHAN_BW']*fscrunch})
+    for ext_name in out.draft_hdr_keys[1:]:
+        if ext_name != 'SUBINT':
+            out.copy_template_BinTable(ext_name, share=True)
+
+    # Small per-row columns of the input, used to fill in the new rows.
+    # They are read for the input rows of each chunk as it is written.
+    names = [dt[0] for dt in out.subint_dtype]
+    columns = [name for name in names if name != 'DATA']
+    first_row = pf.fits['SUBINT'].read(columns=['OFFS_SUB', 'TSUBINT'],
+                                       rows=[0])
+    t_start = first_row['OFFS_SUB'][0] - first_row['TSUBINT'][0] / 2
+
+    if chunk_rows is None:
+        row_bytes = 4 * nsblk_in * npol * nchan
+        chunk_rows = max(1, scrunch_chunk_bytes // row_bytes)
+    out_rows = max(1, chunk_rows * nsblk_in // tscrunch // nsblk)
+
+    out.begin_subint_stream()
+    try:
+        row = 0
+        for spectra in _scrunched_rows(pf, tscrunch, fscrunch, nsblk,
+                                       chunk_rows, out_rows):
+            nnew = min(len(spectra), nrows - row)
+            if nnew <= 0:
+                break
+            table = out.make_HDU_rec_array(nnew, out.subint_dtype)
+            # Input row that each new row starts in
+            first = (row + np.arange(nnew)) * nsblk * tscrunch // nsblk_in
+            in_rows, first = np.unique(first, return_inverse=True)
+            info = pf.fits['SUBINT'].read(columns=columns, rows=in_rows)
+            for name in names:
+                if name not in _scrunched_columns:
+                    table[name] = info[name][first]
+            table['TSUBINT'] = nsblk * tbin
+            table['OFFS_SUB'] = t_start + (row + np.arange(nnew) + 0.5) * \
+                nsblk * tbin
+            table['DAT_FREQ'] = downsample_freqs(info['DAT_FREQ'][first],
+                                                 fscrunch)
+            table['DAT_WTS'] = downsample_freqs(info['DAT_WTS'][first],
+                                                fscrunch)
+            out.quantize_subint_data(spectra[:nnew], method=method,
+                                     percentiles=percentiles, table=table)
+            out.append_subint_array(table)
+            row += nnew
+        out.end_subint_stream()
+    finally:
+        out.close()
+        if out._fits_template is not None:
+            out.fits_template.close()
+    return nrows
+
+
+def _scrunched_rows(pf, tscrunch, fscrunch, nsblk, chunk_rows, out_rows):
+    """
+    Yield blocks of up to `out_rows` rows of `nsblk` scrunched spectra,
+    with dimensions [row, time, poln, chan], decoding `chunk_rows` input
+    rows at a time. Samples that do not fill a time bin, or a row, are
+    carried over into the next block, so bins run across row boundaries.
+    """
+    # Average as much as possible while decoding. The mean of equal sized
+    # means is the mean of the whole bin.
+    downsamp = gcd(tscrunch, pf.subhdr['NSBLK'])
+    tscrunch = tscrunch // downsamp
+    carry = None
+    pending = []
+    npending = 0
+    for data, _, _ in pf.iter_blocks(chunk_rows, downsamp=downsamp,
+                                     fdownsamp=fscrunch):
+        if carry is not None:
+            data = np.concatenate([carry, data])
+        nfull = len(data) // tscrunch * tscrunch
+        # iter_blocks reuses its buffers, so keep a copy of what is left
+        carry = data[nfull:].copy()
+        if tscrunch > 1:
+            spectra = data[:nfull].reshape((-1, tscrunch) + data.shape[1:])
+            spectra = spectra.mean(1, dtype=np.float64).astype(np.float32)
+        else:
+            spectra = data[:nfull].copy()
+        pending.append(spectra)
+        npending += len(spectra)
+        while npending >= nsblk:
+            spectra = np.concatenate(pending)
+            nrows = min(out_rows, len(spectra) // nsblk)
+            yield spectra[:nrows*nsblk].reshape((nrows, nsblk) +
+                                                spectra.shape[1:])
+            pending = [spectra[nrows*nsblk:]]
+            npending = len(pending[0])
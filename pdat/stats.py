@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+# encoding=utf8
+"""One-pass bandpass and statistics accumulation for SEARCH mode data."""
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+import numpy as np
+
+
+def merge_moments(count_a, mean_a, m2_a, count_b, mean_b, m2_b):
+    """
+    Combine the count, mean and sum of squared deviations from the mean (M2)
+    of two sets of samples, following Chan, Golub & LeVeque (1979). Returns
+    (count, mean, m2) of the union. Works elementwise on arrays, and sets
+    with a count of zero are ignored.
+    """
+    count = count_a + count_b
+    with np.errstate(invalid='ignore', divide='ignore'):
+        frac = np.where(count > 0, count_b / np.maximum(count, 1), 0)
+    delta = mean_b - mean_a
+    mean = mean_a + delta * frac
+    m2 = m2_a + m2_b + delta**2 * count_a * frac
+    return count, mean, m2
+
+
+class StreamStats(object):
+    """
+    Running statistics of decoded search mode data, updated one block of
+    spectra at a time in a single pass.
+
+    For each polarization and channel the count, mean, variance, minimum
+    and maximum of the samples are kept. For each subint (row) the mean and
+    variance of each polarization over time and channel are kept, and the
+    mean over channels of each spectrum gives the zero-DM time series. Block
+    moments are merged with the numerically stable pairwise update of
+    Chan et al., so accumulators filled from different parts of a file, e.g.
+    by separate processes, can be combined with `merge()`.
+
+    Pass one as `stats=` to `PyPSRFITS.get_data()` or `iter_blocks()` to
+    collect the statistics of whatever is decoded, e.g.
+
+        stats = pdat.StreamStats()
+        for data, t, f in pf.iter_blocks(32, stats=stats):
+            ...
+        bandpass = stats.mean
+    """
+    def __init__(self):
+        self.count = None
+        self._mean = None
+        self._m2 = None
+        self.min = None
+        self.max = None
+        # Per-subint (count, mean, M2) and zero-DM series, keyed by row
+        self._rows = {}
+        self._zero_dm = {}
+        self.next_row = 0
+
+    def update(self, data, row0=None, nrows=1):
+        """
+        Add a block of spectra with dimensions [time, poln, chan].
+
+        Parameters
+        ----------
+
+        data : array
+            The block, holding `nrows` whole subints.
+
+        row0 : int, optional
+            Row (subint) index of the start of the block. Default is the row
+            after the last one added.
+
+        nrows : int
+            Number of subints in the block.
+        """
+        data = np.asarray(data)
+        if data.ndim != 3:
+            raise ValueError('Blocks must have dimensions '
+                             '[time, poln, chan].')
+        if len(data) == 0:
+            return
+        if len(data) % nrows:
+            raise ValueError('A block of {0} spectra can not hold {1} whole '
+                             'subints.'.format(len(data), nrows))
+        if row0 is None:
+            row0 = self.next_row
+        nsamp, npol, nchan = data.shape
+
+        mean = data.mean(0, dtype=np.float64)
+        m2 = ((data - mean)**2).sum(0)
+        lo = data.min(0)
+        hi = data.max(0)
+        if self.count is None:
+            self.count = np.zeros((npol, nchan), dtype=np.int64)
+            self._mean = np.zeros((npol, nchan))
+            self._m2 = np.zeros((npol, nchan))
+            self.min = lo
+            self.max = hi
+        elif self.count.shape != (npol, nchan):
+            raise ValueError('Blocks have {0} polarizations and channels, '
+                             'not {1}.'.format((npol, nchan),
+                                               self.count.shape))
+        else:
+            self.min = np.minimum(self.min, lo)
+            self.max = np.maximum(self.max, hi)
+        self.count, self._mean, self._m2 = merge_moments(
+            self.count, self._mean, self._m2, nsamp, mean, m2)
+
+        # Each subint's moments, from the per-channel moments of its samples
+        rows = data.reshape((nrows, nsamp // nrows, npol, nchan))
+        zero_dm = rows.mean(3, dtype=np.float64)
+        row_mean = zero_dm.mean(1)
+        row_m2 = ((rows - row_mean[:, np.newaxis, :, np.newaxis])**2
+                  ).sum((1, 3))
+        row_count = nsamp // nrows * nchan
+        for ii in range(nrows):
+            self._rows[row0 + ii] = (row_count, row_mean[ii], row_m2[ii])
+            self._zero_dm[row0 + ii] = zero_dm[ii].astype(np.float32)
+        self.next_row = max(self.next_row, row0 + nrows)
+
+    def merge(self, other):
+        """Add the statistics accumulated by another StreamStats to this
+        one, in place. Returns self."""
+        if other.count is None:
+            return self
+        if self.count is None:
+            self.count = other.count.copy()
+            self._mean = other._mean.copy()
+            self._m2 = other._m2.copy()
+            self.min = other.min.copy()
+            self.max = other.max.copy()
+        else:
+            self.count, self._mean, self._m2 = merge_moments(
+                self.count, self._mean, self._m2,
+                other.count, other._mean, other._m2)
+            self.min = np.minimum(self.min, other.min)
+            self.max = np.maximum(self.max, other.max)
+        for row, moments in other._rows.items():
+            if row in self._rows:
+                # The same subint seen twice, e.g. other channels of it
+                count_a, count_b = self._rows[row][0], moments[0]
+                self._zero_dm[row] = ((self._zero_dm[row] * count_a
+                                       + other._zero_dm[row] * count_b)
+                                      / (count_a + count_b)).astype(
+                                          np.float32)
+                self._rows[row] = merge_moments(*(self._rows[row] + moments))
+            else:
+                self._rows[row] = moments
+                self._zero_dm[row] = other._zero_dm[row]
+        self.next_row = max(self.next_row, other.next_row)
+        return self
+
+    @property
+    def mean(self):
+        """Mean of each polarization and channel, [poln, chan]."""
+        return self._mean
+
+    @property
+    def var(self):
+        """Variance of each polarization and channel, [poln, chan]."""
+        if self.count is None:
+            return None
+        return self._m2 / np.maximum(self.count, 1)
+
+    @property
+    def std(self):
+        """Standard deviation of each polarization and channel."""
+        if self.count is None:
+            return None
+        return np.sqrt(self.var)
+
+    @property
+    def rows(self):
+        """Row (subint) indices seen, in order."""
+        return np.array(sorted(self._rows), dtype=int)
+
+    @property
+    def subint_mean(self):
+        """Mean of each polarization of each subint, [row, poln]."""
+        return np.array([self._rows[row][1] for row in sorted(self._rows)])
+
+    @property
+    def subint_var(self):
+        """Variance of each polarization of each subint, [row, poln]."""
+        return np.array([self._rows[row][2] / self._rows[row][0]
+                         for row in sorted(self._rows)])
+
+    @property
+    def zero_dm(self):
+        """Zero-DM time series (mean over channels of each spectrum) of each
+        polarization in row order, [time, poln]."""
+        if not self._zero_dm:
+            return None
+        return np.concatenate([self._zero_dm[row]
+                               for row in sorted(self._zero_dm)])
+
+    def summary(self):
+        """Dictionary of all of the statistics."""
+        return {'count': self.count, 'mean': self.mean, 'var': self.var,
+                'std': self.std, 'min': self.min, 'max': self.max,
+                'rows': self.rows, 'subint_mean': self.subint_mean,
+                'subint_var': self.subint_var, 'zero_dm': self.zero_dm}
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+"""Shared fixtures for the `PulsarDataToolbox` tests."""
+
+import numpy as np
+import fitsio
+import pytest
+
+
+def write_search_file(path, nrows=4, nsblk=16, npol=2, nchan=8, nbits=8,
+                      poltype='AABBCRCI', tbin=1e-3, seed=0):
+    """
+    Write a small synthetic SEARCH mode PSRFITS file with random data and
+    return the SUBINT table that was written.
+    """
+    rng = np.random.RandomState(seed)
+    if nbits == 8:
+        data_dtype = ('DATA', 'u1', (nsblk, npol, nchan, 1))
+    elif nbits == 16:
+        data_dtype = ('DATA', '>i2', (nsblk, npol, nchan, 1))
+    elif nbits == 32:
+        data_dtype = ('DATA', '>f4', (nsblk, npol, nchan, 1))
+    else:
+        data_dtype = ('DATA', 'u1', (nsblk*npol*nchan*nbits//8,))
+    dtype = [('TSUBINT', '>f8'), ('OFFS_SUB', '>f8'), ('LST_SUB', '>f8'),
+             ('RA_SUB', '>f8'), ('DEC_SUB', '>f8'), ('GLON_SUB', '>f8'),
+             ('GLAT_SUB', '>f8'), ('FD_ANG', '>f4'), ('POS_ANG', '>f4'),
+             ('PAR_ANG', '>f4'), ('TEL_AZ', '>f4'), ('TEL_ZEN', '>f4'),
+             ('DAT_FREQ', '>f4', (nchan,)), ('DAT_WTS', '>f4', (nchan,)),
+             ('DAT_OFFS', '>f4', (nchan*npol,)),
+             ('DAT_SCL', '>f4', (nchan*npol,)), data_dtype]
+    subint = np.zeros(nrows, dtype=dtype)
+    subint['TSUBINT'] = nsblk * tbin
+    subint['OFFS_SUB'] = (np.arange(nrows) + 0.5) * nsblk * tbin
+    subint['LST_SUB'] = np.arange(nrows)
+    subint['DAT_FREQ'] = np.linspace(1500, 1300, nchan)
+    subint['DAT_WTS'] = 1
+    subint['DAT_OFFS'] = rng.randn(nrows, nchan*npol)
+    subint['DAT_SCL'] = rng.rand(nrows, nchan*npol) + 0.5
+    if nbits == 32:
+        subint['DATA'] = rng.randn(*subint['DATA'].shape)
+    elif nbits == 16:
+        subint['DATA'] = rng.randint(-2**15, 2**15, subint['DATA'].shape)
+    else:
+        subint['DATA'] = rng.randint(0, 256, subint['DATA'].shape)
+
+    primary = [{'name': 'OBS_MODE', 'value': 'SEARCH'},
+               {'name': 'SRC_NAME', 'value': 'J1234+5678'},
+               {'name': 'OBSFREQ', 'value': 1400.0},
+               {'name': 'OBSBW', 'value': -200.0},
+               {'name': 'OBSNCHAN', 'value': nchan},
+               {'name': 'STT_IMJD', 'value': 58000},
+               {'name': 'STT_SMJD', 'value': 100},
+               {'name': 'STT_OFFS', 'value': 0.0}]
+    subhdr = [{'name': 'NPOL', 'value': npol},
+              {'name': 'POL_TYPE', 'value': poltype},
+              {'name': 'TBIN', 'value': tbin},
+              {'name': 'NBIN', 'value': 1},
+              {'name': 'NBITS', 'value': nbits},
+              {'name': 'NCHAN', 'value': nchan},
+              {'name': 'CHAN_BW', 'value': -200.0/nchan},
+              {'name': 'NSBLK', 'value': nsblk}]
+    history = np.zeros(1, dtype=[('DATE_PRO', 'S24'), ('PROC_CMD', 'S80'),
+                                 ('NSUB', '>i4'), ('NPOL', '>i2'),
+                                 ('NCHAN', '>i4')])
+    history['PROC_CMD'] = 'synthetic'
+    with fitsio.FITS(path, 'rw', clobber=True) as fits:
+        fits.write(None, header=primary)
+        fits.write_table(history, extname='HISTORY')
+        fits.write_table(subint, extname='SUBINT', header=subhdr)
+    return subint
+
+
+@pytest.fixture
+def search_file(tmpdir):
+    """Factory fixture writing synthetic SEARCH mode files into tmpdir."""
+    def _make(name='search.fits', **kwargs):
+        path = str(tmpdir.join(name))
+        write_search_file(path, **kwargs)
+        return path
+    return _make
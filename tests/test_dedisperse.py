@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the streaming dedispersion in `pdat.dedisperse`."""
+
+import numpy as np
+import pytest
+
+import pdat
+from pdat.dedisperse import dispersion_delay
+
+
+def dedisperse_reference(data, delays):
+    """Dedisperse a whole [time, chan] array, one DM and channel at a
+    time."""
+    nout = len(data) - delays.max()
+    out = np.zeros((len(delays), nout))
+    for idm in range(len(delays)):
+        for chan in range(data.shape[1]):
+            shift = delays[idm, chan]
+            out[idm] += data[shift:shift+nout, chan]
+    return out
+
+
+@pytest.mark.parametrize('block', [1, 7, 50, 1000])
+@pytest.mark.parametrize('workers', [1, 3])
+def test_dedisperser_blocks(block, workers):
+    rng = np.random.RandomState(0)
+    freqs = np.linspace(1500, 1300, 16)
+    data = rng.randn(300, 16).astype(np.float32)
+    dd = pdat.Dedisperser([0, 10, 25.5, 40], freqs, 1e-3, workers=workers)
+    assert dd.delays[0].max() == 0 and dd.delays[:, 0].max() == 0
+    series = np.concatenate([dd.push(data[ii:ii+block])
+                             for ii in range(0, len(data), block)], axis=1)
+    dd.close()
+    expected = dedisperse_reference(data, dd.delays)
+    assert series.shape == expected.shape == (4, 300 - dd.max_delay)
+    assert np.allclose(series, expected, atol=1e-4)
+
+
+def test_dedisperser_finds_pulse():
+    freqs = np.linspace(1500, 1300, 32)
+    tbin = 1e-3
+    data = np.zeros((400, 32), dtype=np.float32)
+    arrival = 50 + np.rint(dispersion_delay(30, freqs, freqs.max()) / tbin)
+    data[arrival.astype(int), np.arange(32)] = 1
+    dd = pdat.Dedisperser(np.arange(0, 60, 5.), freqs, tbin)
+    series = dd.push(data)
+    assert np.unravel_index(series.argmax(), series.shape) == (6, 50)
+    assert series.max() == 32
+    with pytest.raises(ValueError):
+        dd.push(data[:, :4])
+    with pytest.raises(ValueError):
+        pdat.Dedisperser([10], freqs, tbin, ref_freq=1400)
+
+
+def test_dedisperse_psrfits(search_file, tmpdir):
+    path = search_file(nrows=6, npol=4, poltype='AABBCRCI', nchan=16)
+    dms = [0, 20, 50]
+    pf = pdat.PyPSRFITS(path)
+    data = pf.get_data(0, -1, downsamp=2, fdownsamp=2)
+    intensity = data[:, 0] + data[:, 1]
+    freqs = pf.get_data(0, 0, fdownsamp=2, get_ft=True)[2]
+    delays = pdat.Dedisperser(dms, freqs, 2e-3).delays
+    expected = dedisperse_reference(intensity, delays)
+
+    out_path = str(tmpdir.join('series.npy'))
+    series = pdat.dedisperse_psrfits(path, dms, out_path=out_path,
+                                     rows_per_block=2, downsamp=2,
+                                     fdownsamp=2, workers=2)
+    assert np.allclose(series, expected, atol=1e-3)
+    assert np.allclose(np.load(out_path), expected, atol=1e-3)
+    with pytest.raises(ValueError):
+        pdat.dedisperse_psrfits(path, [5000])
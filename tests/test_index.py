@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the PSRFITS metadata index in `pdat.index`."""
+
+import os
+
+import numpy as np
+import fitsio
+
+import pdat
+
+
+def test_scan_query_refresh(search_file, tmpdir):
+    paths = [search_file('a.fits'), search_file('b.fits', nchan=16)]
+    with fitsio.FITS(paths[1], 'rw') as fits:
+        fits[0].write_key('SRC_NAME', 'B1937+21')
+        fits[0].write_key('OBSFREQ', 800.0)
+        fits[0].write_key('STT_IMJD', 58010)
+
+    index = pdat.PSRFITSIndex(str(tmpdir.join('index.db')))
+    assert index.scan(str(tmpdir)) == 2
+    assert len(index) == 2
+    assert index.scan(paths) == 0
+
+    assert index.query(source='J1234+5678') == [os.path.abspath(paths[0])]
+    assert index.query(source='B1937%') == [os.path.abspath(paths[1])]
+    assert index.query(freq_range=(650, 750)) == [os.path.abspath(paths[1])]
+    assert index.query(mjd_range=(58000, 58000.1)) == \
+        [os.path.abspath(paths[0])]
+    info = index.get_info(paths[1])
+    assert info['nchan'] == 16 and info['nsubint'] == 4
+    assert np.isclose(info['mjd_end'] - info['mjd_start'], 4*16e-3/86400)
+
+    # Changed files are re-read and deleted ones dropped
+    search_file('a.fits', nrows=6)
+    os.remove(paths[1])
+    assert index.get_headers(paths[0]) is None
+    assert index.refresh() == 1
+    assert len(index) == 1
+    assert index.get_info(paths[0])['nsubint'] == 6
+    index.close()
+
+
+def test_index_headers_reused(search_file, tmpdir):
+    path = search_file()
+    index = pdat.PSRFITSIndex(str(tmpdir.join('index.db')))
+    index.scan([path], workers=2)
+    headers = index.get_headers(path)
+    assert list(headers.keys()) == ['PRIMARY', 'HISTORY', 'SUBINT']
+    assert headers['SUBINT']['NSBLK'] == 16
+
+    pf = pdat.PyPSRFITS(path, index=index)
+    ref = pdat.PyPSRFITS(path)
+    assert pf.subhdr['NCHAN'] == 8
+    assert np.array_equal(pf.get_data(0, -1), ref.get_data(0, -1))
+    pf.fits.close()
+    ref.fits.close()
+
+    psrf = pdat.psrfits(path, mode='rw', verbose=False, index=index)
+    assert psrf.draft_hdr_keys == ['PRIMARY', 'HISTORY', 'SUBINT']
+    assert psrf.draft_hdrs['PRIMARY']['OBS_MODE'] == 'SEARCH'
+    assert psrf.draft_hdrs['SUBINT'].records() == \
+        psrf['SUBINT'].read_header().records()
+
+
+def test_scan_skips_unreadable_files(search_file, tmpdir, monkeypatch):
+    good = search_file('good.fits')
+    bad = str(tmpdir.join('bad.fits'))
+    with open(bad, 'wb') as f:
+        f.write(b'not a FITS file')
+    index = pdat.PSRFITSIndex(str(tmpdir.join('index.db')), verbose=False)
+    assert index.scan([good, bad]) == 1
+
+    # Exceptions whose constructors need more than a message
+    def fail(path, mode):
+        raise UnicodeDecodeError('ascii', b'\xff', 0, 1, 'bad byte')
+    monkeypatch.setattr(pdat.index.F, 'FITS', fail)
+    result = pdat.index._scan_file(good)
+    assert isinstance(result, IOError) and good in str(result)
+    assert index.scan(good, force=True) == 0
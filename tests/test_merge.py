@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `pdat.merge`."""
+
+import threading
+
+import numpy as np
+import fitsio
+import pytest
+
+import pdat
+from pdat.merge import dedupe_rows, _prefetch
+
+
+@pytest.mark.parametrize('threads', [False, True])
+def test_merge_psrfits(search_file, tmpdir, threads):
+    paths = [search_file('s{0}.fits'.format(ii), nrows=nrows, seed=ii)
+             for ii, nrows in enumerate([3, 5, 2])]
+    # Second file starts 10 s after the first
+    with fitsio.FITS(paths[1], 'rw') as fits:
+        fits[0].write_key('STT_SMJD', 110)
+    out = str(tmpdir.join('merged.fits'))
+    stats = pdat.merge_psrfits(paths, out, chunk_rows=2, threads=threads,
+                               verbose=False)
+    assert stats['rows'] == 10 and stats['bytes'] > 0
+
+    rows = [fitsio.read(path, ext='SUBINT') for path in paths]
+    rows[1]['OFFS_SUB'] += 10
+    with fitsio.FITS(out) as fits:
+        assert [hdu.get_extname() for hdu in fits[1:]] == ['HISTORY',
+                                                           'SUBINT']
+        assert fits[0].read_header()['SRC_NAME'] == 'J1234+5678'
+        hdr = fits['SUBINT'].read_header()
+        assert hdr['NAXIS2'] == 10 and hdr['NSBLK'] == 16
+        assert hdr['TDIM17'] == '(1,8,2,16)'
+        assert np.array_equal(fits['SUBINT'].read(), np.concatenate(rows))
+        # HISTORY is concatenated by default
+        assert fits['HISTORY'].get_nrows() == 3
+
+
+def test_merge_ancillary_policies(search_file, tmpdir):
+    paths = [search_file('s{0}.fits'.format(ii)) for ii in range(3)]
+    out = str(tmpdir.join('merged.fits'))
+    pdat.merge_psrfits(paths, out, ancillary='first', verbose=False)
+    assert fitsio.read(out, ext='HISTORY').size == 1
+    pdat.merge_psrfits(paths, out, ancillary={'HISTORY': 'dedupe'},
+                       clobber=True, verbose=False)
+    assert fitsio.read(out, ext='HISTORY').size == 1
+    with pytest.raises(ValueError):
+        pdat.merge_psrfits(paths, out, verbose=False)
+    with pytest.raises(ValueError):
+        pdat.merge_psrfits(paths, out, ancillary='all', clobber=True,
+                           verbose=False)
+
+
+def test_merge_checks_inputs(search_file, tmpdir):
+    paths = [search_file('a.fits'), search_file('b.fits', nchan=16)]
+    with pytest.raises(ValueError) as err:
+        pdat.merge_psrfits(paths, str(tmpdir.join('out.fits')),
+                           verbose=False)
+    assert 'NCHAN' in str(err.value)
+
+
+def test_dedupe_rows():
+    rows = np.zeros(5, dtype=[('A', 'i4'), ('B', 'S4')])
+    rows['A'] = [3, 1, 3, 2, 1]
+    rows['B'] = [b'x', b'y', b'x', b'z', b'w']
+    assert dedupe_rows(rows)['A'].tolist() == [3, 1, 2, 1]
+
+
+def test_prefetch_stops_when_consumer_stops():
+    closed = threading.Event()
+
+    def blocks():
+        try:
+            for ii in range(100):
+                yield ii
+        finally:
+            closed.set()
+
+    assert list(_prefetch(blocks())) == list(range(100))
+    assert closed.is_set()
+
+    # The reader is blocked on a full queue when the consumer gives up
+    for stop_early in ['close', 'raise']:
+        closed.clear()
+        prefetched = _prefetch(blocks(), depth=1)
+        assert next(prefetched) == 0
+        if stop_early == 'close':
+            prefetched.close()
+        else:
+            with pytest.raises(ZeroDivisionError):
+                prefetched.throw(ZeroDivisionError)
+        # The reader thread has been joined, so it has closed the generator
+        assert closed.is_set()
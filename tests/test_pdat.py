@@ -0,0 +1,463 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for writing PSRFITS files with `pdat.psrfits`."""
+
+import os
+
+import numpy as np
+import fitsio
+import pytest
+
+import pdat
+
+
+def bytes_written():
+    """Bytes written by this process so far, from /proc/self/io."""
+    with open('/proc/self/io') as io:
+        for line in io:
+            if line.startswith('wchar'):
+                return int(line.split()[1])
+
+
+def test_write_psrfits_from_template(search_file, tmpdir):
+    template = search_file(nrows=5)
+    path = str(tmpdir.join('copy.fits'))
+    psrf = pdat.psrfits(path, from_template=template, verbose=False)
+    for ext_name in psrf.draft_hdr_keys[1:]:
+        psrf.copy_template_BinTable(ext_name)
+    psrf.write_psrfits()
+    psrf.close()
+
+    with fitsio.FITS(path) as new, fitsio.FITS(template) as old:
+        assert new[0].read_header()['OBS_MODE'] == 'SEARCH'
+        assert np.array_equal(new['SUBINT'].read(), old['SUBINT'].read())
+        assert np.array_equal(new['HISTORY'].read(), old['HISTORY'].read())
+
+
+@pytest.mark.skipif(not os.path.exists('/proc/self/io'),
+                    reason='needs /proc/self/io to count bytes written')
+def test_write_psrfits_writes_data_once(search_file, tmpdir):
+    # 64 MB SUBINT table with far more header cards than fit in the default
+    # header, so growing the header after the data would move the table.
+    template = search_file('template.fits', nrows=2, nsblk=2048, nchan=1024,
+                           npol=1)
+    with fitsio.FITS(template, 'rw') as fits:
+        for ii in range(80):
+            fits['SUBINT'].write_key('XKEY{0}'.format(ii), float(ii),
+                                     comment='padding card')
+    path = str(tmpdir.join('big.fits'))
+    psrf = pdat.psrfits(path, from_template=template, verbose=False)
+    for ext_name in psrf.draft_hdr_keys[1:]:
+        psrf.copy_template_BinTable(ext_name)
+    psrf.HDU_drafts['SUBINT'] = np.repeat(psrf.HDU_drafts['SUBINT'], 16)
+    psrf.set_draft_header('SUBINT', {'NAXIS2': 32})
+
+    start = bytes_written()
+    psrf.write_psrfits()
+    psrf.close()
+    nbytes = bytes_written() - start
+    assert nbytes < 1.05 * os.path.getsize(path)
+
+    hdr = fitsio.read_header(path, ext='SUBINT')
+    assert hdr['NAXIS2'] == 32 and hdr['XKEY79'] == 79.0
+    assert hdr['TDIM17'] == '(1,1024,1,2048)'
+
+
+def test_subint_stream(search_file, tmpdir):
+    template = search_file(nrows=7)
+    rows = fitsio.read(template, ext='SUBINT')
+    path = str(tmpdir.join('stream.fits'))
+    psrf = pdat.psrfits(path, from_template=template, verbose=False)
+    psrf.copy_template_BinTable('HISTORY')
+    psrf.begin_subint_stream()
+    with pytest.raises(ValueError):
+        psrf.begin_subint_stream()
+    for start in range(0, 7, 3):
+        chunk = psrf.make_HDU_rec_array(len(rows[start:start+3]),
+                                        psrf.subint_dtype)
+        for col in chunk.dtype.names:
+            chunk[col] = rows[col][start:start+3]
+        nwritten = psrf.append_subint_array(chunk)
+    assert nwritten == 7
+    with pytest.raises(ValueError):
+        psrf.append_subint_array(rows[['TSUBINT', 'DATA']])
+    psrf.end_subint_stream()
+    assert psrf.written
+    assert psrf.draft_hdrs['SUBINT']['NAXIS2'] == 7
+    psrf.close()
+
+    with fitsio.FITS(path) as new:
+        assert [hdu.get_extname() for hdu in new[1:]] == ['HISTORY', 'SUBINT']
+        hdr = new['SUBINT'].read_header()
+        assert hdr['NAXIS2'] == 7 and hdr['NSBLK'] == 16
+        assert np.array_equal(new['SUBINT'].read(), rows)
+    pf = pdat.PyPSRFITS(path)
+    assert np.array_equal(pf.get_data(0, -1),
+                          pdat.PyPSRFITS(template).get_data(0, -1))
+
+
+def test_subint_stream_errors(search_file, tmpdir):
+    template = search_file()
+    psrf = pdat.psrfits(str(tmpdir.join('x.fits')), from_template=template,
+                        verbose=False)
+    with pytest.raises(ValueError):
+        psrf.append_subint_array(fitsio.read(template, ext='SUBINT'))
+    with pytest.raises(ValueError):
+        psrf.end_subint_stream()
+    # HISTORY comes before SUBINT so its draft is needed to start
+    with pytest.raises(ValueError):
+        psrf.begin_subint_stream()
+
+
+def test_draft_header_update_values(search_file, tmpdir):
+    template = search_file()
+    psrf = pdat.psrfits(str(tmpdir.join('x.fits')), from_template=template,
+                        verbose=False)
+    hdr = psrf.draft_hdrs['SUBINT']
+    assert isinstance(hdr, pdat.pdat.DraftHeader)
+    psrf.set_draft_header('SUBINT', {'TBIN': 2.5e-5, 'CHAN_BW': -12,
+                                     'NCHAN': '64', 'POL_TYPE': 'AA+BB',
+                                     'TDIM17': '(1, 64, 2, 16)'})
+    assert hdr['TBIN'] == 2.5e-5 and hdr['CHAN_BW'] == -12.0
+    assert isinstance(hdr['CHAN_BW'], float) and hdr['NCHAN'] == 64
+    assert hdr['POL_TYPE'] == 'AA+BB' and hdr['TDIM17'] == '(1,64,2,16)'
+    assert hdr.card('TBIN')['card_string'].startswith(
+        'TBIN    =              2.5E-05')
+    assert hdr.card('NAXIS1')['comment'] == 'width of table in bytes'
+    assert hdr.keys() == fitsio.read_header(template, ext='SUBINT').keys()
+    with pytest.raises(ValueError):
+        psrf.set_draft_header('SUBINT', {'NOT_A_KEY': 1})
+    for bad in [np.nan, np.inf]:
+        with pytest.raises(ValueError):
+            psrf.set_draft_header('SUBINT', {'TBIN': bad})
+
+
+def test_draft_header_public_api(search_file):
+    # DraftHeader keeps its own card index on top of FITSHDR.add_record(),
+    # records() and delete(), so this fails if fitsio changes how those
+    # replace, append or remove cards.
+    header = fitsio.read_header(search_file(), ext='SUBINT')
+    hdr = pdat.pdat.DraftHeader(header)
+    names = [record['name'] for record in hdr.records()]
+    assert hdr.keys() == header.keys() == names
+    hdr.set_value('NCHAN', 16)
+    assert hdr.keys() == names and hdr['NCHAN'] == 16
+    assert hdr.records()[names.index('NCHAN')] is hdr.card('nchan')
+
+    copy = hdr.copy()
+    copy.set_value('NCHAN', 32)
+    assert hdr['NCHAN'] == 16 and copy['NCHAN'] == 32
+
+    hdr.add_record({'name': 'NEWKEY', 'value': 1, 'comment': 'new'})
+    assert hdr.keys() == names + ['NEWKEY']
+    hdr.delete(['NBITS', 'NEWKEY'])
+    names.remove('NBITS')
+    assert hdr.keys() == names and not hdr.card('NBITS')
+    hdr.set_value('NSBLK', 8)
+    assert hdr.card('NSBLK') is hdr.records()[names.index('NSBLK')]
+    assert hdr['NSBLK'] == 8 and hdr.keys() == names
+    hdr['TBIN'] = 1e-4
+    assert hdr.card('TBIN')['value'] == 1e-4 and hdr.keys() == names
+
+
+def test_draft_header_long_string(search_file, tmpdir):
+    path = str(tmpdir.join('x.fits'))
+    psrf = pdat.psrfits(path, from_template=search_file(), verbose=False)
+    value = 'J1234+5678 ' * 6 + "it's"
+    psrf.set_draft_header('PRIMARY', {'SRC_NAME': value})
+    for ext_name in psrf.draft_hdr_keys[1:]:
+        psrf.copy_template_BinTable(ext_name)
+    record = psrf.draft_hdrs['PRIMARY'].card('SRC_NAME')
+    assert record['value'] == value
+    card = record['card_string']
+    assert len(card) <= 80 and card.endswith("&'")
+    assert fitsio.FITSRecord(card)['value'].rstrip('&') in value
+    psrf.write_psrfits()
+    psrf.close()
+    assert fitsio.read_header(path)['SRC_NAME'] == value
+
+    # A doubled quote is not split across cards
+    value_str = pdat.pdat.format_card_value('C', 'a' * 66 + "'b")[1]
+    card = pdat.pdat.make_card_string('OBJECT', value_str)
+    assert card == "OBJECT  = '" + 'a' * 66 + "&'"
+
+
+def test_set_subint_dims(search_file, tmpdir):
+    template = search_file()
+    path = str(tmpdir.join('dims.fits'))
+    psrf = pdat.psrfits(path, from_template=template, verbose=False)
+    psrf.set_subint_dims(nchan=32, npol=1, nsblk=8, nsubint=2)
+    hdr = psrf.draft_hdrs['SUBINT']
+    assert hdr['NAXIS1'] == 8*32 + 2*32*4 + 2*32*4 + 7*8 + 5*4
+    assert hdr['TFORM17'] == '256B' and hdr['TDIM17'] == '(1,32,1,8)'
+    assert psrf.draft_hdrs['PRIMARY']['OBSNCHAN'] == 32
+
+
+def test_append_from_file_chunks(search_file, capsys):
+    dest = search_file('dest.fits', nrows=3, seed=1)
+    sources = [search_file('a.fits', nrows=7, seed=2),
+               search_file('b.fits', nrows=2, seed=3)]
+    expected = np.concatenate([fitsio.read(pth, ext='SUBINT')
+                               for pth in [dest] + sources])
+
+    psrf = pdat.psrfits(dest, mode='rw', verbose=True)
+    capsys.readouterr()
+    stats = psrf.append_from_file(sources, chunk_rows=3)
+    out = capsys.readouterr().out
+    psrf.close()
+    assert stats['SUBINT'] == 9 and stats['HISTORY'] == 2
+    assert stats['bytes'] > 0 and stats['MB/s'] > 0
+    assert 'a.fits' in out and 'MB/s' in out
+
+    with fitsio.FITS(dest) as fits:
+        assert fits['SUBINT'].read_header()['NAXIS2'] == 12
+        assert np.array_equal(fits['SUBINT'].read(), expected)
+        assert fits['HISTORY'].get_nrows() == 3
+
+
+def test_append_from_file_validates_first(search_file):
+    dest = search_file('dest.fits', nrows=3)
+    good = search_file('good.fits', nrows=2)
+    bad = search_file('bad.fits', nchan=16)
+    psrf = pdat.psrfits(dest, mode='rw', verbose=False)
+    with pytest.raises(ValueError):
+        psrf.append_from_file([good, bad])
+    psrf.append_from_file(good, table=['SUBINT'])
+    psrf.close()
+    with fitsio.FITS(dest) as fits:
+        assert fits['SUBINT'].get_nrows() == 5
+        assert fits['HISTORY'].get_nrows() == 1
+
+
+def test_template_cache(search_file, tmpdir):
+    cache = pdat.template_cache
+    cache.clear()
+    template = search_file('template.fits')
+    first = pdat.psrfits(str(tmpdir.join('a.fits')), from_template=template,
+                         verbose=False)
+    second = pdat.psrfits(str(tmpdir.join('b.fits')), from_template=template,
+                          verbose=False)
+    assert first.template is second.template and len(cache) == 1
+    assert template in cache
+
+    # Draft headers are copy-on-write
+    first.set_draft_header('SUBINT', {'NCHAN': 64})
+    assert first.draft_hdrs['SUBINT']['NCHAN'] == 64
+    assert second.draft_hdrs['SUBINT']['NCHAN'] == 8
+    assert first.template.headers['SUBINT']['NCHAN'] == 8
+
+    # Tables are read once and copied into each draft
+    second.copy_template_BinTable('SUBINT')
+    second.copy_template_BinTable('HISTORY')
+    assert 'SUBINT' in second.template.tables
+    second.HDU_drafts['SUBINT']['DATA'][:] = 0
+    assert second.template.tables['SUBINT']['DATA'].any()
+    second.write_psrfits()
+    assert second._fits_template is None
+    second.close()
+    written = fitsio.read(str(tmpdir.join('b.fits')), ext='SUBINT')
+    assert not written['DATA'].any()
+    assert np.array_equal(written['DAT_SCL'],
+                          fitsio.read(template, ext='SUBINT')['DAT_SCL'])
+
+    # A changed template is re-read
+    search_file('template.fits', nchan=16)
+    os.utime(template, (1e9, 1e9))
+    assert template not in cache
+    third = pdat.psrfits(str(tmpdir.join('c.fits')), from_template=template,
+                         verbose=False)
+    assert third.template is not first.template
+    assert third.draft_hdrs['SUBINT']['NCHAN'] == 16
+
+    cache.invalidate(template)
+    assert len(cache) == 0
+    uncached = pdat.psrfits(str(tmpdir.join('d.fits')), from_template=template,
+                            verbose=False, cache=False)
+    assert uncached.template is None and len(cache) == 0
+    assert uncached.draft_hdrs['SUBINT']['NCHAN'] == 16
+
+
+def test_template_cache_limits(search_file, tmpdir):
+    cache = pdat.TemplateCache(max_templates=2)
+    paths = [search_file('t{0}.fits'.format(ii)) for ii in range(3)]
+    for path in paths:
+        cache.get(path)
+    cache.get(paths[1])
+    assert len(cache) == 2
+    assert paths[0] not in cache and paths[1] in cache
+
+    cache.max_bytes = 1
+    entry = cache.get(paths[2])
+    entry.read_table('SUBINT')
+    assert len(cache) == 1 and paths[2] in cache
+
+    cache = pdat.TemplateCache(cache_tables=False)
+    entry = cache.get(paths[0])
+    table = entry.read_table('SUBINT', ['TSUBINT'])
+    assert table.dtype.names == ('TSUBINT',) and entry.tables == {}
+
+
+@pytest.mark.parametrize('cache', [True, False])
+def test_copy_template_rows_and_share(search_file, tmpdir, cache):
+    template = search_file('template.fits', nrows=10)
+    rows = fitsio.read(template, ext='SUBINT')
+    path = str(tmpdir.join('short.fits'))
+    psrf = pdat.psrfits(path, from_template=template, verbose=False,
+                        cache=cache)
+    psrf.copy_template_BinTable('SUBINT', rows=slice(0, 3))
+    psrf.copy_template_BinTable('HISTORY', share=True)
+    assert not psrf.HDU_drafts['HISTORY'].flags.writeable
+    assert psrf.draft_hdrs['SUBINT']['NAXIS2'] == 3
+    assert np.array_equal(psrf.HDU_drafts['SUBINT'], rows[:3])
+    if cache:
+        # Only tables used whole are kept in the template cache
+        assert 'SUBINT' not in psrf.template.tables
+        assert 'HISTORY' in psrf.template.tables
+        assert np.array_equal(psrf.read_template_table('SUBINT', rows=[1, 2]),
+                              rows[1:3])
+        assert 'SUBINT' not in psrf.template.tables
+    psrf.write_psrfits()
+    psrf.close()
+
+    with fitsio.FITS(path) as fits:
+        assert fits['SUBINT'].read_header()['NAXIS2'] == 3
+        assert np.array_equal(fits['SUBINT'].read(), rows[:3])
+        assert np.array_equal(fits['HISTORY'].read(),
+                              fitsio.read(template, ext='HISTORY'))
+    assert np.array_equal(pdat.PyPSRFITS(path).get_data(0, -1),
+                          pdat.PyPSRFITS(template).get_data(0, 2))
+
+
+def test_copy_template_cols_and_dtypes(search_file, tmpdir):
+    template = search_file('template.fits', nrows=6)
+    rows = fitsio.read(template, ext='SUBINT')
+    psrf = pdat.psrfits(str(tmpdir.join('x.fits')), from_template=template,
+                        verbose=False)
+    psrf.copy_template_BinTable('SUBINT', cols=['OFFS_SUB', 'DAT_SCL'],
+                                rows=[5, 1])
+    assert np.array_equal(psrf.HDU_drafts['SUBINT']['OFFS_SUB'],
+                          rows['OFFS_SUB'][[5, 1]])
+    assert np.array_equal(psrf.HDU_drafts['SUBINT']['DAT_SCL'],
+                          rows['DAT_SCL'][[5, 1]])
+
+    # set_subint_dims gives DATA the (nbin, nchan, npol, nsblk) shape
+    psrf.set_subint_dims(nchan=8, npol=2, nsblk=16, nsubint=6)
+    psrf.copy_template_BinTable('SUBINT', dtypes=psrf.subint_dtype,
+                                rows=4)
+    data = psrf.HDU_drafts['SUBINT']['DATA']
+    assert data.shape == (1, 1, 8, 2, 16)
+    assert np.array_equal(data.ravel(), rows['DATA'][4].ravel())
+    with pytest.raises(ValueError):
+        psrf.copy_template_BinTable('SUBINT', cols=['DATA'], share=True)
+    psrf.set_subint_dims(nchan=4, npol=2, nsblk=16, nsubint=6)
+    with pytest.raises(ValueError):
+        psrf.copy_template_BinTable('SUBINT', dtypes=psrf.subint_dtype)
+
+
+def test_rw_headers_are_lazy(search_file):
+    path = search_file(nrows=2)
+    source = search_file('more.fits', nrows=3)
+    psrf = pdat.psrfits(path, mode='rw', verbose=False)
+    assert psrf.draft_hdr_keys == ['PRIMARY', 'HISTORY', 'SUBINT']
+    assert not any(psrf.draft_hdrs.is_loaded(key)
+                   for key in psrf.draft_hdr_keys)
+
+    psrf.set_draft_header('PRIMARY', {'SRC_NAME': 'J0000+0000'})
+    psrf.set_hdr_from_draft('PRIMARY')
+    psrf.append_from_file(source, table=['SUBINT'])
+    assert psrf.draft_hdrs.is_loaded('PRIMARY')
+    assert not psrf.draft_hdrs.is_loaded('SUBINT')
+    assert list(psrf.draft_hdrs.keys()) == psrf.draft_hdr_keys
+    assert psrf.draft_hdrs['SUBINT']['NSBLK'] == 16
+    with pytest.raises(KeyError):
+        psrf.draft_hdrs['POLYCO']
+    psrf.close()
+
+    assert fitsio.read_header(path)['SRC_NAME'] == 'J0000+0000'
+    assert fitsio.read_header(path, ext='SUBINT')['NAXIS2'] == 5
+
+
+@pytest.mark.parametrize('nbits', [8, 16])
+def test_quantize_subint_data(search_file, tmpdir, nbits):
+    template = search_file(nrows=3, nbits=nbits)
+    data = pdat.PyPSRFITS(template).get_data(0, -1)
+    path = str(tmpdir.join('quantized.fits'))
+    psrf = pdat.psrfits(path, from_template=template, verbose=False)
+    for ext_name in psrf.draft_hdr_keys[1:]:
+        psrf.copy_template_BinTable(ext_name)
+    psrf.append_chunk_bytes = 1
+    psrf.quantize_subint_data(2 * data[16:], start_row=1)
+    with pytest.raises(ValueError):
+        psrf.quantize_subint_data(data, start_row=1)
+    psrf.write_psrfits()
+    psrf.close()
+
+    new = pdat.PyPSRFITS(path).get_data(0, -1)
+    step = fitsio.read(path, ext='SUBINT')['DAT_SCL'].reshape(3, 1, 2, 8)
+    step = np.repeat(step, 16, axis=1).reshape(new.shape) / 2 * 1.0001
+    assert np.array_equal(new[:16], data[:16])
+    # float32 rounding of the large 16-bit values
+    step += 1e-6 * abs(new)
+    assert (abs(new[16:] - 2 * data[16:]) <= step[16:]).all()
+
+    # Decode the file as FITS defines it, independently of the reader. The
+    # AA and BB samples are unsigned.
+    rows = fitsio.read(path, ext='SUBINT')
+    assert rows['DATA'].dtype.base == np.dtype('>i2' if nbits == 16 else 'u1')
+    raw = rows['DATA'].astype(np.int64).reshape((3, 16, 2, 8)) % 2**nbits
+    decoded = (raw * rows['DAT_SCL'].reshape((3, 1, 2, 8))
+               + rows['DAT_OFFS'].reshape((3, 1, 2, 8))).reshape(new.shape)
+    assert (abs(decoded[16:] - 2 * data[16:]) <= step[16:]).all()
+    assert np.allclose(decoded, new, rtol=1e-6)
+
+
+@pytest.mark.parametrize('nbits', [1, 2, 4])
+@pytest.mark.parametrize('stream', [False, True])
+def test_write_sub_byte(search_file, tmpdir, nbits, stream):
+    template = search_file(nrows=3)
+    data = pdat.PyPSRFITS(template).get_data(0, -1)
+    path = str(tmpdir.join('packed.fits'))
+    psrf = pdat.psrfits(path, from_template=template, verbose=False)
+    psrf.set_subint_dims(nchan=8, npol=2, nsblk=16, nsubint=3, nbits=nbits)
+    hdr = psrf.draft_hdrs['SUBINT']
+    assert hdr['NBITS'] == nbits and hdr['TFORM17'] == str(32*nbits) + 'B'
+    assert hdr['TDIM17'] == '(1,{0},2,16)'.format(nbits)
+    assert hdr['NAXIS1'] == 32*nbits + 2*8*4 + 2*16*4 + 7*8 + 5*4
+    psrf.copy_template_BinTable('HISTORY')
+    cols = [dt[0] for dt in psrf.subint_dtype if dt[0] != 'DATA']
+    psrf.copy_template_BinTable('SUBINT', cols=cols, dtypes=psrf.subint_dtype)
+    if stream:
+        psrf.begin_subint_stream()
+        for row in range(3):
+            table = psrf.HDU_drafts['SUBINT'][row:row+1].copy()
+            psrf.quantize_subint_data(data[16*row:16*(row+1)], table=table)
+            psrf.append_subint_array(table)
+        psrf.end_subint_stream()
+    else:
+        psrf.quantize_subint_data(data)
+        psrf.write_psrfits()
+    psrf.close()
+
+    assert fitsio.read_header(path, ext='SUBINT')['NAXIS1'] == hdr['NAXIS1']
+    new = pdat.PyPSRFITS(path).get_data(0, -1)
+    step = fitsio.read(path, ext='SUBINT')['DAT_SCL'].reshape(3, 1, 2, 8)
+    step = np.repeat(step, 16, axis=1).reshape(new.shape) / 2 * 1.0001
+    assert (abs(new - data) <= step + 1e-6).all()
+
+
+def test_set_subint_dims_bad_nbits(search_file, tmpdir):
+    psrf = pdat.psrfits(str(tmpdir.join('x.fits')),
+                        from_template=search_file(), verbose=False)
+    with pytest.raises(ValueError):
+        psrf.set_subint_dims(nchan=8, npol=2, nsblk=16, nbits=3)
+    with pytest.raises(ValueError):
+        psrf.set_subint_dims(nchan=3, npol=2, nsblk=16, nbits=2)
+    with pytest.raises(ValueError):
+        psrf.set_subint_dims(nchan=8, npol=2, nsblk=16, data_dtype='>f4')
+    with pytest.raises(ValueError):
+        psrf.set_subint_dims(nchan=8, npol=2, nsblk=16, data_dtype='>i2',
+                             nbits=8)
+    psrf.set_subint_dims(nchan=8, npol=2, nsblk=16, data_dtype='>i2')
+    assert [d[1] for d in psrf.subint_dtype if d[0] == 'DATA'] == ['>i2']
+    assert psrf.draft_hdrs['SUBINT']['NBITS'] == 16
@@ -0,0 +1,404 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the search-mode reader in `pdat.pypsrfits`."""
+
+import numpy as np
+import fitsio
+import pytest
+
+from pdat import PyPSRFITS
+from pdat.pypsrfits import (decode_search_block, quantize_search_block,
+                            pack_samples, unpack_samples)
+
+
+def loop_get_data(pf, start_row, end_row, downsamp=1, fdownsamp=1):
+    """The original per-sample decoding loop of get_data(), kept as the
+    reference for the vectorized decoder."""
+    nsblk = pf.subhdr['NSBLK']
+    npol = pf.subhdr['NPOL']
+    nchan = pf.subhdr['NCHAN']
+    nbit = pf.subhdr['NBITS']
+    tbin_ds = pf.subhdr['TBIN'] * downsamp
+    u_t, s_t = {8: (np.uint8, np.int8), 16: (np.uint16, np.int16),
+                32: (np.float32, np.float32)}[nbit]
+    signpol = 2 if 'AABB' in pf.subhdr['POL_TYPE'] else 1
+    nrows_tot = end_row - start_row + 1
+    nsblk_ds = nsblk // downsamp
+    result = np.zeros((nrows_tot*nsblk_ds, npol, nchan//fdownsamp),
+                      dtype=np.float32)
+    times = np.zeros(nrows_tot*nsblk_ds)
+    for irow in range(nrows_tot):
+        row = pf.fits['SUBINT'][irow+start_row:irow+start_row+1]
+        scales = row['DAT_SCL'][0].reshape((npol, nchan))
+        offsets = row['DAT_OFFS'][0].reshape((npol, nchan))
+        t0_row = row['OFFS_SUB'][0] - row['TSUBINT'][0]/2.0
+        freqs_row = row['DAT_FREQ'][0]
+        dtmp = row['DATA'][0]
+        if nbit == 16:
+            dtmp = dtmp.astype(np.int16).reshape((nsblk, npol, nchan, 1))
+        for isamp in range(nsblk_ds):
+            times[irow*nsblk_ds+isamp] = t0_row + (isamp+0.5)*tbin_ds
+            for ipol in range(npol):
+                t = u_t if ipol < signpol else s_t
+                samp = dtmp[isamp*downsamp:(isamp+1)*downsamp,
+                            ipol, :, 0].astype(t).mean(0)
+                samp *= scales[ipol, :]
+                samp += offsets[ipol, :]
+                if fdownsamp == 1:
+                    result[irow*nsblk_ds+isamp, ipol, :] = samp
+                    freqs = freqs_row.copy()
+                else:
+                    result[irow*nsblk_ds+isamp, ipol, :] = \
+                        samp.reshape((-1, fdownsamp)).mean(1)
+                    freqs = freqs_row.reshape((-1, fdownsamp)).mean(1)
+    return result, times, freqs
+
+
+@pytest.mark.parametrize('nbits', [8, 16, 32])
+@pytest.mark.parametrize('poltype', ['AABBCRCI', 'IQUV'])
+@pytest.mark.parametrize('downsamp,fdownsamp', [(1, 1), (4, 1), (1, 2),
+                                                (8, 4)])
+def test_get_data_matches_loop(search_file, nbits, poltype,
+                               downsamp, fdownsamp):
+    path = search_file(nbits=nbits, poltype=poltype, npol=4)
+    pf = PyPSRFITS(path)
+    data, times, freqs = pf.get_data(0, -1, downsamp=downsamp,
+                                     fdownsamp=fdownsamp, get_ft=True)
+    ref, ref_times, ref_freqs = loop_get_data(pf, 0, 3, downsamp, fdownsamp)
+    assert data.dtype == np.float32
+    assert np.array_equal(data, ref)
+    assert np.array_equal(times, ref_times)
+    assert np.array_equal(freqs, ref_freqs)
+
+
+def test_get_data_single_row_unscaled(search_file):
+    path = search_file()
+    pf = PyPSRFITS(path)
+    data = pf.get_data(2, apply_scales=False, squeeze=True)
+    raw = pf.fits['SUBINT']['DATA'][2][:, :, :, 0]
+    assert np.array_equal(data[:, 0], raw[:, 0])
+    assert np.array_equal(data[:, 1], raw[:, 1])
+
+
+def test_get_data_rejects_fold_mode(search_file):
+    path = search_file()
+    pf = PyPSRFITS(path)
+    pf.hdr['OBS_MODE'] = 'PSR'
+    with pytest.raises(RuntimeError):
+        pf.get_data(0)
+
+
+def test_get_data_block_size_independent(search_file):
+    path = search_file(nrows=7)
+    pf = PyPSRFITS(path)
+    full = pf.get_data(0, -1, downsamp=2)
+    pf.read_block_bytes = 3 * pf.subhdr['NAXIS1']
+    assert np.array_equal(pf.get_data(0, -1, downsamp=2), full)
+    assert np.array_equal(pf.get_data(2, 5, downsamp=2), full[2*8:6*8])
+
+
+def test_row_info(search_file):
+    path = search_file()
+    pf = PyPSRFITS(path)
+    info = pf.get_row_info()
+    assert len(info) == 4
+    assert np.array_equal(info['DAT_SCL'][1],
+                          pf.fits['SUBINT']['DAT_SCL'][1])
+    assert np.array_equal(pf.get_row_info(1, -2), info[1:3])
+    # Only the frequencies of the first subint are kept
+    assert pf.get_freqs() is pf.get_freqs(0)
+    assert np.array_equal(pf.get_freqs(-1), info['DAT_FREQ'][3])
+    rows = pf.read_rows(1, 2, columns=['DATA', 'OFFS_SUB'])
+    assert len(rows) == 2
+    assert np.array_equal(rows['OFFS_SUB'], info['OFFS_SUB'][1:3])
+
+
+def test_iter_blocks_matches_get_data(search_file):
+    path = search_file(nrows=7)
+    pf = PyPSRFITS(path)
+    data, times, freqs = pf.get_data(0, -1, downsamp=4, fdownsamp=2,
+                                     get_ft=True)
+    blocks = []
+    buffers = set()
+    for d, t, f in pf.iter_blocks(3, downsamp=4, fdownsamp=2):
+        assert d.shape[0] <= 3 * 4
+        buffers.add(d.__array_interface__['data'][0])
+        blocks.append((d.copy(), t.copy()))
+        assert np.array_equal(f, freqs)
+    assert len(blocks) == 3
+    assert len(buffers) == 1
+    assert np.array_equal(np.concatenate([b[0] for b in blocks]), data)
+    assert np.array_equal(np.concatenate([b[1] for b in blocks]), times)
+
+
+def test_iter_blocks_bad_block_size(search_file):
+    pf = PyPSRFITS(search_file())
+    with pytest.raises(ValueError):
+        next(pf.iter_blocks(0))
+
+
+@pytest.mark.parametrize('nbits', [1, 2, 4])
+def test_get_data_sub_byte(search_file, nbits):
+    nsblk, npol, nchan = 16, 2, 8
+    path = search_file(nbits=nbits, npol=npol, nchan=nchan, nsblk=nsblk)
+    pf = PyPSRFITS(path)
+    raw = pf.fits['SUBINT']['DATA'][:]
+    bits = np.unpackbits(raw, axis=1).reshape((raw.shape[0], -1, nbits))
+    weights = 2**np.arange(nbits)[::-1]
+    samples = (bits * weights).sum(-1).reshape((-1, npol, nchan))
+
+    data = pf.get_data(0, -1, apply_scales=False)
+    assert np.array_equal(data, samples)
+    info = pf.get_row_info()
+    scl = info['DAT_SCL'].reshape((-1, 1, npol, nchan))
+    offs = info['DAT_OFFS'].reshape((-1, 1, npol, nchan))
+    expected = (samples.reshape((-1, nsblk, npol, nchan)) * scl
+                + offs).reshape((-1, 4, npol, nchan)).mean(1)
+    assert np.allclose(pf.get_data(0, -1, downsamp=4), expected, rtol=1e-6)
+
+
+@pytest.mark.parametrize('nbits', [2, 8, 16, 32])
+def test_memmap_matches_fitsio(search_file, nbits):
+    path = search_file(nbits=nbits)
+    pf = PyPSRFITS(path)
+    cols = pf.memmap_columns()
+    for col in ['DATA', 'DAT_SCL', 'DAT_OFFS', 'DAT_WTS']:
+        assert isinstance(cols[col].base, np.memmap) or \
+            isinstance(cols[col], np.memmap)
+        assert np.array_equal(cols[col], pf.fits['SUBINT'][col][:])
+    assert cols['DATA'].dtype == pf.fits['SUBINT']['DATA'][:].dtype
+
+    mapped = PyPSRFITS(path, use_mmap=True)
+    assert np.array_equal(mapped.get_data(0, -1, downsamp=2),
+                          pf.get_data(0, -1, downsamp=2))
+
+
+def test_scaled_data_column_not_memmapped(search_file, tmpdir):
+    # fitsio stores signed bytes as TFORM 'B' with TZERO = -128
+    rows = fitsio.read(search_file(npol=4), ext='SUBINT')
+    dtype = [(name, 'i1', rows.dtype[name].shape) if name == 'DATA' else
+             (name, rows.dtype[name].base, rows.dtype[name].shape)
+             for name in rows.dtype.names]
+    signed = np.zeros(len(rows), dtype=dtype)
+    for name in rows.dtype.names:
+        signed[name] = rows[name].view(signed.dtype[name].base)
+    path = str(tmpdir.join('signed.fits'))
+    subhdr = [{'name': key, 'value': value} for key, value in
+              [('NPOL', 4), ('POL_TYPE', 'AABBCRCI'), ('TBIN', 1e-3),
+               ('NBIN', 1), ('NBITS', 8), ('NCHAN', 8), ('NSBLK', 16)]]
+    with fitsio.FITS(path, 'rw', clobber=True) as fits:
+        fits.write(None, header=[{'name': 'OBS_MODE', 'value': 'SEARCH'}])
+        fits.write_table(signed, extname='SUBINT', header=subhdr)
+
+    pf = PyPSRFITS(path)
+    assert not pf.can_memmap()
+    with pytest.raises(ValueError):
+        pf.memmap()
+    full = pf.get_data(0, -1)
+    assert np.array_equal(PyPSRFITS(path, use_mmap=True).get_data(0, -1),
+                          full)
+    assert np.array_equal(pf.get_data(0, -1, chans=[1, 6], pols=[2]),
+                          full[:, [2]][..., [1, 6]])
+    import pdat
+    psrf = pdat.psrfits(path, mode='r', verbose=False)
+    with pytest.raises(ValueError):
+        psrf.memmap_columns()
+    psrf.close()
+
+
+def test_psrfits_memmap_columns(search_file):
+    import pdat
+    path = search_file()
+    psrf = pdat.psrfits(path, mode='r', verbose=False)
+    cols = psrf.memmap_columns(columns=['DATA', 'DAT_WTS'])
+    assert np.array_equal(cols['DATA'][1], psrf['SUBINT']['DATA'][1])
+    assert np.array_equal(cols['DAT_WTS'], psrf['SUBINT']['DAT_WTS'][:])
+
+
+def test_parallel_decode_matches_serial(search_file):
+    path = search_file(nrows=9)
+    pf = PyPSRFITS(path)
+    data, times, freqs = pf.get_data(1, -1, downsamp=2, get_ft=True)
+    pdata, ptimes, pfreqs = pf.get_data(1, -1, downsamp=2, get_ft=True,
+                                        workers=3)
+    assert np.array_equal(pdata, data)
+    assert np.array_equal(ptimes, times)
+    assert np.array_equal(pfreqs, freqs)
+
+    blocks = [d.copy() for d, t, f in pf.iter_blocks(4, start_row=1,
+                                                     downsamp=2, workers=2)]
+    assert np.array_equal(np.concatenate(blocks), data)
+
+
+@pytest.mark.parametrize('nbits', [2, 8, 16, 32])
+@pytest.mark.parametrize('sel', [dict(chan_range=(2, 6)),
+                                 dict(chans=[7, 0, 5]),
+                                 dict(pols=[1, 3]),
+                                 dict(pols=[3, 0], chan_range=(4, 8))])
+def test_get_data_selection(search_file, nbits, sel):
+    path = search_file(nbits=nbits, npol=4)
+    pf = PyPSRFITS(path)
+    full, times, freqs = pf.get_data(0, -1, downsamp=2, get_ft=True)
+    chans = np.arange(8)
+    if 'chan_range' in sel:
+        chans = chans[slice(*sel['chan_range'])]
+    elif 'chans' in sel:
+        chans = np.array(sel['chans'])
+    pols = np.array(sel.get('pols', np.arange(4)))
+
+    data, stimes, sfreqs = pf.get_data(0, -1, downsamp=2, get_ft=True, **sel)
+    assert np.array_equal(data, full[:, pols][:, :, chans])
+    assert np.array_equal(stimes, times)
+    assert np.array_equal(sfreqs, freqs[chans])
+
+
+def test_get_data_selection_fdownsamp(search_file):
+    pf = PyPSRFITS(search_file(npol=4))
+    full = pf.get_data(0, -1)
+    data = pf.get_data(0, -1, chan_range=(2, 6), pols=[0], fdownsamp=2)
+    assert data.shape == (64, 1, 2)
+    expected = full[:, :1, 2:6].reshape((64, 1, 2, 2)).mean(-1)
+    assert np.allclose(data, expected, rtol=1e-6)
+    with pytest.raises(ValueError):
+        pf.get_data(0, chan_range=(0, 2), chans=[0, 1])
+
+
+def test_get_data_out_buffer(search_file):
+    pf = PyPSRFITS(search_file())
+    expected = pf.get_data(0, -1, downsamp=2)
+    out = np.empty_like(expected)
+    result = pf.get_data(0, -1, downsamp=2, out=out)
+    assert result is out
+    assert np.array_equal(out, expected)
+    with pytest.raises(ValueError):
+        pf.get_data(0, -1, out=out)
+    with pytest.raises(ValueError):
+        pf.get_data(0, -1, downsamp=2, out=out, out_dtype=np.float16)
+    with pytest.raises(ValueError):
+        pf.get_data(0, -1, downsamp=2, out=np.empty(out.shape[::-1],
+                                                    dtype=np.float32).T)
+
+
+def test_get_data_out_dtype(search_file):
+    pf = PyPSRFITS(search_file(npol=4, poltype='AABBCRCI'))
+    full = pf.get_data(0, -1, downsamp=2)
+    half = pf.get_data(0, -1, downsamp=2, out_dtype=np.float16)
+    assert half.dtype == np.float16
+    assert np.array_equal(half, full.astype(np.float16))
+
+    raw = pf.get_data(0, -1, out_dtype=np.int16)
+    unscaled = pf.get_data(0, -1, apply_scales=False)
+    assert raw.dtype == np.int16
+    assert np.array_equal(raw, unscaled)
+    assert raw[:, 2:].min() < 0 <= raw[:, :2].min()
+    with pytest.raises(ValueError):
+        pf.get_data(0, -1, downsamp=2, out_dtype=np.int16)
+    blocks = [d.copy() for d, t, f in pf.iter_blocks(3, out_dtype=np.int16)]
+    assert np.array_equal(np.concatenate(blocks), raw)
+
+
+@pytest.mark.parametrize('nbits', [8, 16])
+@pytest.mark.parametrize('method', ['minmax', 'percentile'])
+def test_quantize_inverts_decode(search_file, nbits, method):
+    pf = PyPSRFITS(search_file(npol=4, poltype='AABBCRCI', nbits=nbits))
+    data = pf.get_data(0, -1).reshape((4, 16, 4, 8))
+    samples, scales, offsets = quantize_search_block(data, nbits, signpol=2,
+                                                     method=method)
+    assert samples.dtype == (np.uint8 if nbits == 8 else np.uint16)
+    decoded = decode_search_block(samples, nbits, signpol=2, scales=scales,
+                                  offsets=offsets).reshape(data.shape)
+    # Half a step, plus float32 rounding of the large 16-bit values
+    step = scales[:, np.newaxis] / 2 * 1.0001 + 1e-6 * abs(data)
+    inside = np.ones(data.shape, dtype=bool)
+    if method == 'percentile':
+        # Only the clipped outliers are further away
+        lo, hi = np.percentile(data, (0.5, 99.5), axis=1)
+        inside = (data >= lo[:, np.newaxis]) & (data <= hi[:, np.newaxis])
+        assert inside.mean() > 0.8
+    assert (abs(decoded - data) <= step)[inside].all()
+
+    flat = np.zeros((1, 16, 4, 8), dtype=np.float32) + 3.0
+    samples, scales, offsets = quantize_search_block(flat, nbits, signpol=2)
+    assert np.allclose(decode_search_block(samples, nbits, signpol=2,
+                                           scales=scales, offsets=offsets), 3)
+
+
+@pytest.mark.parametrize('nbits', [1, 2, 4])
+def test_pack_samples(nbits):
+    rng = np.random.RandomState(1)
+    samples = rng.randint(0, 2**nbits, (3, 5, 16)).astype(np.uint8)
+    packed = pack_samples(samples, nbits)
+    assert packed.shape == (3, 5, 16*nbits//8)
+    assert np.array_equal(unpack_samples(packed, nbits), samples)
+    first = [[1] + [0]*(8//nbits - 1)]
+    assert pack_samples(first, nbits)[0, 0] == 1 << (8-nbits)
+    with pytest.raises(ValueError):
+        pack_samples(samples[..., :-1], nbits)
+
+
+@pytest.mark.parametrize('poltype,npol', [('AABBCRCI', 4), ('AABB', 2),
+                                          ('IQUV', 4), ('AA+BB', 1)])
+def test_get_data_pol_mode(search_file, poltype, npol):
+    pf = PyPSRFITS(search_file(npol=npol, poltype=poltype))
+    full = pf.get_data(0, -1, fdownsamp=2)
+    total = pf.get_data(0, -1, fdownsamp=2, pol_mode='I')
+    assert total.shape == (64, 1, 4)
+    if 'AABB' in poltype:
+        assert np.allclose(total[:, 0], full[:, 0] + full[:, 1])
+        for mode, pol in [('AA', 0), ('BB', 1)]:
+            assert np.array_equal(pf.get_data(0, -1, fdownsamp=2,
+                                              pol_mode=mode)[:, 0],
+                                  full[:, pol])
+        assert np.array_equal(pf.get_data(0, -1, fdownsamp=2,
+                                          pol_mode='AABB-sum'), total)
+        with pytest.raises(ValueError):
+            pf.get_data(0, -1, pol_mode='I', out_dtype=np.int16)
+    else:
+        assert np.array_equal(total[:, 0], full[:, 0])
+        with pytest.raises(ValueError):
+            pf.get_data(0, -1, pol_mode='AA')
+    blocks = [d.copy() for d, t, f in pf.iter_blocks(3, fdownsamp=2,
+                                                     pol_mode='I')]
+    assert np.array_equal(np.concatenate(blocks), total)
+    assert np.array_equal(pf.get_data(0, -1, fdownsamp=2, pol_mode='I',
+                                      workers=2), total)
+    with pytest.raises(ValueError):
+        pf.get_data(0, -1, pol_mode='I', pols=[0])
+    with pytest.raises(ValueError):
+        pf.get_data(0, -1, pol_mode='V')
+
+
+@pytest.mark.parametrize('fdownsamp', [1, 2, 4])
+def test_get_data_applies_weights(search_file, fdownsamp):
+    path = search_file(npol=4)
+    unweighted = PyPSRFITS(path).get_data(0, -1).reshape((4, 16, 4, 8))
+    weights = np.ones((4, 8), dtype=np.float32)
+    weights[:, 1] = 0
+    weights[:, 5] = 0.5
+    weights[2, 4:] = 0
+    weights[:, 7] = 0
+    with fitsio.FITS(path, 'rw') as fits:
+        fits['SUBINT'].write_column('DAT_WTS', weights)
+
+    pf = PyPSRFITS(path)
+    data = pf.get_data(0, -1, fdownsamp=fdownsamp)
+    w = weights[:, None, None].astype(np.float64)
+    groups = (unweighted * w).reshape((4, 16, 4, -1, fdownsamp)).sum(-1)
+    wsum = w.reshape((4, 1, 1, -1, fdownsamp)).sum(-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ref = np.where(wsum > 0, groups / wsum, 0)
+    if fdownsamp == 1:
+        ref = np.where(w > 0, unweighted, 0)
+    assert np.allclose(data, ref.reshape(data.shape), rtol=1e-6, atol=1e-6)
+    assert np.all(data.reshape((4, 16, 4, -1))[2, ..., 4//fdownsamp:] == 0)
+
+    blocks = [d.copy() for d, t, f in pf.iter_blocks(3, fdownsamp=fdownsamp)]
+    assert np.array_equal(np.concatenate(blocks), data)
+    assert np.array_equal(pf.get_data(0, -1, fdownsamp=fdownsamp,
+                                      workers=2), data)
+    assert np.array_equal(pf.get_data(0, -1, apply_weights=False),
+                          unweighted.reshape((64, 4, 8)))
+    # Raw integer samples are returned as they are
+    raw = pf.get_data(0, -1, apply_scales=False, out_dtype=np.uint8)
+    assert np.count_nonzero(raw[:, :, 1])
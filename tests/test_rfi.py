@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the spectral kurtosis RFI flagging in `pdat.rfi`."""
+
+import numpy as np
+import fitsio
+import pytest
+
+import pdat
+from pdat.pypsrfits import raw_to_samples
+from pdat.rfi import raw_moments, scaled_moments
+
+
+@pytest.fixture
+def rfi_file(search_file):
+    """A file of noise with a burst in row 1, channel 5 and a constant
+    signal in row 2, channel 20."""
+    path = search_file(nrows=3, nsblk=64, npol=2, nchan=32, poltype='AABB')
+    rng = np.random.RandomState(2)
+    with fitsio.FITS(path, 'rw') as fits:
+        rows = fits['SUBINT'].read()
+        data = rows['DATA']
+        data[...] = np.clip(rng.normal(100, 10, data.shape), 0, 255)
+        data[1, ::16, :, 5] = 250
+        data[2, :, :, 20] = 120
+        fits['SUBINT'].write(rows)
+    return path
+
+
+def test_sk_mask(rfi_file):
+    mask = pdat.sk_mask(rfi_file)
+    assert mask.shape == (3, 32)
+    assert mask[1, 5] and mask[2, 20]
+    assert mask.sum() <= 4
+    unscaled = pdat.sk_mask(rfi_file, start_row=1, apply_scales=False)
+    assert unscaled.shape == (2, 32) and unscaled[0, 5] and unscaled[1, 20]
+    # One row at a time, with a reader that is left open
+    pf = pdat.PyPSRFITS(rfi_file)
+    pf.read_block_bytes = 1
+    assert np.array_equal(pdat.sk_mask(rfi_file, pf=pf), mask)
+    assert pf.fits['SUBINT'].get_nrows() == 3
+
+
+@pytest.mark.parametrize('nbits', [4, 8, 16])
+def test_raw_moments_match_decoded(search_file, nbits):
+    path = search_file(nrows=2, nbits=nbits, poltype='AABBCRCI', npol=4)
+    pf = pdat.PyPSRFITS(path)
+    dtmp = raw_to_samples(pf.read_rows(0, 1)['DATA'], nbits, (16, 4, 8))
+    if nbits == 16:
+        dtmp = dtmp.view(np.uint16)
+    s1, s2 = raw_moments(dtmp[:, :, :2])
+    assert s1.dtype == s2.dtype == np.int64
+    info = pf.get_row_info()
+    scales = info['DAT_SCL'].reshape((2, 4, 8))[:, :2]
+    offsets = info['DAT_OFFS'].reshape((2, 4, 8))[:, :2]
+    p1, p2 = scaled_moments(s1, s2, 16, scales.astype(np.float64),
+                            offsets.astype(np.float64))
+    data = pf.get_data(0, 1).reshape((2, 16, 4, 8))[:, :, :2]
+    data = data.astype(np.float64)
+    assert np.allclose(p1, data.sum(1))
+    assert np.allclose(p2, (data**2).sum(1))
+
+    signed = dtmp[:, :, 2:].view(np.int8 if nbits == 8 else dtmp.dtype)
+    s1, s2 = raw_moments(signed)
+    assert np.array_equal(s2, (signed.astype(np.int64)**2).sum(1))
+
+
+def test_zap_channels(rfi_file, tmpdir):
+    mask = pdat.sk_mask(rfi_file)
+    expected = pdat.PyPSRFITS(rfi_file).get_data(0, -1)
+    expected.reshape((3, 64, 2, 32))[...] *= ~mask[:, None, None]
+    assert np.array_equal(pdat.PyPSRFITS(rfi_file).get_data(0, -1,
+                                                            zap=mask),
+                          expected)
+    with pytest.raises(ValueError):
+        pdat.PyPSRFITS(rfi_file).get_data(0, -1, zap=mask[1:])
+
+    psrf = pdat.psrfits(rfi_file, mode='rw', verbose=False)
+    psrf.zap_channels(mask[1:], start_row=1)
+    psrf.close()
+    weights = fitsio.read(rfi_file, ext='SUBINT')['DAT_WTS']
+    assert np.array_equal(weights == 0, mask & (np.arange(3) > 0)[:, None])
+
+    psrf = pdat.psrfits(str(tmpdir.join('new.fits')), from_template=rfi_file,
+                        verbose=False)
+    psrf.copy_template_BinTable('SUBINT')
+    psrf.zap_channels(mask)
+    assert np.array_equal(psrf.HDU_drafts['SUBINT']['DAT_WTS'] == 0,
+                          mask | (weights == 0))
+    with pytest.raises(ValueError):
+        psrf.zap_channels(mask[:, :4])
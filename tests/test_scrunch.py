@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `pdat.scrunch_psrfits`."""
+
+import numpy as np
+import fitsio
+import pytest
+
+import pdat
+
+
+def scrunch_reference(data, nsblk, tscrunch, fscrunch):
+    """Scrunch a whole [time, poln, chan] array at once."""
+    nsamp = len(data) // tscrunch // nsblk * nsblk * tscrunch
+    nchan = data.shape[2] // fscrunch
+    data = data[:nsamp, :, :nchan*fscrunch].astype(np.float64)
+    data = data.reshape((-1, tscrunch, data.shape[1], nchan, fscrunch))
+    return data.mean(4).mean(1)
+
+
+@pytest.mark.parametrize('tscrunch,fscrunch,nsblk,chunk_rows',
+                         [(4, 2, None, 2), (3, 1, None, 1), (6, 4, 5, 3),
+                          (1, 8, None, None)])
+def test_scrunch_matches_reference(search_file, tmpdir, tscrunch, fscrunch,
+                                   nsblk, chunk_rows):
+    path = search_file(nrows=5, npol=4, poltype='AABBCRCI', nbits=16)
+    out_path = str(tmpdir.join('scrunched.fits'))
+    stats = pdat.scrunch_psrfits(path, out_path, tscrunch=tscrunch,
+                                 fscrunch=fscrunch, nsblk=nsblk,
+                                 chunk_rows=chunk_rows, verbose=False)
+    if nsblk is None:
+        nsblk = 16 // tscrunch
+    expected = scrunch_reference(pdat.PyPSRFITS(path).get_data(0, -1),
+                                 nsblk, tscrunch, fscrunch)
+    nrows = len(expected) // nsblk
+    assert stats['rows_out'] == nrows
+
+    pf = pdat.PyPSRFITS(out_path)
+    data, times, freqs = pf.get_data(0, -1, get_ft=True)
+    scales = pf.get_row_info()['DAT_SCL'].reshape((nrows, 1, 4, -1))
+    step = np.repeat(scales, nsblk, axis=1).reshape(data.shape) / 2
+    assert np.all(abs(data - expected) <= step * 1.0001 + 1e-5*abs(data))
+
+    old = fitsio.read_header(path, ext='SUBINT')
+    hdr = pf.subhdr
+    assert hdr['NSBLK'] == nsblk and hdr['NCHAN'] == 8 // fscrunch
+    assert hdr['NBITS'] == 16 and hdr['NAXIS2'] == nrows
+    assert np.isclose(hdr['TBIN'], old['TBIN'] * tscrunch)
+    assert np.isclose(hdr['CHAN_BW'], old['CHAN_BW'] * fscrunch)
+    assert np.allclose(freqs, pdat.PyPSRFITS(path).get_freqs()
+                       .reshape((-1, fscrunch)).mean(1))
+    assert np.allclose(np.diff(times), hdr['TBIN'])
+    assert np.isclose(times[0], hdr['TBIN'] / 2)
+    assert np.array_equal(fitsio.read(out_path, ext='HISTORY'),
+                          fitsio.read(path, ext='HISTORY'))
+
+
+def test_scrunch_sub_byte_and_errors(search_file, tmpdir):
+    path = search_file(nrows=2)
+    out_path = str(tmpdir.join('scrunched.fits'))
+    pdat.scrunch_psrfits(path, out_path, tscrunch=2, nbits=2, verbose=False)
+    pf = pdat.PyPSRFITS(out_path)
+    assert pf.subhdr['NBITS'] == 2
+    assert path not in pdat.template_cache
+    assert pf.subhdr['NAXIS1'] == 32 + 2*8*4 + 2*16*4 + 76
+    assert pf.get_data(0, -1).shape == (16, 2, 8)
+    with pytest.raises(ValueError):
+        pdat.scrunch_psrfits(path, out_path, tscrunch=2, verbose=False)
+    with pytest.raises(ValueError):
+        pdat.scrunch_psrfits(path, out_path, tscrunch=64, nsblk=16,
+                             clobber=True, verbose=False)
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the streaming statistics in `pdat.stats`."""
+
+import numpy as np
+import pytest
+
+import pdat
+
+
+def check_stats(stats, data, nsblk):
+    """Compare a StreamStats with numpy reductions of the whole data."""
+    assert np.array_equal(stats.count, np.full(data.shape[1:], len(data)))
+    assert np.allclose(stats.mean, data.mean(0, dtype=np.float64))
+    assert np.allclose(stats.var, data.var(0, dtype=np.float64))
+    assert np.array_equal(stats.min, data.min(0))
+    assert np.array_equal(stats.max, data.max(0))
+    rows = data.reshape((-1, nsblk) + data.shape[1:]).astype(np.float64)
+    assert np.allclose(stats.subint_mean, rows.mean((1, 3)))
+    assert np.allclose(stats.subint_var, rows.var((1, 3)))
+    assert np.allclose(stats.zero_dm, data.mean(2), atol=1e-5)
+
+
+def test_stream_stats_merge():
+    rng = np.random.RandomState(0)
+    # A large offset makes the naive sum of squares lose precision
+    data = (1e4 + rng.randn(64, 2, 8)).astype(np.float32)
+    whole = pdat.StreamStats()
+    whole.update(data, nrows=8)
+    check_stats(whole, data, 8)
+
+    parts = [pdat.StreamStats() for _ in range(3)]
+    parts[0].update(data[:24], nrows=3)
+    parts[0].update(data[24:32])
+    parts[2].update(data[32:], row0=4, nrows=4)
+    merged = pdat.StreamStats().merge(parts[2]).merge(parts[1])
+    merged.merge(parts[0])
+    check_stats(merged, data, 8)
+    assert merged.next_row == 8 and list(merged.rows) == list(range(8))
+    assert merged.summary()['std'].shape == (2, 8)
+
+    with pytest.raises(ValueError):
+        merged.update(data[:10], nrows=3)
+    with pytest.raises(ValueError):
+        merged.update(data[:8, :, :4])
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_stats_from_read_path(search_file, workers):
+    pf = pdat.PyPSRFITS(search_file(nrows=6, npol=4, poltype='AABBCRCI'))
+    pf.read_block_bytes = 3000
+    stats = pdat.StreamStats()
+    data = pf.get_data(0, -1, downsamp=2, workers=workers, stats=stats)
+    check_stats(stats, data, 8)
+
+    stats = pdat.StreamStats()
+    blocks = [d.copy() for d, t, f in pf.iter_blocks(4, fdownsamp=2,
+                                                     pols=[0, 1],
+                                                     stats=stats)]
+    check_stats(stats, np.concatenate(blocks), 16)